@@ -0,0 +1,124 @@
+import logging
+import os
+import sqlite3
+from os import stat_result
+from pathlib import Path
+from threading import Lock, local
+from time import time
+from typing import Optional, Tuple
+
+from .config import HASH_CACHE_PATH, HASH_CACHE_SIZE
+
+INT64_MAX = 0x7fffffffffffffff
+
+
+class HashCache:
+    '''文件校验和缓存
+
+    以 (dev, inode, size, mtime_ns) 作为文件身份，内容未变化的文件无需再次读取。
+    数据保存在 SQLite 中，多个会话、多个进程可以同时读写。
+    '''
+
+    def __init__(self, path: str = HASH_CACHE_PATH,
+                 max_entries: int = HASH_CACHE_SIZE):
+        self.path = Path(os.path.expanduser(path))
+        self.max_entries = max_entries
+        self.n_puts = 0
+        self.mutex = Lock()
+        self.local = local()  # sqlite3 的连接不能跨线程使用, 每个线程独立连接
+
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        db = self.connect()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                   'dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER, '
+                   'chksum BLOB, atime INTEGER, PRIMARY KEY (dev, ino))')
+        db.execute('CREATE INDEX IF NOT EXISTS idx_atime ON hashes (atime)')
+
+    @classmethod
+    def open(cls, path: str = HASH_CACHE_PATH,
+             max_entries: int = HASH_CACHE_SIZE) -> Optional['HashCache']:
+        '''打开缓存，失败时 (如家目录只读) 返回 None'''
+        try:
+            return cls(path, max_entries)
+        except (OSError, sqlite3.Error) as e:
+            logging.warning(f'[HashCache] Disabled due to: {e}')
+            return None
+
+    def connect(self) -> sqlite3.Connection:
+        '''获取当前线程的数据库连接'''
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(str(self.path), timeout=30,
+                                 isolation_level=None)
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    @staticmethod
+    def identity(stat: stat_result) -> Tuple[int, int]:
+        '''文件的 (dev, inode), 超出 SQLite 整数范围的值转为负数'''
+        dev, ino = stat.st_dev, stat.st_ino
+        dev = dev if dev <= INT64_MAX else dev - (1 << 64)
+        ino = ino if ino <= INT64_MAX else ino - (1 << 64)
+        return dev, ino
+
+    def get(self, stat: stat_result) -> Optional[bytes]:
+        '''查找内容未变化的文件的校验和'''
+        dev, ino = self.identity(stat)
+        now = int(time())
+        try:
+            db = self.connect()
+            row = db.execute('SELECT chksum, atime FROM hashes '
+                             'WHERE dev=? AND ino=? AND size=? AND mtime=?',
+                             (dev, ino, stat.st_size, stat.st_mtime_ns)
+                             ).fetchone()
+            if row is None:
+                return None
+
+            # 访问时间只用于淘汰, 一天内只更新一次, 避免每次查询都写库
+            chksum, atime = row
+            if now - atime > 86400:
+                db.execute('UPDATE hashes SET atime=? WHERE dev=? AND ino=?',
+                           (now, dev, ino))
+            return bytes(chksum)
+        except sqlite3.Error as e:
+            logging.warning(f'[HashCache] Lookup failed: {e}')
+            return None
+
+    def put(self, stat: stat_result, chksum: bytes):
+        '''记录文件的校验和'''
+        now = int(time())
+        # 刚被修改过的文件可能仍在写入，同一 mtime 下内容还会变化，不做缓存
+        if now - stat.st_mtime < 2:
+            return
+
+        dev, ino = self.identity(stat)
+        try:
+            db = self.connect()
+            db.execute('INSERT OR REPLACE INTO hashes '
+                       'VALUES (?, ?, ?, ?, ?, ?)',
+                       (dev, ino, stat.st_size, stat.st_mtime_ns, chksum, now))
+        except sqlite3.Error as e:
+            logging.warning(f'[HashCache] Save failed: {e}')
+            return
+
+        with self.mutex:
+            self.n_puts += 1
+            need_evict = self.n_puts % 1000 == 0
+        if need_evict:
+            self.evict()
+
+    def evict(self):
+        '''超出容量时淘汰最久未使用的记录 (多淘汰 10%, 减少淘汰次数)'''
+        try:
+            db = self.connect()
+            n_rows, = db.execute('SELECT COUNT(*) FROM hashes').fetchone()
+            if n_rows > self.max_entries:
+                n_evict = n_rows - self.max_entries + self.max_entries // 10
+                db.execute('DELETE FROM hashes WHERE rowid IN ('
+                           'SELECT rowid FROM hashes ORDER BY atime LIMIT ?)',
+                           (n_evict,))
+                logging.debug(f'[HashCache] Evicted {n_evict} entries')
+        except sqlite3.Error as e:
+            logging.warning(f'[HashCache] Evict failed: {e}')
@@ -6,15 +6,16 @@ import logging
 import signal
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 from functools import partial, wraps
+from itertools import count
 from getpass import getpass, getuser
-from json import dumps
+from json import dumps, loads
 from os.path import abspath
 from pwd import getpwuid
 from socket import create_connection
 from textwrap import dedent
 from threading import Thread
 from time import sleep
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, List, Tuple
 
 from paramiko import Channel, Transport, SSHConfig
 from paramiko import RSAKey, DSSKey, ECDSAKey, Ed25519Key
@@ -24,8 +25,16 @@ from rich.progress import Progress, SpinnerColumn, TextColumn
 from rich.table import Table
 
 from .config import SERVER_ADDR, SSH_MUX, TIMEOUT
-from .network import Flag, Packet, send_pkt, recv_pkt
-from .transfer import Sender, Receiver, trans_progress
+from .config import (SCALE_MAX_TUNNELS, SCALE_INTERVAL, SCALE_MIN_GAIN,
+                     SCALE_IDLE_SHARE)
+from .config import DEFAULT_CHUNK_SIZE, MAX_CHUNK_SIZE, HASH_WORKERS
+from .config import BUNDLE_FILE_SIZE
+from .network import (Flag, Packet, SessionParams, ConnectionPool, send_pkt,
+                      recv_pkt)
+from .compress import CODECS, DEFAULT_CODEC, LEVELS
+from .network import CHKSUM_FUNCS
+from .cache import HashCache
+from .transfer import FileInfo, Sender, Receiver, Porter, trans_progress
 
 
 conn_progress = Progress(
@@ -51,6 +60,82 @@ def retry(num, *, wait, exceptions=(Exception,)):
     return deco
 
 
+class AutoScaler(Thread):
+    '''根据实测的吞吐量自动增减 SSH 隧道
+
+    从一条隧道开始，每隔 SCALE_INTERVAL 秒统计一次连接池的总吞吐量。
+    吞吐量仍在明显提升时再建立一条隧道，不再提升时撤掉最后建立的隧道并停止增长,
+    此后逐个下线几乎闲置的连接。吞吐量再次明显提升时恢复增长
+    '''
+
+    def __init__(self, client: 'Client', porter: Porter,
+                 add_tunnel: Callable[[], Any]):
+        super().__init__(daemon=True)
+        self.client = client
+        self.porter = porter
+        self.conn_pool: ConnectionPool = porter.conn_pool
+        self.add_tunnel = add_tunnel
+        self.best = 0.0  # 目前为止的最高吞吐量
+        self.is_growing = True
+
+    @property
+    def can_retire(self) -> bool:
+        '''旧版对端不认识 DETACH 报文'''
+        return self.conn_pool.params.protocol >= 2
+
+    def grow(self):
+        if len(self.client.tunnels) < self.client.n_tunnel:
+            logging.info(f'[b]fcp[/b]: add a tunnel, '
+                         f'{len(self.client.tunnels) + 1} in total')
+            try:
+                self.add_tunnel()
+            except (Exception, SystemExit) as e:
+                # 新建隧道失败 (如服务器拒绝更多连接) 时沿用已有的隧道, 继续采样
+                logging.warning(f'[b]fcp[/b]: failed to add a tunnel: {e!r}')
+
+    def shrink(self):
+        '''撤掉最后建立的隧道'''
+        tunnels = list(self.client.tunnels.values())
+        if len(tunnels) > 1 and self.can_retire:
+            logging.info('[b]fcp[/b]: throughput stopped improving, '
+                         'retire the last tunnel')
+            for channel in tunnels[-1]:
+                self.conn_pool.retire(channel)
+
+    def retire_idle(self, deltas: Dict[Any, int]):
+        '''下线一个几乎闲置的连接'''
+        if len(deltas) <= SSH_MUX or not self.can_retire:
+            return
+        average = sum(deltas.values()) / len(deltas)
+        conn, n_bytes = min(deltas.items(), key=lambda item: item[1])
+        if n_bytes < average * SCALE_IDLE_SHARE:
+            logging.info(f'[b]fcp[/b]: retire idle Channel-{id(conn):x}')
+            self.conn_pool.retire(conn)
+
+    def run(self):
+        last = self.conn_pool.traffic()
+        while self.porter.is_alive():
+            sleep(SCALE_INTERVAL)
+            traffic = self.conn_pool.traffic()
+            deltas = {conn: n_bytes - last.get(conn, 0)
+                      for conn, n_bytes in traffic.items()}
+            last = traffic
+            self.client.prune_tunnels()
+
+            rate = sum(deltas.values()) / SCALE_INTERVAL
+            if rate <= 0:
+                continue  # 尚未开始传输数据 (如正在计算校验和)
+            elif rate >= self.best * (1 + SCALE_MIN_GAIN):
+                self.best = rate
+                self.is_growing = True
+                self.grow()
+            elif self.is_growing:
+                self.is_growing = False
+                self.shrink()
+            else:
+                self.retire_idle(deltas)
+
+
 class Client:
     default_port = 22
     default_dir = os.path.expanduser('~/.ssh')
@@ -58,6 +143,11 @@ class Client:
 
     def __init__(self, cli_parser: ArgumentParser):
         args = cli_parser.parse_args()
+        if args.compress in LEVELS and args.compress_level:
+            low, high = LEVELS[args.compress]
+            if not low <= args.compress_level <= high:
+                cli_parser.error(f'--compress-level of {args.compress} must '
+                                 f'be between {low} and {high}')
 
         # init logger
         self.log_level = {
@@ -88,13 +178,29 @@ class Client:
         self.pkey_path = args.private_key
         self.include = args.include
         self.exclude = [p for p in args.exclude.split(',') if p]
-        self.n_tunnel = args.num
+        self.auto_scale = args.num == 'auto'
+        self.n_tunnel = SCALE_MAX_TUNNELS if self.auto_scale else args.num
+        self.chunk_size = min(args.chunk_size * 1024, MAX_CHUNK_SIZE)
+        self.chksum_mode = args.packet_check
+        self.compare = 'checksum' if args.checksum else 'quick'
+        self.n_hashers = args.hash_workers
+        self.delta = not args.whole_file
+        self.bundle_size = args.bundle_size * 1024
+        self.codec = args.compress
+        self.level = args.compress_level
+        self.ssh_compression = args.ssh_compression
+        if args.hash_cache:
+            FileInfo.hash_cache = HashCache.open()
+        FileInfo.mmap_io = args.mmap
         self.n_channel = self.n_tunnel * SSH_MUX
-        self.conn_tid = conn_progress.add_task('Connecting',
-                                               total=self.n_channel)
+        self.conn_tid = conn_progress.add_task(
+            'Connecting',
+            total=SSH_MUX if self.auto_scale else self.n_channel
+        )
 
         # the ssh tunnels
         self.tunnels: Dict[Transport, List[Channel]] = {}
+        self.conn_ids = count(1)  # 后续连接的编号, 首个连接为 0
 
     @staticmethod
     def parse_remote_addr(remote):
@@ -210,7 +316,8 @@ class Client:
         if isinstance(sock, tuple):
             sock = create_connection(sock)
         tp = Transport(sock)
-        tp.use_compression(True)
+        # 数据块由 FastCopy 按需压缩, SSH 层默认不再压缩
+        tp.use_compression(self.ssh_compression)
         tp.set_keepalive(60)
         try:
             tp.connect(username=user, pkey=pkey, password=password)
@@ -288,50 +395,94 @@ class Client:
         logging.error('[b]fcp[/b]: failed to create SSH tunnel')
         sys.exit(1)
 
-    def handshake(self, channel, conn_info: str):
+    def handshake(self, channel, conn_info: str
+                  ) -> Tuple[bytes, SessionParams]:
         '''握手'''
         conn_pkt = Packet.load(self.action, conn_info)
         send_pkt(channel, conn_pkt)
         session_pkt = recv_pkt(channel)
-        session_id, = session_pkt.unpack_body()
+        session_id, s_params = session_pkt.unpack_body()
         logging.info(f'[b]fcp[/b]: Channel-{id(channel):x} connected')
 
-        return session_id
+        # 旧版服务器不回传会话参数，此时使用 v1 协议
+        if s_params:
+            params = SessionParams.from_dict(loads(s_params))
+        else:
+            params = SessionParams()
+        logging.debug(f'[b]fcp[/b]: {params}')
+
+        return session_id, params
 
     def create_attached_channels(self, tp, conn_pool, session_id):
         channels = self.tunnels[tp]
-        attach_pkt = Packet.load(Flag.ATTACH, session_id)
 
         def _attache_channel():
             channel = self.create_channel(tp)
+            conn_id = next(self.conn_ids)
+            if conn_pool.params.resend:
+                attach_pkt = Packet.load(Flag.ATTACH, session_id, conn_id)
+            else:
+                attach_pkt = Packet.load(Flag.ATTACH, session_id)
             send_pkt(channel, attach_pkt)
-            conn_pool.add(channel)
+            conn_pool.add(channel, conn_id)
             logging.info(f'[b]fcp[/b]: Channel-{id(channel):x} connected')
 
         for _ in range(SSH_MUX - len(channels)):
             thr = Thread(target=_attache_channel, daemon=True)
             thr.start()
 
-    def attached_connect(self, conn_pool, session_id, pkey, password):
-        '''后续连接'''
+    @retry(3, wait=0.3, exceptions=ConnectionResetError)
+    def attach_tunnel(self, conn_pool, session_id, pkey, password):
+        '''新建一条隧道并在其中创建后续连接'''
         addr = (self.host, self.port)
+        tp = self.create_transport(addr, self.username, pkey, password)
+        if tp:
+            if self.auto_scale:
+                conn_progress.update(self.conn_tid,
+                                     total=len(self.tunnels) * SSH_MUX)
+            self.create_attached_channels(tp, conn_pool, session_id)
 
-        @retry(3, wait=0.3, exceptions=ConnectionResetError)
-        def _attache():
-            tp = self.create_transport(addr, self.username, pkey, password)
-            if tp:
-                self.create_attached_channels(tp, conn_pool, session_id)
-
+    def attached_connect(self, conn_pool, session_id, pkey, password):
+        '''后续连接'''
         # create channels from exists transports
         for tp in self.tunnels:
             self.create_attached_channels(tp, conn_pool, session_id)
 
-        # create new transports
-        for _ in range(self.n_tunnel - len(self.tunnels)):
-            thr = Thread(target=_attache, daemon=True)
+        # create new transports, 自动模式下由 AutoScaler 按需增加
+        n_tunnel = 1 if self.auto_scale else self.n_tunnel
+        for _ in range(n_tunnel - len(self.tunnels)):
+            thr = Thread(target=self.attach_tunnel, daemon=True,
+                         args=(conn_pool, session_id, pkey, password))
             thr.start()
             sleep(0.3)
 
+    def replace_channel(self, conn_pool, session_id, pkey, password, channel):
+        '''连接意外断开后补建一条, 所在的隧道已断开时改为新建隧道'''
+        for tp, channels in list(self.tunnels.items()):
+            if channel in channels:
+                channels.remove(channel)
+                break
+        else:
+            return
+
+        if tp.is_active():
+            logging.warning(f'[b]fcp[/b]: Channel-{id(channel):x} lost, '
+                            'reconnecting')
+            self.create_attached_channels(tp, conn_pool, session_id)
+        elif not channels:
+            # 隧道中的连接全部断开后只新建一条隧道
+            logging.warning('[b]fcp[/b]: tunnel lost, reconnecting')
+            self.tunnels.pop(tp, None)
+            tp.close()
+            self.attach_tunnel(conn_pool, session_id, pkey, password)
+
+    def prune_tunnels(self):
+        '''关闭所有通道均已下线的隧道'''
+        for tp, channels in list(self.tunnels.items()):
+            if channels and all(channel.closed for channel in channels):
+                tp.close()
+                self.tunnels.pop(tp, None)
+
     def start(self):
         progress_table = Table.grid()
         progress_table.add_row(conn_progress)
@@ -342,33 +493,52 @@ class Client:
                 tp, pkey, password = self.ssh_connect()
                 first_channel = self.create_channel(tp)
                 local_user = getpwuid(os.getuid()).pw_name
+                req_params = SessionParams.request(self.chunk_size,
+                                                   self.chksum_mode,
+                                                   self.compare,
+                                                   self.delta,
+                                                   self.bundle_size,
+                                                   self.codec,
+                                                   self.level)
 
                 if self.action == Flag.PULL:
                     conn_info = dumps({
                         'user': self.username,
                         'srcs': self.srcs,
                         'include': self.include,
-                        'exclude': self.exclude
+                        'exclude': self.exclude,
+                        'params': req_params
                     }, ensure_ascii=False, separators=(',', ':'))
-                    session_id = self.handshake(first_channel, conn_info)
+                    session_id, params = self.handshake(first_channel,
+                                                        conn_info)
                     porter = Receiver(session_id, local_user, self.dst,
-                                      self.n_channel)
+                                      self.n_channel, params)
                 else:
                     conn_info = dumps({
                         'user': self.username,
-                        'dst': self.dst
+                        'dst': self.dst,
+                        'params': req_params
                     })
-                    session_id = self.handshake(first_channel, conn_info)
+                    session_id, params = self.handshake(first_channel,
+                                                        conn_info)
                     porter = Sender(session_id, local_user, self.srcs,
-                                    self.n_channel, self.include, self.exclude)
+                                    self.n_channel, self.include, self.exclude,
+                                    params, self.n_hashers)
 
                 porter.conn_pool.add(first_channel)
+                porter.conn_pool.on_drop = partial(self.replace_channel,
+                                                   porter.conn_pool,
+                                                   session_id, pkey, password)
                 porter.start()
 
                 # create attached connections
                 t = Thread(target=self.attached_connect,
                            args=(porter.conn_pool, session_id, pkey, password))
                 t.start()
+                if self.auto_scale:
+                    add_tunnel = partial(self.attach_tunnel, porter.conn_pool,
+                                         session_id, pkey, password)
+                    AutoScaler(self, porter, add_tunnel).start()
 
                 porter.join()
             except Exception as e:
@@ -389,6 +559,10 @@ def handle_sigint(signum, frame):
 signal.signal(signal.SIGINT, handle_sigint)
 
 
+def num_or_auto(value: str):
+    return value if value == 'auto' else int(value)
+
+
 def main():
     parser = ArgumentParser(
         prog='fcp',
@@ -408,8 +582,71 @@ def main():
     parser.add_argument('-F', dest='ssh_config', type=str, default=None,
                         help='The config file for SSH (default: ~/.ssh/config)')
 
-    parser.add_argument('-n', dest='num', type=int, default=8,
-                        help='Max number of SSH tunnels (default: %(default)s)')
+    parser.add_argument('-n', dest='num', type=num_or_auto, default=8,
+                        help=('Max number of SSH tunnels, or `auto` to scale '
+                              'with the measured throughput '
+                              '(default: %(default)s)'))
+
+    parser.add_argument('-c', '--checksum', action='store_true',
+                        help=('Skip files based on checksum, not mod-time '
+                              '& size (default: disable)'))
+
+    parser.add_argument('--chunk-size', type=int, metavar='KB',
+                        default=DEFAULT_CHUNK_SIZE // 1024,
+                        help=('Size of data chunk in KB, negotiated with '
+                              'the server (default: %(default)s)'))
+
+    parser.add_argument('--packet-check', type=str, metavar='MODE',
+                        default='none', choices=list(CHKSUM_FUNCS),
+                        help=('Per-packet checksum, the MAC of SSH already '
+                              'ensures integrity. Choices: '
+                              f'{" | ".join(CHKSUM_FUNCS)} '
+                              '(default: %(default)s)'))
+
+    parser.add_argument('--bundle-size', type=int, metavar='KB',
+                        default=BUNDLE_FILE_SIZE // 1024,
+                        help=('Send changed files up to this size in KB in '
+                              'bundles requested by the receiver, 0 to '
+                              'disable (default: %(default)s)'))
+
+    parser.add_argument('--compress', type=str, metavar='CODEC',
+                        default=DEFAULT_CODEC, choices=list(CODECS),
+                        help=('Compress data chunks that are worth it, '
+                              'negotiated with the server. `none` together '
+                              'with -c lets fcpd send pulled chunks with '
+                              'sendfile. Choices: '
+                              f'{" | ".join(CODECS)} '
+                              '(default: %(default)s)'))
+
+    parser.add_argument('--compress-level', type=int, metavar='LEVEL',
+                        default=0,
+                        help=('Compression level (zlib 1-9, zstd 1-22, '
+                              'lz4 0-16), 0 for the default level of the '
+                              'codec (default: %(default)s)'))
+
+    parser.add_argument('-C', dest='ssh_compression', action='store_true',
+                        help=('Enable SSH compression, which compresses all '
+                              'data including incompressible files '
+                              '(default: disable)'))
+
+    parser.add_argument('-W', '--whole-file', action='store_true',
+                        help=('Always send whole files instead of only the '
+                              'changed chunks (default: disable)'))
+
+    parser.add_argument('-w', dest='hash_workers', type=int,
+                        default=HASH_WORKERS,
+                        help=('Number of threads to hash files when sending '
+                              '(default: %(default)s)'))
+
+    parser.add_argument('--no-hash-cache', dest='hash_cache',
+                        action='store_false',
+                        help=('Do not cache file hashes in '
+                              '~/.cache/fastcopy (default: enable)'))
+
+    parser.add_argument('--mmap', action='store_true',
+                        help=('Read and write local files through mmap, '
+                              'files must not be truncated during the '
+                              'transfer (default: disable)'))
 
     parser.add_argument('-v', dest='verbose', action='count', default=0,
                         help='Verbose mode (default: disable)')
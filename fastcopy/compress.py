@@ -0,0 +1,149 @@
+import zlib
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple, Union
+
+from .config import COMPRESS_SAMPLE_SIZE, COMPRESS_MIN_RATIO, COMPRESS_MAX_SKIP
+
+try:
+    import zstandard  # 可选依赖, 压缩率与速度均优于 zlib
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame  # 可选依赖, 压缩率较低但速度极快
+except ImportError:
+    lz4 = None
+
+Buffer = Union[bytes, bytearray, memoryview]
+Compress = Callable[[Buffer, int], bytes]
+Decompress = Callable[[Buffer], bytes]
+
+
+def _zstd_compress(data: Buffer, level: int) -> bytes:
+    # ZstdCompressor 不是线程安全的, 每次新建
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zstd_decompress(data: Buffer) -> bytes:
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def _lz4_compress(data: Buffer, level: int) -> bytes:
+    return lz4.frame.compress(data, compression_level=level)
+
+
+# 数据块的压缩方式: (压缩函数, 解压函数, 默认压缩级别)
+CODECS: Dict[str, Optional[Tuple[Compress, Decompress, int]]] = {
+    'none': None,
+    'zlib': (zlib.compress, zlib.decompress, 1),
+}
+if zstandard is not None:
+    CODECS['zstd'] = (_zstd_compress, _zstd_decompress, 3)
+if lz4 is not None:
+    CODECS['lz4'] = (_lz4_compress, lz4.frame.decompress, 0)
+
+DEFAULT_CODEC = 'zstd' if 'zstd' in CODECS else 'zlib'
+
+# 各压缩方式支持的压缩级别范围: (最低级别, 最高级别)
+LEVELS: Dict[str, Tuple[int, int]] = {
+    'zlib': (1, 9),
+    'zstd': (1, 22),
+    'lz4': (0, 16),
+}
+
+
+def clamp_level(codec: str, level: int) -> int:
+    '''将压缩级别限制在该压缩方式支持的范围内, 0 仍表示默认级别'''
+    if level == 0 or codec not in LEVELS:
+        return 0
+    low, high = LEVELS[codec]
+    return max(low, min(level, high))
+
+
+# 本身已经压缩过的文件格式, 不再尝试压缩
+COMPRESSED_SUFFIXES = {
+    '.7z', '.br', '.bz2', '.gz', '.lz4', '.lzma', '.rar', '.tgz', '.xz',
+    '.zip', '.zst', '.jar', '.whl', '.apk', '.deb', '.rpm', '.dmg',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp3', '.aac', '.ogg', '.flac', '.opus', '.m4a',
+    '.mp4', '.mkv', '.mov', '.avi', '.webm', '.m4v',
+}
+
+
+class ChunkCompressor:
+    '''单个文件的自适应压缩
+
+    压缩数据块前先试压开头的一小段样本，压缩率达标才压缩整个数据块，压缩后仍不达标则原样发送。
+    连续失败时按指数退避跳过后续的数据块。
+    由多个读取线程共用, 计数偶有不准也无妨
+    '''
+    __slots__ = ('func', 'level', 'skip', 'backoff')
+
+    def __init__(self, codec: str, level: int = 0):
+        self.func, _, default_level = CODECS[codec]
+        self.level = level or default_level
+        self.skip = 0  # 接下来不再尝试压缩的数据块数
+        self.backoff = 0
+
+    @classmethod
+    def for_file(cls, codec: str, level: int,
+                 path: Path) -> Optional['ChunkCompressor']:
+        '''未启用压缩或文件本身已经压缩过时返回 None'''
+        if CODECS.get(codec) is None:
+            return None
+        elif path.suffix.lower() in COMPRESSED_SUFFIXES:
+            return None
+        else:
+            return cls(codec, level)
+
+    @staticmethod
+    def pays_off(n_raw: int, n_compressed: int) -> bool:
+        return n_compressed <= n_raw * COMPRESS_MIN_RATIO
+
+    def compress(self, chunk: Buffer) -> Optional[bytes]:
+        '''返回压缩后的数据, 不值得压缩时返回 None'''
+        if self.skip > 0:
+            self.skip -= 1
+            return None
+
+        sample = chunk[:COMPRESS_SAMPLE_SIZE]
+        if (len(chunk) > len(sample)
+                and not self.pays_off(len(sample),
+                                      len(self.func(sample, self.level)))):
+            self.fail()
+            return None
+
+        data = self.func(chunk, self.level)
+        if not self.pays_off(len(chunk), len(data)):
+            self.fail()
+            return None
+
+        self.backoff = 0
+        return data
+
+    def fail(self):
+        self.backoff = min(max(1, self.backoff * 2), COMPRESS_MAX_SKIP)
+        self.skip = self.backoff
+
+
+class Compressed:
+    '''收到的压缩数据块, 由写入线程解压'''
+    __slots__ = ('data', 'length', 'func')
+
+    def __init__(self, data: Buffer, length: int, codec: str):
+        self.data = data
+        self.length = length  # 解压后的长度
+        self.func = CODECS[codec][1]
+
+    def __len__(self) -> int:
+        return self.length
+
+    def decompress(self) -> bytes:
+        try:
+            raw = self.func(self.data)
+        except Exception as e:
+            raise ValueError(f'failed to decompress chunk: {e}') from e
+        if len(raw) != self.length:
+            raise ValueError(f'decompressed chunk has {len(raw)} bytes, '
+                             f'expected {self.length}')
+        return raw
@@ -1,5 +1,47 @@
 SERVER_ADDR = ('127.0.0.1', 7523)
-CHUNK_SIZE = 1024 * 4  # 默认数据块大小 (单位: 字节)
+PROTOCOL = 2  # 当前协议版本
+CHUNK_SIZE = 1024 * 4  # 旧版协议的数据块大小 (单位: 字节)
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # 新版协议默认申请的数据块大小
+MAX_CHUNK_SIZE = 1024 * 1024 * 8  # 允许协商的最大数据块
 SSH_MUX = 2
+SCALE_MAX_TUNNELS = 16  # 自动模式下的最大隧道数
+SCALE_INTERVAL = 2  # 自动模式下统计吞吐量的间隔 (秒)
+SCALE_MIN_GAIN = 0.1  # 吞吐量至少提升该比例才继续增加隧道
+SCALE_IDLE_SHARE = 0.1  # 流量低于平均值的该比例的连接视为闲置
+HASH_WORKERS = 4  # 发送端计算文件校验和的默认线程数
+WRITE_WORKERS = 4  # 接收端写入文件的线程数
+WRITE_QUEUE_SIZE = 64  # 等待写入的数据块数量上限, 写满后暂停接收
+SEND_QUEUE_SIZE = 4  # 每个连接待发送的报文数量上限, 全部写满后阻塞发送方
+SEND_SAMPLE_INTERVAL = 0.5  # 统计各连接发送速率的间隔 (秒)
+RECV_QUEUE_SIZE = 64  # 等待处理的报文数量上限, 写满后暂停从连接中读取
+CREDIT_WINDOW = 1024 * 1024 * 64  # 允许对端在途 (已发出但本端尚未处理完) 的字节数
+ACK_INTERVAL = 16  # 每收到该数量的报文 (或约一个数据块大小的数据), 在同一连接上向对端确认一次
+RUN_MAX_BYTES = 1024 * 1024 * 8  # 合并写入时单个连续区段的大小上限
+COALESCE_MAX_BYTES = 1024 * 1024 * 32  # 等待合并写入的数据总量上限
+POLL_INTERVAL = 0.01  # 接收端等待报文时检查已写完文件的间隔 (秒)
+READ_WORKERS = 4  # 发送端并行读取文件的线程数
+STRIPE_CHUNKS = 8  # 并行读取时每个线程一次读取的数据块数
+READ_AHEAD_SIZE = 1024 * 1024 * 8  # 并行读取同一文件时, 各组领先最早未发出的数据块的字节数上限
+HASH_BUF_SIZE = 1024 * 1024  # 计算校验和时每次读取的长度
+WINDOW_MIN_BYTES = 1024 * 1024 * 16  # 接收窗口的在途字节数下限
+WINDOW_MAX_BYTES = 1024 * 1024 * 256  # 接收窗口的在途字节数上限
+WINDOW_MIN_FILES = 8  # 接收窗口的在途文件数下限
+WINDOW_MAX_FILES = 256  # 接收窗口的在途文件数上限 (每个在途文件占用一个文件句柄)
+BUNDLE_FILE_SIZE = 1024 * 64  # 不超过此大小的文件打包发送, 无需等待 FILE_READY
+COMPRESS_SAMPLE_SIZE = 1024 * 16  # 压缩整个数据块前先试压的样本大小
+COMPRESS_MIN_RATIO = 0.9  # 压缩后不超过原大小的该比例才值得压缩
+COMPRESS_MAX_SKIP = 64  # 连续压缩失败时最多跳过的数据块数
+DELTA_MIN_SIZE = 1024 * 1024 * 16  # 已存在的文件超过此大小时只传输有变化的数据块
+SIG_ANCHOR_SIZE = 32  # 数据块签名附带的块首字节数, 用于查找前后移动过的旧数据块
+SHIFT_SEARCH_BLOCKS = 8  # 查找移动过的数据时, 在前后各多少个旧数据块中查找
+SHIFT_MAX_MISSES = 32  # 连续查找失败该次数后, 该文件不再查找移动过的数据
+RESUME_MIN_SIZE = 1024 * 1024 * 64  # 超过此大小的文件在接收时记录断点续传日志
+REPAIR_RETRIES = 2  # 文件校验失败后重传差异数据块的次数上限
+JOURNAL_FLUSH_INTERVAL = 1  # 断点续传日志写入磁盘的间隔 (秒)
+HASH_PENDING_SIZE = 1024 * 1024 * 32  # 接收端暂存乱序数据块的上限 (每个文件)
+HASH_CACHE_PATH = '~/.cache/fastcopy/hashes.db'  # 文件校验和缓存
+HASH_CACHE_SIZE = 1000 * 1000  # 校验和缓存的最大记录数
 TIMEOUT = 60 * 5  # 全局超时时间
-LEN_HEAD = 7
+CLOSE_TIMEOUT = 5  # 会话结束时等待对端关闭连接的时间 (秒)
+LEN_HEAD = 7  # 旧版报文头长度
+LEN_HEAD_V2 = 9  # 新版报文头长度
@@ -0,0 +1,179 @@
+import logging
+import os
+from pathlib import Path
+from struct import calcsize, pack
+from threading import Lock
+from time import monotonic
+from typing import List, Optional, Tuple
+
+from .config import JOURNAL_FLUSH_INTERVAL
+
+MAGIC = b'FCPJ'
+HEAD_FMT = '>4sIQd16s'  # magic | chunk_size | size | mtime | chksum
+LEN_HEAD = calcsize(HEAD_FMT)
+
+
+class ChunkJournal:
+    '''断点续传日志
+
+    与正在接收的文件放在同一目录，以位图记录已写入的数据块。
+    文件头记录源文件的大小、修改时间与校验和，源文件变化后日志自动失效。
+    位图中的标记只会由 0 变为 1，写入中途被打断也不会误标未写入的数据块。
+    位图写入磁盘前先将文件数据落盘, 断电后也不会标记实际未写入磁盘的数据块。
+    '''
+
+    def __init__(self, path: Path, head: bytes, n_chunks: int,
+                 bitmap: Optional[bytearray] = None):
+        self.path = path
+        self.head = head
+        self.n_chunks = n_chunks
+        self.is_loaded = bitmap is not None  # 是否是上次中断时留下的日志
+        self.bitmap = bitmap or bytearray((n_chunks + 7) // 8)
+        self.fp = None
+        self.dirty = False
+        self.flushed_at = monotonic()
+        self.flush_lock = Lock()
+        self.closed = False  # 已关闭或删除, 此后不再写入 (由 flush_lock 保护)
+
+    @staticmethod
+    def path_of(filepath: Path) -> Path:
+        '''日志文件路径: 同目录下的隐藏文件'''
+        return filepath.with_name(f'.{filepath.name}.fcpj')
+
+    @staticmethod
+    def pack_head(chunk_size: int, size: int, mtime: float,
+                  chksum: bytes) -> bytes:
+        return pack(HEAD_FMT, MAGIC, chunk_size, size, mtime, chksum)
+
+    @classmethod
+    def create(cls, filepath: Path, chunk_size: int, size: int,
+               mtime: float, chksum: bytes) -> 'ChunkJournal':
+        head = cls.pack_head(chunk_size, size, mtime, chksum)
+        n_chunks = (size + chunk_size - 1) // chunk_size
+        return cls(cls.path_of(filepath), head, n_chunks)
+
+    @classmethod
+    def load(cls, filepath: Path, chunk_size: int, size: int,
+             mtime: float, chksum: bytes) -> Optional['ChunkJournal']:
+        '''读取上次中断时留下的日志, 与当前要接收的文件不符时删除并返回 None'''
+        path = cls.path_of(filepath)
+        try:
+            with open(path, 'rb') as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logging.warning(f'[Journal] Failed to read {path}: {e}')
+            return None
+
+        head = cls.pack_head(chunk_size, size, mtime, chksum)
+        n_chunks = (size + chunk_size - 1) // chunk_size
+        n_bytes = (n_chunks + 7) // 8
+        try:
+            is_matched = (data[:LEN_HEAD] == head
+                          and len(data) == LEN_HEAD + n_bytes
+                          and filepath.stat().st_size == size)
+        except OSError:
+            is_matched = False
+
+        if is_matched:
+            return cls(path, head, n_chunks, bytearray(data[LEN_HEAD:]))
+        else:
+            logging.debug(f'[Journal] Discard outdated journal: {path}')
+            cls.discard(filepath)
+            return None
+
+    @classmethod
+    def discard(cls, filepath: Path):
+        '''删除文件对应的日志'''
+        try:
+            os.unlink(cls.path_of(filepath))
+        except FileNotFoundError:
+            pass
+
+    def has(self, seq: int) -> bool:
+        return (seq < self.n_chunks
+                and bool(self.bitmap[seq >> 3] & (1 << (seq & 7))))
+
+    def mark(self, seq: int):
+        '''标记数据块已写入, 由写入方在 is_due() 时调用 flush() 写入磁盘'''
+        self.bitmap[seq >> 3] |= 1 << (seq & 7)
+        self.dirty = True
+
+    def is_due(self) -> bool:
+        '''距上次写入磁盘已超过间隔'''
+        return (self.dirty
+                and monotonic() - self.flushed_at >= JOURNAL_FLUSH_INTERVAL)
+
+    def unmark(self, seq: int):
+        self.bitmap[seq >> 3] &= ~(1 << (seq & 7)) & 0xff
+        self.dirty = True
+
+    def missing(self) -> List[Tuple[int, int]]:
+        '''尚未写入的数据块区间 (start, count)'''
+        ranges: List[Tuple[int, int]] = []
+        for seq in range(self.n_chunks):
+            if not self.has(seq):
+                if ranges and sum(ranges[-1]) == seq:
+                    ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+                else:
+                    ranges.append((seq, 1))
+        return ranges
+
+    def flush(self, data_fd: int, wait: bool = True):
+        '''先将文件数据落盘, 再写入此前已标记的位图
+
+        wait 为 False 时, 若其他线程正在写入则直接返回
+        '''
+        if not self.flush_lock.acquire(blocking=wait):
+            return
+        try:
+            # 其他线程可能已在等锁期间关闭或删除日志, data_fd 也可能已关闭
+            if not self.closed:
+                self.write(data_fd)
+        finally:
+            self.flush_lock.release()
+
+    def write(self, data_fd: int):
+        '''flush 的实现 (调用时须持有 self.flush_lock)'''
+        try:
+            self.dirty = False
+            self.flushed_at = monotonic()
+            bitmap = bytes(self.bitmap)  # 只保存落盘前已写入的数据块的标记
+            os.fdatasync(data_fd)
+            if self.fp is None:
+                # 续传时原地更新位图, 避免截断后中断导致日志失效
+                if self.is_loaded:
+                    self.fp = open(self.path, 'r+b')
+                else:
+                    self.fp = open(self.path, 'wb')
+                    self.fp.write(self.head)
+            self.fp.seek(LEN_HEAD)
+            self.fp.write(bitmap)
+            self.fp.flush()
+        except OSError as e:
+            logging.warning(f'[Journal] Failed to write {self.path}: {e}')
+
+    def close(self, data_fd: int):
+        '''传输中断时保存日志 (data_fd 为正在接收的文件, 须在其关闭前调用)'''
+        with self.flush_lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.dirty:
+                self.write(data_fd)
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+
+    def remove(self):
+        '''文件接收完成后删除日志 (须在关闭文件前调用)'''
+        with self.flush_lock:
+            self.closed = True
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
@@ -1,18 +1,60 @@
+import asyncio
 import logging
+import os
+from collections import deque
 from binascii import crc32
 from enum import IntEnum
 from paramiko import Channel
-from queue import Empty, Queue
-from selectors import SelectSelector, EVENT_WRITE
+from queue import Empty, Full, LifoQueue, Queue
 from socket import socket, error as SocketError
-from struct import pack, unpack
-from threading import Event, Thread
-from time import sleep
-from typing import Any, NamedTuple, Set, Tuple, Union
+from struct import iter_unpack, pack, unpack, unpack_from
+from threading import Condition, Event, Lock, Thread
+from time import monotonic
+from typing import (Any, BinaryIO, Callable, Deque, Dict, List, Optional, Set,
+                    Tuple, Union)
 
-from .config import TIMEOUT, LEN_HEAD
+from .compress import CODECS, DEFAULT_CODEC, clamp_level
+from .window import Window
+from .config import (TIMEOUT, CLOSE_TIMEOUT, PROTOCOL, CHUNK_SIZE,
+                     DEFAULT_CHUNK_SIZE,
+                     MAX_CHUNK_SIZE, BUNDLE_FILE_SIZE, RECV_QUEUE_SIZE,
+                     SEND_QUEUE_SIZE, SEND_SAMPLE_INTERVAL, CREDIT_WINDOW,
+                     ACK_INTERVAL, SIG_ANCHOR_SIZE, LEN_HEAD, LEN_HEAD_V2)
+
+try:
+    from crc32c import crc32c  # 可选依赖，支持 SSE4.2 / ARMv8 硬件加速
+except ImportError:
+    crc32c = None
 
 Connection = Union[socket, Channel]
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+class FileRegion:
+    '''文件中的一段数据
+
+    作为数据块报文的 data 时不读入内存, 发送时由 os.sendfile 直接从文件拷贝到 socket
+    '''
+    __slots__ = ('fp', 'offset', 'length')
+
+    def __init__(self, fp: BinaryIO, offset: int, length: int):
+        self.fp = fp  # 所有报文发出后, 文件随最后一个引用释放而关闭
+        self.offset = offset
+        self.length = length
+
+    def __len__(self) -> int:
+        return self.length
+
+    def read(self) -> bytes:
+        '''读出数据, 文件变短时补零以保持报文长度不变'''
+        data = os.pread(self.fp.fileno(), self.length, self.offset)
+        return data.ljust(self.length, b'\0')
+
+
+# 报文校验方式, none 表示由传输层 (如 SSH 的 MAC) 保证完整性
+CHKSUM_FUNCS = {'none': None, 'crc32': crc32}
+if crc32c is not None:
+    CHKSUM_FUNCS['crc32c'] = crc32c
 
 
 class Flag(IntEnum):
@@ -28,28 +70,213 @@ class Flag(IntEnum):
     FILE_CHUNK = 10  # 数据传输
     DONE = 11        # 完成
     EXCEPTION = 12   # 异常退出
+    FILE_HASH = 13   # 文件校验和
+    FILE_SIGS = 14   # 数据块签名
+    FILE_KEEP = 15   # 保留数据块
+    BUNDLE = 16      # 小文件打包
+    FILE_HOLES = 17  # 空洞数据块
+    FILE_ZCHUNK = 18  # 压缩数据块
+    DETACH = 19      # 连接下线
+    CREDIT = 20      # 发送额度
+    ACK = 21         # 确认收到
+    LOST = 22        # 连接断开
+    FILE_COPY = 23   # 移动的数据块
+    FILE_FAILED = 24  # 文件发送失败
+    FILE_WANT = 25   # 索取小文件
 
     @classmethod
     def contains(cls, member: object) -> bool:
         return member in cls.__members__.values()
 
 
-class Packet(NamedTuple):
-    flag: Flag
-    body: bytes
+class SessionParams:
+    '''会话参数
+
+    客户端在 PUSH / PULL 申请中提出期望的参数，服务器确认后随 SID 一起回传。
+    旧版对端不认识这些字段，双方会自动回落到 v1 协议。
+    '''
+    __slots__ = ('protocol', 'chunk_size', 'chksum_mode', 'compare', 'delta',
+                 'bundle_size', 'codec', 'level', 'credit', 'resend')
+
+    def __init__(self, protocol: int = 1, chunk_size: int = CHUNK_SIZE,
+                 chksum_mode: str = 'crc32', compare: str = 'checksum',
+                 delta: bool = False, bundle_size: int = 0,
+                 codec: str = 'none', level: int = 0, credit: int = 0,
+                 resend: bool = False):
+        self.protocol = protocol
+        self.chunk_size = chunk_size
+        self.chksum_mode = chksum_mode
+        self.compare = compare  # 判断文件是否相同的方式: quick | checksum
+        self.delta = delta  # 已存在的文件是否只传输有变化的数据块
+        self.bundle_size = bundle_size  # 打包发送的小文件的大小上限, 0 为不打包
+        self.codec = codec  # 数据块的压缩方式, none 为不压缩
+        self.level = level  # 压缩级别, 0 为该压缩方式的默认级别
+        self.credit = credit  # 双方各自允许对端在途的字节数, 0 为不做流量控制
+        self.resend = resend  # 连接断开时是否重发对端未确认收到的数据块
 
     def __str__(self) -> str:
+        return (f'SessionParams(protocol={self.protocol}, '
+                f'chunk_size={self.chunk_size}, '
+                f'chksum_mode={self.chksum_mode}, '
+                f'compare={self.compare}, '
+                f'delta={self.delta}, '
+                f'bundle_size={self.bundle_size}, '
+                f'codec={self.codec}, '
+                f'level={self.level}, '
+                f'credit={self.credit}, '
+                f'resend={self.resend})')
+
+    @property
+    def head_fmt(self) -> str:
+        '''报文头格式: v1 的长度字段为 2 字节, v2 为 4 字节'''
+        return '>BIH' if self.protocol < 2 else '>BII'
+
+    @property
+    def len_head(self) -> int:
+        return LEN_HEAD if self.protocol < 2 else LEN_HEAD_V2
+
+    @property
+    def quick_check(self) -> bool:
+        '''是否仅通过大小和修改时间判断文件是否相同'''
+        return self.compare == 'quick'
+
+    def checksum(self, *buffers: Buffer) -> int:
+        '''按会话的校验方式计算校验和'''
+        func = CHKSUM_FUNCS[self.chksum_mode]
+        value = 0
+        if func is not None:
+            for buf in buffers:
+                value = func(buf, value)
+        return value
+
+    def to_dict(self) -> dict:
+        return {'protocol': self.protocol,
+                'chunk_size': self.chunk_size,
+                'chksum': self.chksum_mode,
+                'compare': self.compare,
+                'delta': self.delta,
+                'bundle': self.bundle_size,
+                'compress': self.codec,
+                'level': self.level,
+                'credit': self.credit,
+                'resend': self.resend}
+
+    @classmethod
+    def from_dict(cls, params: dict) -> 'SessionParams':
+        '''解析对端回传的参数'''
+        protocol = int(params.get('protocol', 1))
+        if protocol < 2:
+            return cls()
+        else:
+            return cls(protocol,
+                       int(params['chunk_size']),
+                       params.get('chksum', 'crc32'),
+                       params.get('compare', 'checksum'),
+                       bool(params.get('delta', False)),
+                       int(params.get('bundle', 0)),
+                       params.get('compress', 'none'),
+                       int(params.get('level', 0)),
+                       int(params.get('credit', 0)),
+                       bool(params.get('resend', False)))
+
+    @classmethod
+    def request(cls, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                chksum_mode: str = 'crc32', compare: str = 'quick',
+                delta: bool = True,
+                bundle_size: int = BUNDLE_FILE_SIZE,
+                codec: str = DEFAULT_CODEC, level: int = 0,
+                credit: int = CREDIT_WINDOW, resend: bool = True) -> dict:
+        '''客户端期望的会话参数
+
+        校验方式与压缩方式按优先级列出，服务器从中选择自己支持的第一个
+        '''
+        return {'protocol': PROTOCOL,
+                'chunk_size': chunk_size,
+                'chksum': [chksum_mode, 'crc32'],
+                'compare': compare,
+                'delta': delta,
+                'bundle': bundle_size,
+                'compress': [codec, 'zlib'] if codec != 'none' else ['none'],
+                'level': level,
+                'credit': credit,
+                'resend': resend}
+
+    @classmethod
+    def negotiate(cls, requested: dict) -> 'SessionParams':
+        '''服务器根据客户端的申请确定最终参数'''
+        protocol = min(int(requested.get('protocol', 1)), PROTOCOL)
+        if protocol < 2:
+            return cls()
+
+        chunk_size = int(requested.get('chunk_size', DEFAULT_CHUNK_SIZE))
+        chunk_size = max(CHUNK_SIZE, min(chunk_size, MAX_CHUNK_SIZE))
+
+        for chksum_mode in requested.get('chksum', []):
+            if chksum_mode in CHKSUM_FUNCS:
+                break
+        else:
+            chksum_mode = 'crc32'
+
+        compare = requested.get('compare', 'checksum')
+        if compare not in ('quick', 'checksum'):
+            compare = 'checksum'
+
+        delta = bool(requested.get('delta', False))
+
+        bundle_size = int(requested.get('bundle', 0))
+        bundle_size = max(0, min(bundle_size, chunk_size))
+
+        for codec in requested.get('compress', []):
+            if codec in CODECS:
+                break
+        else:
+            codec = 'none'
+        # 申请的级别针对客户端首选的压缩方式, 回退到其他方式时可能超出范围
+        level = clamp_level(codec, int(requested.get('level', 0)))
+
+        # 旧版客户端不申请额度, 不做流量控制; 额度至少能容纳数个数据块报文
+        credit = int(requested.get('credit', 0))
+        if credit > 0:
+            credit = max(4 * (chunk_size + 1024), min(credit, CREDIT_WINDOW))
+
+        resend = bool(requested.get('resend', False))
+
+        return cls(protocol, chunk_size, chksum_mode, compare, delta,
+                   bundle_size, codec, level, credit, resend)
+
+
+LEGACY = SessionParams()  # 握手阶段统一使用 v1 协议
+
+
+class Packet:
+    '''数据报文'''
+    __slots__ = ('flag', 'body', 'data', 'chksum')
+
+    def __init__(self, flag: Flag, body: Buffer, data: Buffer = b'',
+                 chksum: Optional[int] = None):
+        self.flag = flag
+        self.body = body
+        self.data = data  # 紧随 body 之后的数据, 发送时不与 body 拼接
+        self.chksum = chksum  # 封包或收包时计算一次后缓存
+
+    def __str__(self) -> str:
+        chksum = '-' * 8 if self.chksum is None else f'{self.chksum:08x}'
         return (f'Packet: {self.flag.name} '
                 f'len={self.length} '
-                f'chk={self.chksum:08x}')
+                f'chk={chksum}')
 
     @property
     def length(self) -> int:
-        return len(self.body)
+        return len(self.body) + len(self.data)
 
-    @property
-    def chksum(self) -> int:
-        return crc32(self.body)
+    def checksum(self, params: SessionParams = LEGACY) -> int:
+        '''计算并缓存校验和'''
+        if self.chksum is None:
+            data = self.data
+            if isinstance(data, FileRegion) and params.chksum_mode != 'none':
+                data = data.read()
+            self.chksum = params.checksum(self.body, data)
+        return self.chksum
 
     @staticmethod
     def load(flag: Flag, *args) -> 'Packet':
@@ -59,8 +286,13 @@ class Packet(NamedTuple):
                 body = args[0]
             else:
                 body = str(args[0]).encode('utf8')
-        elif flag == Flag.SID or flag == Flag.ATTACH:
-            body = pack('>16s', *args)
+        elif flag == Flag.SID:
+            # session_id 之后附带协商好的会话参数 (旧版客户端为空)
+            length = len(args[-1])
+            body = pack(f'>16s{length}s', *args)
+        elif flag == Flag.ATTACH:
+            # 协商了重发时附带客户端为连接分配的编号
+            body = pack('>16sI' if len(args) > 1 else '>16s', *args)
         elif flag == Flag.MONOFILE:
             body = pack('>?', *args)
         elif flag == Flag.DIR_INFO:
@@ -69,14 +301,50 @@ class Packet(NamedTuple):
         elif flag == Flag.FILE_INFO:
             length = len(args[-1])
             body = pack(f'>IHQd16s{length}s', *args)
-        elif flag == Flag.FILE_COUNT:
+        elif flag in (Flag.FILE_COUNT, Flag.CREDIT, Flag.ACK):
             body = pack('>I', *args)
         elif flag == Flag.FILE_READY:
-            body = pack('>I', *args)
-        elif flag == Flag.FILE_CHUNK:
-            length = len(args[-1])
-            body = pack(f'>2I{length}s', *args)
-        elif flag == Flag.DONE:
+            # 断点续传时附带接收端缺失的数据块区间
+            body = pack('>I', args[0])
+            if len(args) > 1:
+                ranges = b''.join(pack('>2I', *rng) for rng in args[1])
+                body += pack('>I', len(args[1])) + ranges
+        elif flag == Flag.FILE_HASH:
+            body = pack('>I16s', *args)
+        elif flag == Flag.LOST or flag == Flag.FILE_FAILED:
+            body = pack('>2I', *args)
+        elif flag == Flag.FILE_SIGS:
+            # args: file_id, [(weak, strong, anchor), ...]
+            fmt = f'>I16s{SIG_ANCHOR_SIZE}s'
+            sigs = b''.join(pack(fmt, *sig) for sig in args[1])
+            body = pack('>I', args[0]) + sigs
+        elif flag == Flag.FILE_KEEP or flag == Flag.FILE_HOLES:
+            # args: file_id, [(start, count), ...]
+            ranges = b''.join(pack('>2I', *rng) for rng in args[1])
+            body = pack('>I', args[0]) + ranges
+        elif flag == Flag.FILE_COPY:
+            # args: file_id, [(seq, offset), ...]
+            copies = b''.join(pack('>IQ', *copy) for copy in args[1])
+            body = pack('>I', args[0]) + copies
+        elif flag == Flag.FILE_WANT:
+            # args: [file_id, ...]
+            body = b''.join(pack('>I', f_id) for f_id in args[0])
+        elif flag == Flag.BUNDLE:
+            # args: [(file_id, perm, size, mtime, chksum, path, data), ...]
+            entries = []
+            for *info, path, data in args[0]:
+                entries.append(pack('>IHQd16sH', *info, len(path)))
+                entries.append(path)
+                entries.append(data)
+            body = b''.join(entries)
+        elif flag == Flag.FILE_CHUNK or flag == Flag.FILE_ZCHUNK:
+            # 数据块不拷贝进 body, 发送时由 sendmsg 直接引用, 或由 sendfile 从文件发送
+            body = pack('>2I', *args[:2])
+            data = args[2]
+            if not isinstance(data, FileRegion):
+                data = memoryview(data)
+            return Packet(flag, body, data)
+        elif flag == Flag.DONE or flag == Flag.DETACH:
             body = pack('>?', True)
         elif flag == Flag.EXCEPTION:
             body = str(args[0]).encode('utf8')
@@ -84,15 +352,23 @@ class Packet(NamedTuple):
             raise ValueError(f'{flag} is not a valid Flag')
         return Packet(flag, body)
 
-    def pack(self) -> bytes:
+    def head(self, params: SessionParams = LEGACY) -> bytes:
+        '''封装报文头'''
+        chksum = self.checksum(params)
+        return pack(params.head_fmt, self.flag, chksum, self.length)
+
+    def pack(self, params: SessionParams = LEGACY) -> bytes:
         '''封包'''
-        fmt = f'>BIH{self.length}s'
-        return pack(fmt, self.flag, self.chksum, self.length, self.body)
+        data = self.data
+        if isinstance(data, FileRegion):
+            data = data.read()
+        return b''.join((self.head(params), self.body, data))
 
     @staticmethod
-    def unpack_head(head: bytes) -> Tuple[Flag, int, int]:
+    def unpack_head(head: bytes,
+                    params: SessionParams = LEGACY) -> Tuple[Flag, int, int]:
         '''解析 head'''
-        flag, chksum, length = unpack('>BIH', head)
+        flag, chksum, length = unpack(params.head_fmt, head)
         if not Flag.contains(flag):
             raise PacketError
         else:
@@ -103,8 +379,19 @@ class Packet(NamedTuple):
         if self.flag == Flag.PULL or self.flag == Flag.PUSH:
             return (self.body.decode('utf-8'),)  # connection info
 
-        elif self.flag == Flag.SID or self.flag == Flag.ATTACH:
-            return unpack('>16s', self.body)  # Worker ID
+        elif self.flag == Flag.SID:
+            # session_id | params
+            #    16B     |  ...
+            fmt = f'>16s{self.length - 16}s'
+            return unpack(fmt, self.body)
+
+        elif self.flag == Flag.ATTACH:
+            # session_id | conn_id (可选)
+            #    16B     |    4B
+            if self.length > 16:
+                return unpack('>16sI', self.body)
+            else:
+                return (*unpack('>16s', self.body), 0)
 
         elif self.flag == Flag.MONOFILE:
             return unpack('>?', self.body)  # is monofile
@@ -124,16 +411,83 @@ class Packet(NamedTuple):
         elif self.flag == Flag.FILE_COUNT:
             return unpack('>I', self.body)  # file count
 
+        elif self.flag == Flag.CREDIT:
+            return unpack('>I', self.body)  # 归还的字节数
+
+        elif self.flag == Flag.ACK:
+            return unpack('>I', self.body)  # 该连接上累计收到的报文数
+
+        elif self.flag == Flag.FILE_FAILED:
+            # file id, 发送端本轮为该文件发出的报文数
+            return unpack('>2I', self.body)
+
         elif self.flag == Flag.FILE_READY:
-            return unpack('>I', self.body)  # file id
+            # file_id | n_ranges | start | count | ...
+            #   4B    |    4B    |  4B   |  4B   | ...
+            # 仅有 file_id 时表示需要发送整个文件
+            f_id, = unpack_from('>I', self.body)
+            if self.length > 4:
+                return f_id, list(iter_unpack('>2I', self.body[8:]))
+            else:
+                return f_id, None
+
+        elif self.flag == Flag.FILE_HASH:
+            return unpack('>I16s', self.body)  # file id, chksum
+
+        elif self.flag == Flag.LOST:
+            return unpack('>2I', self.body)  # conn_id, 该连接上收到的报文数
+
+        elif self.flag == Flag.FILE_SIGS:
+            # file_id | weak | strong | anchor | weak | strong | anchor | ...
+            #   4B    |  4B  |  16B   |  32B   |  4B  |  16B   |  32B   | ...
+            f_id, = unpack_from('>I', self.body)
+            fmt = f'>I16s{SIG_ANCHOR_SIZE}s'
+            return f_id, list(iter_unpack(fmt, self.body[4:]))
+
+        elif self.flag == Flag.FILE_KEEP or self.flag == Flag.FILE_HOLES:
+            # file_id | start | count | start | count | ...
+            #   4B    |  4B   |  4B   |  4B   |  4B   | ...
+            f_id, = unpack_from('>I', self.body)
+            return f_id, list(iter_unpack('>2I', self.body[4:]))
+
+        elif self.flag == Flag.FILE_COPY:
+            # file_id | seq | offset | seq | offset | ...
+            #   4B    | 4B  |   8B   | 4B  |   8B   | ...
+            f_id, = unpack_from('>I', self.body)
+            return f_id, list(iter_unpack('>IQ', self.body[4:]))
+
+        elif self.flag == Flag.FILE_WANT:
+            # file_id | file_id | ...
+            #   4B    |   4B    | ...
+            return ([f_id for f_id, in iter_unpack('>I', self.body)],)
 
-        elif self.flag == Flag.FILE_CHUNK:
+        elif self.flag == Flag.BUNDLE:
+            # 每个文件依次为:
+            #   file_id | perm | size | mtime | chksum | path_len | path | data
+            #     4B    |  2B  |  8B  |  8B   |  16B   |    2B    | ...  | ...
+            entries = []
+            offset = 0
+            while offset < self.length:
+                *info, len_path = unpack_from('>IHQd16sH', self.body, offset)
+                offset += 40
+                path = bytes(self.body[offset:offset + len_path])
+                offset += len_path
+                data = self.body[offset:offset + info[2]]
+                offset += info[2]
+                entries.append((*info, path, data))
+            return (entries,)
+
+        elif self.flag == Flag.FILE_CHUNK or self.flag == Flag.FILE_ZCHUNK:
             # file_id |  seq  | chunk
             #    4B   |  4B   |  ...
-            fmt = f'>2I{self.length - 8}s'
-            return unpack(fmt, self.body)
+            # chunk 为指向接收缓冲区的 memoryview, 不做拷贝
+            if self.data:
+                return (*unpack('>2I', self.body), self.data)
+            else:
+                return (*unpack_from('>2I', self.body),
+                        memoryview(self.body)[8:])
 
-        elif self.flag == Flag.DONE:
+        elif self.flag == Flag.DONE or self.flag == Flag.DETACH:
             return unpack('>?', self.body)
 
         elif self.flag == Flag.EXCEPTION:
@@ -151,37 +505,119 @@ class PacketError(Exception):
     pass
 
 
-def send_pkt(conn: Connection, packet: Packet):
+def send_pkt(conn: Connection, packet: Packet,
+             params: SessionParams = LEGACY):
     '''发送数据报文'''
-    datagram = packet.pack()
-    conn.sendall(datagram)
+    if isinstance(packet.data, FileRegion):
+        # socket 连接由事件循环通过 sendfile 发送, 这里只会是 paramiko 的 Channel
+        head = packet.head(params) + packet.body
+        send_buffers(conn, [head, packet.data.read()])
+    elif packet.data:
+        head = packet.head(params) + packet.body
+        send_buffers(conn, [head, packet.data])
+    else:
+        datagram = packet.pack(params)
+        conn.sendall(datagram)
 
 
-def recv_all(conn: Connection, length: int) -> bytes:
-    '''接受完整数据'''
-    datagram = bytearray()
-    while length > 0:
-        _data = conn.recv(length)
-        n_recv = len(_data)
+def send_buffers(conn: Connection, buffers: List[Buffer]):
+    '''分散/聚集发送多段数据, 发送过程中不拼接数据'''
+    if isinstance(conn, socket):
+        views = [memoryview(buf) for buf in buffers]
+        while views:
+            n_sent = conn.sendmsg(views)
+            # 丢弃已发送完毕的缓冲区, 截掉部分发送的缓冲区
+            while views and n_sent >= len(views[0]):
+                n_sent -= len(views.pop(0))
+            if views:
+                views[0] = views[0][n_sent:]
+    else:
+        # paramiko 的 Channel 没有 sendmsg, 逐段发送 (memoryview 不会被拷贝)
+        for buf in buffers:
+            conn.sendall(buf)
+
+
+class BufferPool:
+    '''接收缓冲区池
+
+    缓冲区容量统一为一个完整数据块报文的大小，用完后归还以便复用，
+    超出容量的报文临时分配，不放回池中
+    '''
+
+    def __init__(self, block_size: int, max_bytes: int = 64 * 1024 * 1024):
+        self.block_size = block_size
+        self.free: LifoQueue = LifoQueue(max(4, max_bytes // block_size))
+
+    def get(self, size: int) -> memoryview:
+        '''取出一个至少能容纳 size 字节的缓冲区'''
+        if size <= self.block_size:
+            try:
+                buf = self.free.get_nowait()
+            except Empty:
+                buf = bytearray(self.block_size)
+        else:
+            buf = bytearray(size)
+        return memoryview(buf)[:size]
+
+    def put(self, view: memoryview):
+        '''归还缓冲区'''
+        buf = view.obj
+        if len(buf) == self.block_size:
+            try:
+                self.free.put_nowait(buf)
+            except Full:
+                pass
+
+
+def recv_into(conn: Connection, view: memoryview):
+    '''接收数据, 直接写满 view 所指向的缓冲区'''
+    offset, length = 0, len(view)
+    while offset < length:
+        if isinstance(conn, socket):
+            n_recv = conn.recv_into(view[offset:])
+        else:
+            # paramiko 的 Channel 没有 recv_into
+            _data = conn.recv(length - offset)
+            n_recv = len(_data)
+            view[offset:offset + n_recv] = _data
+
         if n_recv > 0:
-            length -= n_recv
-            datagram += _data
+            offset += n_recv
         else:
             raise ConnectionResetError
 
-    return bytes(datagram)
+
+def recv_all(conn: Connection, length: int) -> bytes:
+    '''接受完整数据'''
+    # 通常一次即可收完
+    datagram = conn.recv(length)
+    if len(datagram) == length:
+        return datagram
+    elif not datagram:
+        raise ConnectionResetError
+
+    buf = bytearray(length)
+    buf[:len(datagram)] = datagram
+    recv_into(conn, memoryview(buf)[len(datagram):])
+    return bytes(buf)
 
 
-def recv_pkt(conn: Connection) -> Packet:
+def recv_pkt(conn: Connection, params: SessionParams = LEGACY,
+             buffers: Optional[BufferPool] = None) -> Packet:
     '''接收数据报文'''
     # 接收并解析 head 部分
-    head = recv_all(conn, LEN_HEAD)
-    flag, chksum, len_body = Packet.unpack_head(head)
+    head = recv_all(conn, params.len_head)
+    flag, chksum, len_body = Packet.unpack_head(head, params)
 
-    # 接收 body 部分
-    body = recv_all(conn, len_body)
-    if crc32(body) == chksum:
-        return Packet(flag, body)
+    # 接收 body 部分, 数据块直接收进缓冲池中的缓冲区
+    if flag == Flag.FILE_CHUNK and buffers is not None:
+        body = buffers.get(len_body)
+        recv_into(conn, body)
+    else:
+        body = recv_all(conn, len_body)
+
+    if params.checksum(body) == chksum:
+        return Packet(flag, body, chksum=chksum)
     else:
         raise PacketError
 
@@ -189,31 +625,740 @@ def recv_pkt(conn: Connection) -> Packet:
 class Counter:
     def __init__(self):
         self.n_sent = 0
+        self.n_recv = 0
 
     def acc(self, length):
         self.n_sent += length
 
+    @property
+    def n_bytes(self) -> int:
+        return self.n_sent + self.n_recv
+
+
+class EventLoop(Thread):
+    '''进程内共享的事件循环
+
+    所有 socket 连接的收发都在这一个线程中完成 (Linux 上由 epoll 驱动),
+    不再为每个连接单独创建接收线程
+    '''
+    _instance: Optional['EventLoop'] = None
+    _lock = Lock()
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.loop = asyncio.new_event_loop()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    @classmethod
+    def get(cls) -> asyncio.AbstractEventLoop:
+        '''首次使用时启动'''
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                cls._instance.start()
+        return cls._instance.loop
+
+
+class PacketProtocol(asyncio.BufferedProtocol):
+    '''在事件循环中收发一个 socket 连接上的报文
+
+    报文头与包体直接收进预先分配的缓冲区, 数据块使用缓冲池中的缓冲区;
+    recv_q 写满时暂停读取该连接, 由 TCP 反压发送端
+    '''
+
+    def __init__(self, pool: 'ConnectionPool', conn: socket):
+        self.pool = pool
+        self.conn = conn
+        self.params = pool.params
+        self.transport: Optional[asyncio.Transport] = None
+        self.closed = False
+
+        self.head = memoryview(bytearray(self.params.len_head))
+        self.body: Optional[memoryview] = None  # 为 None 时正在接收报文头
+        self.offset = 0  # 报文头或包体中已收到的字节数
+        self.flag = Flag.DONE
+        self.chksum = 0
+        self.pending: Optional[Packet] = None  # recv_q 写满时暂存的报文
+        self.drain_waiter: Optional[asyncio.Future] = None
+        self.lost = Event()  # 连接已断开
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        # 写缓冲区超过一个数据块时暂停该连接的发送协程, 报文交由其他连接发送
+        transport.set_write_buffer_limits(high=self.params.chunk_size + 65536)
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.closed = True
+        if exc is not None:
+            logging.warning(f'[Recv] Conn-{id(self.conn):x}: {exc}.')
+        self.resume_writing()
+        self.pool.drop(self.conn)
+        self.pool.report(self.conn)
+        self.lost.set()
+
+    def close(self, abort=False):
+        self.closed = True
+        if self.transport is not None:
+            if abort:
+                self.transport.abort()  # 连接已断开, 丢弃写缓冲区
+            else:
+                self.transport.close()  # 写缓冲区中的数据发完后关闭
+
+    def shutdown(self):
+        '''会话结束: 发完写缓冲区后关闭写方向, 继续读取并丢弃报文, 直到对端关闭连接
+
+        直接关闭时若仍有未读的数据, 内核会发出 RST, 对端尚未读取的报文 (如 DONE) 随之丢失
+        '''
+        self.closed = True
+        if self.transport is None or self.transport.is_closing():
+            self.lost.set()
+            return
+        if self.pending is not None:
+            self.pending = None
+            self.pool.paused.remove(self)
+            self.transport.resume_reading()
+        if self.transport.can_write_eof():
+            try:
+                self.transport.write_eof()
+                return
+            except OSError:
+                pass  # 对端已断开
+        self.transport.close()
+
+    def pause_writing(self):
+        if self.drain_waiter is None:
+            self.drain_waiter = asyncio.get_event_loop().create_future()
+
+    def resume_writing(self):
+        waiter, self.drain_waiter = self.drain_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self.body is None:
+            return self.head[self.offset:]
+        else:
+            return self.body[self.offset:]
+
+    def buffer_updated(self, nbytes: int):
+        self.offset += nbytes
+        if self.body is None:
+            if self.offset < len(self.head):
+                return
+            try:
+                self.flag, self.chksum, length = Packet.unpack_head(
+                    self.head.tobytes(), self.params)
+            except PacketError:
+                logging.error(f'conn-{id(self.conn):x} received '
+                              'an error packet.')
+                self.transport.abort()
+                return
+            if self.flag == Flag.FILE_CHUNK:
+                self.body = self.pool.buffers.get(length)
+            else:
+                self.body = memoryview(bytearray(length))
+            self.offset = 0
+
+        if self.offset == len(self.body):
+            self.on_packet()
+
+    def on_packet(self):
+        '''收到一个完整的报文'''
+        body = self.body
+        if self.flag != Flag.FILE_CHUNK:
+            body = body.tobytes()
+        self.body, self.offset = None, 0
+        if self.params.checksum(body) != self.chksum:
+            logging.error(f'conn-{id(self.conn):x} received an error packet.')
+            self.transport.abort()
+            return
+
+        packet = Packet(self.flag, body, chksum=self.chksum)
+        logging.debug(f'[Recv] conn-{id(self.conn):x}: {packet}')
+        if not self.pool.on_received(self.conn, packet) or self.closed:
+            return
+
+        try:
+            self.pool.recv_q.put_nowait(packet)
+        except Full:
+            self.pending = packet
+            self.transport.pause_reading()
+            self.pool.paused.append(self)
+            # 入队失败后消费端可能已取空队列, 再尝试一次
+            self.pool.resume_readers()
+
+    def resume(self) -> bool:
+        '''投递暂存的报文并恢复读取, recv_q 仍满时返回 False'''
+        try:
+            self.pool.recv_q.put_nowait(self.pending)
+        except Full:
+            return False
+        self.pending = None
+        if not self.closed:
+            self.transport.resume_reading()
+        return True
+
+    def write(self, *buffers: Buffer):
+        '''写缓冲区为空时由 sendmsg 直接聚集发送, 只将未发出的部分交给 transport
+
+        transport.write 会把未发出的部分拷贝进其内部的 bytearray (Python 3.12 之前),
+        直接发送使数据块通常不经拷贝即发出
+        '''
+        views = [memoryview(buf) for buf in buffers]
+        if (self.transport.get_write_buffer_size() == 0
+                and not self.transport.is_closing()):
+            try:
+                n_sent = self.conn.sendmsg(views)
+            except (BlockingIOError, InterruptedError):
+                n_sent = 0
+            except OSError:
+                n_sent = 0  # 交由 transport 发送, 由其报告连接断开
+            # 丢弃已发送完毕的缓冲区, 截掉部分发送的缓冲区
+            while views and n_sent >= len(views[0]):
+                n_sent -= len(views.pop(0))
+            if views:
+                views[0] = views[0][n_sent:]
+        for view in views:
+            self.transport.write(view)
+
+    async def send(self, packet: Packet):
+        '''写入报文, 写缓冲区过多时等待其排空'''
+        if self.closed or self.transport.is_closing():
+            # 写入出错后 connection_lost 尚未回调, 不再写入已断开的连接
+            raise ConnectionResetError('connection closed')
+        head = packet.head(self.params) + packet.body
+        data = packet.data
+        if isinstance(data, FileRegion):
+            self.transport.write(head)
+            loop = asyncio.get_event_loop()
+            n_sent = await loop.sendfile(self.transport, data.fp,
+                                         data.offset, data.length)
+            if n_sent < data.length:
+                # 文件变短, 补零以保持报文完整
+                self.transport.write(bytes(data.length - n_sent))
+        elif data:
+            self.write(head, data)
+        else:
+            self.transport.write(head)
+
+        if self.drain_waiter is not None:
+            await self.drain_waiter
+        if self.closed:
+            raise ConnectionResetError('connection closed')
+
+
+class Outbox:
+    '''单个连接的发送队列
+
+    协商了重发时还记录该连接上的报文序号: 发出的报文保留至对端确认,
+    收到的报文按数量定期向对端确认
+    '''
+    __slots__ = ('conn', 'conn_id', 'packets', 'n_queued', 'n_inflight',
+                 'busy', 'rate', 'sampled', 'closed', 'resend', 'n_written',
+                 'unacked', 'ack', 'n_received', 'n_acked', 'n_unacked_bytes',
+                 'is_reported',
+                 'is_lost')
+
+    def __init__(self, conn: Connection, conn_id: int, resend: bool = False):
+        self.conn = conn
+        self.conn_id = conn_id  # 双方共用的连接编号, 由客户端分配
+        self.packets: Deque[Packet] = deque()
+        self.n_queued = 0  # 队列中的字节数
+        self.n_inflight = 0  # 已取出、正在发送的字节数
+        self.busy = 0.0  # 累计发送耗时 (秒)
+        self.rate = 0.0  # 近期的发送速率 (Bytes/s), 为 0 表示尚未测得
+        self.sampled = (0, 0.0)  # 上次采样时的 (发送量, 发送耗时)
+        self.closed = False  # 连接下线或断开后不再接收新报文
+        self.resend = resend  # 是否保留对端尚未确认的报文
+        self.n_written = 0  # 已发出的报文数 (不含 ACK)
+        self.unacked: Deque[Tuple[int, Packet]] = deque()  # 对端尚未确认的报文及其序号
+        self.ack: Optional[int] = None  # 待发给对端的确认
+        self.n_received = 0  # 收到的报文数 (不含 ACK)
+        self.n_acked = 0  # 已向对端确认的报文数
+        self.n_unacked_bytes = 0  # 收到但尚未向对端确认的字节数
+        self.is_reported = False  # 连接断开后是否已将 n_received 告知对端
+        self.is_lost = False  # 对端是否已告知其在该连接上收到的报文数
+
+    @property
+    def is_full(self) -> bool:
+        return len(self.packets) >= SEND_QUEUE_SIZE
+
+    def put(self, packet: Packet):
+        self.packets.append(packet)
+        self.n_queued += packet.length
+
+    def get(self) -> Packet:
+        packet = self.packets.popleft()
+        self.n_queued -= packet.length
+        return packet
+
+    def clear(self) -> List[Packet]:
+        packets = list(self.packets)
+        self.packets.clear()
+        self.n_queued = 0
+        return packets
+
+    def mark_ack(self):
+        '''确认目前收到的所有报文, 由发送者随后发出'''
+        self.n_acked = self.n_received
+        self.n_unacked_bytes = 0
+        self.ack = self.n_received & 0xffffffff
+
+    def next_ack(self) -> Optional[Packet]:
+        if self.ack is None:
+            return None
+        packet = Packet.load(Flag.ACK, self.ack)
+        self.ack = None
+        return packet
+
+    def written(self, packet: Packet):
+        '''报文已发出 (或发送中断), 保留至对端确认'''
+        if packet.flag == Flag.ACK:
+            return
+        self.n_written += 1
+        if self.resend:
+            self.unacked.append((self.n_written, packet))
+
+    def acked(self, n_packets: int):
+        '''对端确认已收到该连接上的前 n_packets 个报文 (序号按 32 位回绕)'''
+        while (self.unacked
+               and (n_packets - self.unacked[0][0]) & 0xffffffff < 0x80000000):
+            self.unacked.popleft()
+
+    def sample(self, n_sent: int):
+        '''按发送耗时计算速率, 连接空闲的时间不计入'''
+        n_bytes = n_sent - self.sampled[0]
+        busy = self.busy - self.sampled[1]
+        if busy > 0:
+            self.rate = Window.smooth(self.rate, n_bytes / busy)
+        self.sampled = (n_sent, self.busy)
+
 
 class ConnectionPool(Thread):
+    '''连接池
+
+    每个连接有自己的发送队列与发送者, 报文放入预计最快发完的连接的队列,
+    空闲的发送者会从其他连接的队列中窃取报文。
+    socket 连接 (如 fcpd 一侧) 由共享的事件循环非阻塞地收发, 每个连接一个发送协程;
+    paramiko 的 Channel 不支持事件循环, 每个连接各启动一个发送线程与接收线程。
+    本线程定期统计各连接的发送速率。
+
+    协商了重发 (resend) 时, 接收方每收到约一个数据块大小的数据 (或 ACK_INTERVAL 个报文)
+    就在同一连接上确认一次, 尚未确认的报文由本线程定期确认。
+    连接意外断开后, 其上未被确认的数据块等报文交给其他连接重发, 并通过 on_drop 通知补建连接。
+
+    协商了额度 (credit) 时, 在途的报文不超过对端的额度, 对端处理完报文后归还额度,
+    接收端占用的内存因此不随网速增长
+    '''
     _max_size = 128
 
-    def __init__(self, size=16):
+    def __init__(self, size=16, params: SessionParams = LEGACY):
         super().__init__(daemon=True)
         self.size = min(size, self._max_size)
-        self.send_q = Queue(self.size)
-        self.recv_q = Queue()
+        self.params = params
+        self.recv_q = Queue(RECV_QUEUE_SIZE)  # 未协商额度时, 处理不及时则由 TCP 反压发送端
+        self.buffers = BufferPool(params.chunk_size + 8)
         self.done = Event()
-        self.sender = SelectSelector()
         self.connections: Set[Connection] = set()
+        self.counters: Dict[Connection, Counter] = {}  # 各连接的收发量
+
+        # 发送队列: cond 保护以下所有状态
+        self.cond = Condition()
+        self.outboxes: Dict[Connection, Outbox] = {}
+        self.orphans: Deque[Packet] = deque()  # 下线或断开的连接未发出的报文, 优先发送
+        self.dropped: Dict[int, Outbox] = {}  # 意外断开的连接, 按连接编号索引
+        self.n_pending = 0  # 尚未发送完毕的报文数
+        self.credit = params.credit  # 还可以发给对端的字节数
+        self.n_granted = 0  # 已处理完、尚未归还给对端的字节数
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        # 由事件循环收发的连接
+        self.protocols: Dict[Connection, PacketProtocol] = {}
+        # 因 recv_q 写满而暂停读取的连接
+        self.paused: Deque[PacketProtocol] = deque()
+        # 连接意外断开时的回调
+        self.on_drop: Optional[Callable[[Connection], Any]] = None
+        self.stopping = False  # 会话结束时 (含对端结束) 关闭连接不算意外断开
+        self.has_packets: Optional[asyncio.Event] = None  # 唤醒等待报文的发送协程
+
+        # 连接下线: 一方发出 DETACH 后不再通过该连接发送报文,
+        # 双方都发出并收到 DETACH 后关闭连接, 下线过程中不会丢失报文
+        self.mutex = Lock()
+        self.retiring: Set[Connection] = set()  # 等待发送者发出 DETACH 的连接
+        self.detached: Set[Connection] = set()  # 已发出 DETACH 的连接
+        self.peer_detached: Set[Connection] = set()  # 已收到 DETACH 的连接
+
+    @property
+    def can_sendfile(self) -> bool:
+        '''连接均为真正的 socket (如 fcpd 一侧) 且报文不做校验时, 数据块可由 sendfile 发送'''
+        return (self.params.chksum_mode == 'none' and bool(self.connections)
+                and all(isinstance(conn, socket) for conn in self.connections))
+
+    def send(self, packet: Packet, timeout: Optional[float] = None) -> bool:
+        '''放入预计最快发完的连接的队列, 所有队列都已写满或额度不足时阻塞
+
+        指定 timeout 时最多等待 timeout 秒, 超时 (如连接已全部断开) 则放弃并返回 False
+        '''
+        if packet.flag == Flag.DONE or packet.flag == Flag.EXCEPTION:
+            self.stopping = True  # 本端即将结束会话, 对端随后关闭连接
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.cond:
+            outbox = self.schedule() if self.has_credit(packet) else None
+            while outbox is None:
+                if deadline is None:
+                    self.cond.wait()
+                elif deadline > monotonic():
+                    self.cond.wait(deadline - monotonic())
+                else:
+                    return False
+                outbox = self.schedule() if self.has_credit(packet) else None
+            outbox.put(packet)
+            self.n_pending += 1
+            if self.params.credit and packet.flag != Flag.CREDIT:
+                self.credit -= packet.length
+            self.cond.notify_all()
+        self.wake_writers()
+        return True
+
+    def has_credit(self, packet: Packet) -> bool:
+        '''额度是否足够发送该报文, 超过总额度的报文在对端处理完所有报文后发送'''
+        return (not self.params.credit or packet.flag == Flag.CREDIT
+                or packet.length <= self.credit
+                or self.credit >= self.params.credit)
+
+    def on_credit(self, packet: Packet):
+        '''对端归还了额度'''
+        n_bytes, = packet.unpack_body()
+        with self.cond:
+            self.credit += n_bytes
+            self.cond.notify_all()
+
+    def grant(self, n_bytes: int):
+        '''报文已处理完毕, 攒够总额度的 1/4 后归还给对端'''
+        if not self.params.credit or self.done.is_set():
+            return
+        with self.cond:
+            self.n_granted += n_bytes
+            if self.n_granted < self.params.credit // 4:
+                return
+            n_bytes, self.n_granted = self.n_granted, 0
+        self.send(Packet.load(Flag.CREDIT, n_bytes))
+
+    def schedule(self) -> Optional[Outbox]:
+        '''按 (排队 + 在途字节数) / 近期速率 估算各连接发完所需的时间, 取最短的'''
+        outboxes = [outbox for outbox in self.outboxes.values()
+                    if not (outbox.closed or outbox.is_full)]
+        if not outboxes:
+            return None
+
+        # 尚未测得速率的连接按最快的连接估算, 使其尽快参与发送
+        best_rate = max((outbox.rate for outbox in outboxes), default=0) or 1
+        return min(outboxes, key=lambda o: ((o.n_queued + o.n_inflight)
+                                            / (o.rate or best_rate)))
+
+    def take(self, outbox: Outbox) -> Optional[Packet]:
+        '''取出下一个要发的报文: 先发确认, 再取自己队列中的、无主的, 最后从正忙的连接窃取'''
+        ack = outbox.next_ack()
+        if ack is not None:
+            return ack
+        elif outbox.packets:
+            packet = outbox.get()
+        elif self.orphans:
+            packet = self.orphans.popleft()
+        else:
+            victims = [o for o in self.outboxes.values()
+                       if o.packets and o.n_inflight]
+            if not victims:
+                return None
+            packet = max(victims, key=lambda o: o.n_queued).get()
+
+        outbox.n_inflight += packet.length
+        self.cond.notify_all()
+        return packet
+
+    def sent(self, outbox: Outbox, packet: Packet, elapsed: float):
+        '''报文发送完毕 (或发送失败)'''
+        if packet.flag == Flag.ACK:
+            return
+        with self.cond:
+            outbox.n_inflight -= packet.length
+            outbox.busy += elapsed
+            self.n_pending -= 1
+            self.cond.notify_all()
+
+    def on_received(self, conn: Connection, packet: Packet) -> bool:
+        '''统计并处理连接层的报文, 返回是否需要交给上层'''
+        counter = self.counters.get(conn)
+        if counter is not None:
+            counter.n_recv += packet.length
+        if packet.flag == Flag.ACK:
+            n_packets, = packet.unpack_body()
+            with self.cond:
+                outbox = self.outboxes.get(conn)
+                if outbox is not None:
+                    outbox.acked(n_packets)
+            return False
+
+        if self.params.resend:
+            with self.cond:
+                outbox = self.outboxes.get(conn) or self.find_dropped(conn)
+                if outbox is not None:
+                    if outbox.is_reported:
+                        return False  # 已告知对端重发
+                    outbox.n_received += 1
+                    outbox.n_unacked_bytes += packet.length
+                    # 按字节数确认, 对端为重发保留的数据不超过约一个数据块
+                    if ((outbox.n_unacked_bytes >= self.params.chunk_size
+                         or outbox.n_received - outbox.n_acked >= ACK_INTERVAL)
+                            and not outbox.closed):
+                        outbox.mark_ack()
+                        self.cond.notify_all()
+                        self.wake_writers()
+
+        if packet.flag == Flag.DETACH:
+            self.on_detach(conn)
+            return False
+        elif packet.flag == Flag.CREDIT:
+            self.on_credit(packet)
+            return False
+        elif packet.flag == Flag.LOST:
+            self.on_lost(packet)
+            return False
+        else:
+            if packet.flag == Flag.DONE or packet.flag == Flag.EXCEPTION:
+                self.stopping = True  # 对端即将结束会话并关闭连接
+            return True
+
+    def find_dropped(self, conn: Connection) -> Optional[Outbox]:
+        for outbox in self.dropped.values():
+            if outbox.conn is conn:
+                return outbox
+        return None
+
+    def written(self, outbox: Outbox, packet: Packet):
+        '''报文已发出 (或发送中断), 调用时须持有 self.cond
+
+        对端已告知该连接上收到的报文数时, 此后写出的报文不可能到达, 直接交给其他连接重发
+        '''
+        if not outbox.is_lost:
+            outbox.written(packet)
+        elif packet.flag != Flag.ACK:
+            self.orphans.appendleft(packet)
+            self.n_pending += 1
+            self.cond.notify_all()
+            self.wake_writers()
+
+    def drop(self, conn: Connection):
+        '''连接意外断开: 未发出的报文交给其他连接发送, 并通知补建连接
+
+        已发出的报文保留至对端告知其在该连接上收到了多少个报文 (LOST)
+        '''
+        if self.done.is_set():
+            return  # 会话已结束, 连接随之关闭
+        with self.cond:
+            outbox = self.outboxes.pop(conn, None)
+            if outbox is None:
+                return  # 已下线或已处理过
+            self.orphans.extendleft(reversed(outbox.clear()))
+            outbox.closed = True
+            if self.params.resend:
+                self.dropped[outbox.conn_id] = outbox
+            self.cond.notify_all()
+
+        self.pop(conn, abort=True)
+        if not self.stopping:
+            logging.warning(f'[Pool] Conn-{id(conn):x} dropped')
+            if self.on_drop is not None:
+                Thread(target=self.on_drop, args=(conn,), daemon=True).start()
+
+    def report(self, conn: Connection):
+        '''连接断开且不会再收到报文后, 通过其他连接告知对端本端在该连接上收到的报文数'''
+        with self.cond:
+            outbox = self.find_dropped(conn)
+            if outbox is None or outbox.is_reported or self.done.is_set():
+                return
+            outbox.is_reported = True
+            packet = Packet.load(Flag.LOST, outbox.conn_id, outbox.n_received)
+            self.orphans.appendleft(packet)
+            self.n_pending += 1
+            self.cond.notify_all()
+        self.wake_writers()
 
-    def send(self, packet: Packet):
-        self.send_q.put(packet)
+    def on_lost(self, packet: Packet):
+        '''对端告知其在已断开的连接上收到的报文数, 重发其余的报文'''
+        conn_id, n_received = packet.unpack_body()
+        with self.cond:
+            outbox = self.dropped.get(conn_id)
+            if outbox is None:
+                conns = [o.conn for o in self.outboxes.values()
+                         if o.conn_id == conn_id]
+        if outbox is None:
+            # 对端先发现连接断开, 本端随之放弃该连接
+            if not conns:
+                return
+            self.drop(conns[0])
+
+        with self.cond:
+            outbox = self.dropped.get(conn_id)
+            if outbox is None:
+                return
+            outbox.acked(n_received)
+            outbox.is_lost = True
+            lost = [packet for _, packet in outbox.unacked]
+            outbox.unacked.clear()
+            self.orphans.extendleft(reversed(lost))
+            self.n_pending += len(lost)
+            self.cond.notify_all()
+        logging.warning(f'[Pool] Conn-{id(outbox.conn):x}: '
+                        f'resend {len(lost)} packets')
+        self.wake_writers()
+
+    def shut(self, conn: Connection):
+        '''连接不再接收新报文, 已排队的报文交给其他连接发送'''
+        with self.cond:
+            outbox = self.outboxes.get(conn)
+            if outbox is not None and not outbox.closed:
+                outbox.closed = True
+                self.orphans.extend(outbox.clear())
+            self.cond.notify_all()
+        self.wake_writers()
+
+    def sample(self):
+        '''统计各连接近期的发送速率'''
+        with self.cond:
+            for conn, outbox in self.outboxes.items():
+                counter = self.counters.get(conn)
+                if counter is not None:
+                    outbox.sample(counter.n_sent)
+
+    def flush_acks(self):
+        '''定期确认尚未确认的报文, 以免传输尾声或连接空闲时对端一直保留它们'''
+        if not self.params.resend:
+            return
+        with self.cond:
+            outboxes = [outbox for outbox in self.outboxes.values()
+                        if outbox.n_received != outbox.n_acked
+                        and not outbox.closed]
+            for outbox in outboxes:
+                outbox.mark_ack()
+            if outboxes:
+                self.cond.notify_all()
+        if outboxes:
+            self.wake_writers()
 
     def recv(self, timeout=TIMEOUT) -> Packet:
-        return self.recv_q.get(timeout)
+        packet = self.recv_q.get(timeout)
+        self.on_dequeue(packet)
+        return packet
+
+    def poll(self, timeout: float) -> Optional[Packet]:
+        '''等待报文, 超时返回 None'''
+        try:
+            packet = self.recv_q.get(timeout=timeout)
+        except Empty:
+            return None
+        self.on_dequeue(packet)
+        return packet
+
+    def on_dequeue(self, packet: Packet):
+        self.notify_readers()
+        # 数据块写入文件后 (release) 才归还额度, 其余报文取出即归还
+        if packet.flag != Flag.FILE_CHUNK and packet.flag != Flag.FILE_ZCHUNK:
+            self.grant(packet.length)
 
-    def add(self, conn: Connection):
-        '''添加一个连接'''
+    def wake_writers(self):
+        '''唤醒事件循环中等待报文的发送协程'''
+        if self.protocols:
+            self.loop.call_soon_threadsafe(self.set_has_packets)
+
+    def set_has_packets(self):
+        if self.has_packets is not None:
+            self.has_packets.set()
+
+    def notify_readers(self):
+        '''recv_q 有了空位, 让暂停的连接恢复读取'''
+        if self.paused:
+            self.loop.call_soon_threadsafe(self.resume_readers)
+
+    def resume_readers(self):
+        while self.paused:
+            if not self.paused[0].resume():
+                break
+            self.paused.popleft()
+
+    def traffic(self) -> Dict[Connection, int]:
+        '''各连接累计收发的字节数, 不含正在下线的连接'''
+        with self.mutex:
+            leaving = self.retiring | self.detached | self.peer_detached
+            return {conn: counter.n_bytes
+                    for conn, counter in self.counters.items()
+                    if conn not in leaving}
+
+    def retire(self, conn: Connection):
+        '''让一个连接下线'''
+        with self.mutex:
+            if conn in self.counters and conn not in self.detached:
+                self.retiring.add(conn)
+            else:
+                return
+        self.shut(conn)
+
+    def detach(self, conn: Connection):
+        '''通知对端连接下线, 此后不再通过该连接发送报文 (在发送线程中执行)'''
+        try:
+            send_pkt(conn, Packet.load(Flag.DETACH), self.params)
+        except SocketError:
+            self.drop(conn)
+            return
+        self.on_detached(conn)
+
+    async def detach_async(self, conn: socket, proto: PacketProtocol):
+        '''同 detach, 在连接的发送协程中执行'''
+        try:
+            await proto.send(Packet.load(Flag.DETACH))
+        except SocketError:
+            self.drop(conn)
+            return
+        self.on_detached(conn)
+
+    def on_detached(self, conn: Connection):
+        '''已发出 DETACH, 若对端也已发出则关闭连接'''
+        with self.mutex:
+            self.retiring.discard(conn)
+            if conn in self.peer_detached:
+                is_closable = True
+            else:
+                self.detached.add(conn)
+                is_closable = False
+        if is_closable:
+            self.pop(conn)
+
+    def on_detach(self, conn: Connection):
+        '''收到对端的 DETACH, 对端已不再通过该连接发送报文'''
+        with self.mutex:
+            if conn in self.detached:
+                is_closable = True
+            else:
+                self.peer_detached.add(conn)
+                self.retiring.add(conn)
+                is_closable = False
+        if is_closable:
+            self.pop(conn)
+        else:
+            self.shut(conn)
+
+    def release(self, packet: Packet):
+        '''数据块处理完毕后归还其接收缓冲区及对端的发送额度'''
+        n_bytes = packet.length
+        if isinstance(packet.body, memoryview):
+            self.buffers.put(packet.body)
+        self.grant(n_bytes)
+
+    def add(self, conn: Connection, conn_id: int = 0):
+        '''添加一个连接, conn_id 为客户端分配的连接编号 (首个连接为 0)'''
         # 检查数量是否达到上限
         if len(self.connections) >= self._max_size:
             return False
@@ -222,79 +1367,182 @@ class ConnectionPool(Thread):
             return True
 
         self.connections.add(conn)
-        self.sender.register(conn, EVENT_WRITE, data=Counter())
+        self.counters[conn] = Counter()
+        with self.cond:
+            self.outboxes[conn] = Outbox(conn, conn_id, self.params.resend)
+            self.cond.notify_all()
 
-        t_recv = Thread(target=self.listen_to_recv, args=(conn,), daemon=True)
-        t_recv.start()
+        if isinstance(conn, socket):
+            self.loop = EventLoop.get()
+            self.protocols[conn] = PacketProtocol(self, conn)
+            asyncio.run_coroutine_threadsafe(self.serve(conn), self.loop)
+        else:
+            t_send = Thread(target=self.listen_to_send, args=(conn,),
+                            daemon=True)
+            t_send.start()
+            t_recv = Thread(target=self.listen_to_recv, args=(conn,),
+                            daemon=True)
+            t_recv.start()
         return True
 
-    def pop(self, conn: Connection):
+    async def serve(self, conn: socket):
+        '''在事件循环中接管一个 socket 连接, 并持续发送分给它或窃取来的报文'''
+        if self.has_packets is None:
+            self.has_packets = asyncio.Event()
+        proto = self.protocols.get(conn)
+        if proto is None or proto.closed:
+            conn.close()
+            return
+
+        loop = asyncio.get_event_loop()
         try:
-            self.sender.unregister(conn)
-        except (KeyError, ValueError):
-            pass
+            await loop.connect_accepted_socket(lambda: proto, sock=conn)
+        except SocketError as e:
+            self.drop(conn)
+            logging.warning(f'[Send] Conn-{id(conn):x}: {e}.')
+            return
+
+        counter = self.counters[conn]
+        outbox = self.outboxes[conn]
+        while not (self.done.is_set() or proto.closed):
+            # 待下线的连接先发出 DETACH, 此后不再发送报文
+            if conn in self.retiring:
+                await self.detach_async(conn, proto)
+                return
+            if conn in self.detached:
+                return
+
+            with self.cond:
+                packet = self.take(outbox)
+            if packet is None:
+                self.has_packets.clear()
+                await self.has_packets.wait()
+                continue
+
+            started = monotonic()
+            try:
+                await proto.send(packet)
+                counter.acc(packet.length)
+            except SocketError as e:
+                self.drop(conn)
+                logging.warning(f'[Send] Conn-{id(conn):x}: {e}.')
+            finally:
+                with self.cond:
+                    self.written(outbox, packet)  # 发送中断的报文也可能已到达对端
+                self.sent(outbox, packet, monotonic() - started)
+
+    def pop(self, conn: Connection, abort=False):
+        self.shut(conn)
+        proto = self.protocols.pop(conn, None)
+
+        with self.mutex:
+            self.counters.pop(conn, None)
+            self.retiring.discard(conn)
+            self.detached.discard(conn)
+            self.peer_detached.discard(conn)
+
+        with self.cond:
+            self.outboxes.pop(conn, None)
 
         try:
             self.connections.remove(conn)
         except KeyError:
             pass
         finally:
+            self.close(conn, proto, abort)
+
+    def close(self, conn: Connection, proto: Optional[PacketProtocol],
+              abort=False):
+        if proto is None:
             conn.close()
+        else:
+            # socket 已交由事件循环管理, 须在事件循环中关闭
+            self.loop.call_soon_threadsafe(proto.close, abort)
+            self.wake_writers()
 
-    def listen_to_send(self):
+    def listen_to_send(self, conn: Connection):
+        conn_name = f'{id(conn):x}'
+        counter = self.counters[conn]
+        outbox = self.outboxes[conn]
         while not self.done.is_set():
-            # find the conn that sent the least data
-            keys = [key for key, _ in self.sender.select(timeout=1)]
-            if not keys:
-                continue
-            else:
-                key = min(keys, key=lambda k: k.data.n_sent)
+            # 待下线的连接先发出 DETACH, 此后不再发送报文
+            if conn in self.retiring:
+                self.detach(conn)
+                return
+            if conn in self.detached or conn not in self.connections:
+                return
 
-            # get data
-            try:
-                packet: Packet = self.send_q.get(timeout=TIMEOUT)
-                conn: Connection = key.fileobj
-            except Empty:
-                break
+            with self.cond:
+                packet = self.take(outbox)
+                if packet is None:
+                    self.cond.wait(1)
+                    continue
 
-            # send
+            started = monotonic()
             try:
-                send_pkt(conn, packet)
-                key.data.acc(packet.length)
+                send_pkt(conn, packet, self.params)
+                counter.acc(packet.length)
             except SocketError as e:
-                self.pop(conn)
-                logging.warning(f'[Send] Conn-{id(conn):x}: {e}.')
+                self.drop(conn)
+                logging.warning(f'[Send] Conn-{conn_name}: {e}.')
+            finally:
+                with self.cond:
+                    self.written(outbox, packet)  # 发送中断的报文也可能已到达对端
+                self.sent(outbox, packet, monotonic() - started)
 
     def listen_to_recv(self, conn: Connection):
         conn_name = f'{id(conn):x}'
         while not self.done.is_set():
             try:
-                packet = recv_pkt(conn)
-                self.recv_q.put(packet)
+                packet = recv_pkt(conn, self.params, self.buffers)
                 logging.debug(f'[Recv] conn-{conn_name}: {packet}')
+                if packet.flag == Flag.DETACH:
+                    self.on_received(conn, packet)
+                    return
+                if self.on_received(conn, packet):
+                    self.recv_q.put(packet)
             except ConnectionResetError:
-                self.pop(conn)
-                return
+                break
             except SocketError as e:
-                self.pop(conn)
                 logging.warning(f'[Recv] Conn-{conn_name}: {e}.')
+                break
             except PacketError:
-                self.pop(conn)
                 logging.error(f'conn-{conn_name} received an error packet.')
-                return
+                break
+        else:
+            return
 
-    def stop(self):
-        while not self.send_q.empty():
-            sleep(0.2)
+        # 连接意外断开
+        self.drop(conn)
+        self.report(conn)
+
+    def stop(self, timeout: Optional[float] = None):
+        # 等待所有报文发出 (含已取出但尚未发送完毕的), 连接已全部断开或超时后不再等待
+        self.stopping = True
+        with self.cond:
+            self.cond.wait_for(
+                lambda: self.n_pending == 0 or not self.outboxes, timeout)
         self.done.set()
-        self.sender.close()
+        with self.cond:
+            self.cond.notify_all()
+
+        # 先关闭写方向, 对端读完报文并关闭连接后 (或超时) 再关闭
+        protos = list(self.protocols.values())
+        for proto in protos:
+            self.loop.call_soon_threadsafe(proto.shutdown)
+        deadline = monotonic() + CLOSE_TIMEOUT
+        for proto in protos:
+            proto.lost.wait(max(deadline - monotonic(), 0))
+
         for conn in self.connections.copy():
-            conn.close()
+            self.close(conn, self.protocols.get(conn))
+        self.wake_writers()
 
     def run(self):
         if not self.connections:
             raise ValueError('No connection')
 
         self.done.clear()
-        self.listen_to_send()
-        self.stop()
+        while not self.done.wait(SEND_SAMPLE_INTERVAL):
+            self.sample()
+            self.flush_acks()
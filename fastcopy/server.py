@@ -3,19 +3,20 @@
 import _socket
 import logging
 from argparse import ArgumentParser
-from json import loads
+from json import dumps, loads
 from socket import AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SO_REUSEPORT
 from socket import error as SocketError, timeout as TimeoutError
 from socket import socket
 from threading import Lock, Thread
-from typing import Dict
+from typing import Dict, Tuple
 from uuid import uuid4
 
 import daemon
 
-from .config import SERVER_ADDR, TIMEOUT
-from .network import Flag, Packet, send_pkt, recv_pkt
-from .transfer import Sender, Receiver, Porter
+from .config import SERVER_ADDR, TIMEOUT, HASH_WORKERS
+from .cache import HashCache
+from .network import Flag, Packet, SessionParams, send_pkt, recv_pkt
+from .transfer import FileInfo, Sender, Receiver, Porter
 
 
 class WatchDog(Thread):
@@ -44,17 +45,19 @@ class WatchDog(Thread):
         if packet.flag == Flag.PULL or packet.flag == Flag.PUSH:
             # 创建 Porter
             conn_info, = packet.unpack_body()
-            porter = self.server.create_porter(packet.flag, conn_info)
-            porter.conn_pool.add(self.sock)
-            porter.start()
+            porter, params = self.server.create_porter(packet.flag, conn_info)
 
-            # 将 SID 发送给客户端
-            packet = Packet.load(Flag.SID, porter.sid)
+            # 将 SID 及协商好的会话参数发送给客户端
+            packet = Packet.load(Flag.SID, porter.sid, params)
             send_pkt(self.sock, packet)
 
+            # SID 发出后再启动 Porter, 避免其报文抢在 SID 之前发出
+            porter.conn_pool.add(self.sock)
+            porter.start()
+
         elif packet.flag == Flag.ATTACH:
-            sid, = packet.unpack_body()
-            if not self.server.porters[sid].conn_pool.add(self.sock):
+            sid, conn_id = packet.unpack_body()
+            if not self.server.porters[sid].conn_pool.add(self.sock, conn_id):
                 self.sock.close()
 
         else:
@@ -66,31 +69,45 @@ class WatchDog(Thread):
 class Server(Thread):
     max_tasks = 256  # 同时运行的最大任务数量
 
-    def __init__(self, max_conn) -> None:
+    def __init__(self, max_conn, n_hashers=HASH_WORKERS) -> None:
         super().__init__(daemon=True)
         self.addr = SERVER_ADDR
         self.max_conn = max_conn  # 一个 Porter 的最大连接数
+        self.n_hashers = n_hashers  # 发送文件时计算校验和的线程数
         self.is_running = True
         self.mutex = Lock()
         self.porters: Dict[bytes, Porter] = {}
 
-    def create_porter(self, cli_flag: Flag, conn_info: str) -> Porter:
-        '''创建新 Porter'''
+    def create_porter(self, cli_flag: Flag,
+                      conn_info: str) -> Tuple[Porter, bytes]:
+        '''创建新 Porter, 并返回需回传给客户端的会话参数'''
         sid = uuid4().bytes
         _info = loads(conn_info)
         username = _info['user']
+
+        # 旧版客户端不会申请会话参数，此时不回传参数，继续使用 v1 协议
+        if 'params' in _info:
+            params = SessionParams.negotiate(_info['params'])
+            s_params = dumps(params.to_dict()).encode('utf8')
+        else:
+            params = SessionParams()
+            s_params = b''
+        logging.debug(f'[Server] Task-{sid.hex()} with {params}')
+
         if cli_flag == Flag.PULL:
             srcs = _info['srcs']
             include = _info['include']
             exclude = _info['exclude']
             logging.debug(f'[Server] New task-{sid.hex()} for send {srcs}')
             self.porters[sid] = Sender(sid, username, srcs, self.max_conn,
-                                       include, exclude)
+                                       include, exclude, params,
+                                       self.n_hashers)
         else:
             dst_path = _info['dst']
             logging.debug(f'[Server] New task-{sid.hex()} for recv {dst_path}')
-            self.porters[sid] = Receiver(sid, username, dst_path, self.max_conn)
-        return self.porters[sid]
+            self.porters[sid] = Receiver(sid, username, dst_path,
+                                         self.max_conn, params)
+        return self.porters[sid], s_params
 
     def close_all_porters(self):
         '''关闭所有 Porter'''
@@ -160,6 +177,18 @@ def main():
                         default=128,
                         help='max concurrent connections of one task.')
 
+    parser.add_argument('-w',
+                        dest='hash_workers',
+                        metavar='NUM',
+                        type=int,
+                        default=HASH_WORKERS,
+                        help='number of threads to hash files when sending.')
+
+    parser.add_argument('--no-hash-cache',
+                        dest='hash_cache',
+                        action='store_false',
+                        help='do not cache file hashes in ~/.cache/fastcopy.')
+
     parser.add_argument('--loglevel',
                         metavar='LEVEL',
                         default='error',
@@ -178,14 +207,18 @@ def main():
                                 level=loglevel,
                                 datefmt='%Y-%m-%d %H:%M:%S',
                                 format=logformat)
-            server = Server(args.concurrency)
+            if args.hash_cache:
+                FileInfo.hash_cache = HashCache.open()
+            server = Server(args.concurrency, args.hash_workers)
             server.start()
             server.join()
     else:
         logging.basicConfig(level=loglevel,
                             datefmt='%Y-%m-%d %H:%M:%S',
                             format=logformat)
-        server = Server(args.concurrency)
+        if args.hash_cache:
+            FileInfo.hash_cache = HashCache.open()
+        server = Server(args.concurrency, args.hash_workers)
         server.start()
         server.join()
 
@@ -1,21 +1,81 @@
 import os
 import re
 import logging
+import mmap
+from binascii import crc32
 from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from glob import has_magic, iglob
 from hashlib import md5
 from math import ceil
 from pathlib import Path
 from pwd import getpwnam
-from queue import Empty
-from threading import Semaphore, Thread
-from typing import Deque, Dict, Generator, Iterable, List, Tuple, Union
+from queue import Empty, Queue
+from stat import S_ISREG
+from threading import Condition, Lock, Semaphore, Thread
+from time import monotonic
+from typing import (Callable, Deque, Dict, Generator, Iterable, List,
+                    Optional, Set, Tuple, Union)
 
 from rich.progress import (BarColumn, Progress, TaskID, SpinnerColumn,
                            TextColumn, TransferSpeedColumn)
 
-from .config import CHUNK_SIZE
-from .network import Flag, ConnectionPool, Packet
+from .cache import HashCache
+from .compress import ChunkCompressor, Compressed
+from .config import (CHUNK_SIZE, DELTA_MIN_SIZE, HASH_BUF_SIZE, HASH_WORKERS,
+                     HASH_PENDING_SIZE, RESUME_MIN_SIZE, READ_AHEAD_SIZE,
+                     READ_WORKERS, REPAIR_RETRIES, STRIPE_CHUNKS,
+                     WRITE_WORKERS, WRITE_QUEUE_SIZE, RUN_MAX_BYTES,
+                     COALESCE_MAX_BYTES, POLL_INTERVAL, SIG_ANCHOR_SIZE,
+                     SHIFT_SEARCH_BLOCKS, SHIFT_MAX_MISSES, TIMEOUT,
+                     CLOSE_TIMEOUT)
+from .journal import ChunkJournal
+from .window import Window
+from .network import (Buffer, Flag, ConnectionPool, FileRegion, Packet,
+                      SessionParams, LEGACY)
+
+UNKNOWN_HASH = bytes(16)  # 快速比对模式下, 发送端在读取文件时才计算校验和
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')  # 一次 pwritev 最多写入的缓冲区数
+except (ValueError, OSError):
+    IOV_MAX = 1024
+
+# 数据块签名: (弱校验 crc32, 强校验 MD5, 块首锚点)
+BlockSig = Tuple[int, bytes, bytes]
+
+
+def seq_ranges(seqs: Iterable[int]) -> List[Tuple[int, int]]:
+    '''将数据块编号合并为区间 (start, count)'''
+    ranges: List[Tuple[int, int]] = []
+    for seq in sorted(seqs):
+        if ranges and sum(ranges[-1]) == seq:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+        else:
+            ranges.append((seq, 1))
+    return ranges
+
+
+def has_data(fd: int, offset: int, end: int) -> bool:
+    '''文件的 [offset, end) 区间内是否有数据 (不全是空洞)'''
+    if not hasattr(os, 'SEEK_DATA'):
+        return True
+    try:
+        return os.lseek(fd, offset, os.SEEK_DATA) < end
+    except OSError:
+        return False  # ENXIO: offset 之后全是空洞
+
+
+def use_mmap(size: int) -> bool:
+    '''开启 mmap 时文件通过 mmap 读写, 省去逐块的系统调用与中间对象'''
+    return FileInfo.mmap_io and size > 0
+
+
+def map_file(fd: int, size: int, access: int) -> mmap.mmap:
+    mm = mmap.mmap(fd, size, access=access)
+    if hasattr(mm, 'madvise'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    return mm
 
 
 trans_progress = Progress(
@@ -28,16 +88,117 @@ trans_progress = Progress(
 )
 
 
+progress_lock = Lock()  # 多个读取线程及会话共用 trans_progress
+
+
 def handle_finished_task(progress: Progress):
-    tasks = progress.tasks.copy()
-    n_tasks = len(tasks)
-    if n_tasks > 10:
-        for task in tasks:
-            if task.finished:
-                progress.remove_task(task.id)
-                n_tasks -= 1
-                if n_tasks <= 10:
-                    return
+    with progress_lock:
+        tasks = progress.tasks.copy()
+        n_tasks = len(tasks)
+        if n_tasks > 10:
+            for task in tasks:
+                if task.finished:
+                    progress.remove_task(task.id)
+                    n_tasks -= 1
+                    if n_tasks <= 10:
+                        return
+
+
+def update_task(task_id: TaskID, **kwargs):
+    '''更新进度条任务, 任务可能已被 handle_finished_task 移除'''
+    with progress_lock:
+        try:
+            trans_progress.update(task_id, **kwargs)
+        except KeyError:
+            pass
+
+
+def remove_task(task_id: TaskID):
+    '''移除进度条任务, 任务可能已被 handle_finished_task 移除'''
+    with progress_lock:
+        try:
+            trans_progress.remove_task(task_id)
+        except KeyError:
+            pass
+
+
+class StreamHasher:
+    '''随数据块写入按顺序增量计算 MD5
+
+    乱序到达的数据块暂存在内存中，等前面的数据块到齐后再计算。
+    暂存量超出上限时, 超出的数据块只记下编号 (其数据已写入磁盘), 轮到它时再从磁盘读回,
+    补读量只与超出的部分有关, 不会因一次超限而放弃整个文件的增量计算。
+    '''
+
+    def __init__(self, chunk_size: int, fd: int,
+                 max_pending: int = HASH_PENDING_SIZE):
+        self.hasher = md5()
+        self.chunk_size = chunk_size
+        self.fd = fd
+        self.max_pending = max_pending
+        self.next_seq = 0
+        self.pending: Dict[int, bytes] = {}
+        self.n_pending = 0
+        self.spilled: Set[int] = set()  # 已写入磁盘、需要读回的数据块
+        self.n_reread = 0  # 从磁盘读回的字节数
+
+    def update(self, seq: int, chunk: Buffer):
+        if (seq < self.next_seq or seq in self.pending
+                or seq in self.spilled):
+            return
+
+        if seq == self.next_seq:
+            self.hasher.update(chunk)
+            self.next_seq += 1
+            self.advance()
+        elif self.n_pending + len(chunk) <= self.max_pending:
+            # chunk 可能指向会被复用的接收缓冲区，需拷贝
+            self.pending[seq] = bytes(chunk)
+            self.n_pending += len(chunk)
+        else:
+            self.spilled.add(seq)
+
+    def written(self, seq: int):
+        '''数据块已在磁盘上 (如与本地数据相同而保留), 轮到它时再读取'''
+        if seq >= self.next_seq and seq not in self.pending:
+            self.spilled.add(seq)
+            self.advance()
+
+    def advance(self, is_written: Optional[Callable[[int], bool]] = None):
+        '''依次计算后续已暂存或已在磁盘上的数据块'''
+        while True:
+            seq = self.next_seq
+            if seq in self.pending:
+                chunk = self.pending.pop(seq)
+                self.n_pending -= len(chunk)
+            elif seq in self.spilled or (is_written and is_written(seq)):
+                self.spilled.discard(seq)
+                chunk = self.read(seq * self.chunk_size, self.chunk_size)
+            else:
+                break
+            self.hasher.update(chunk)
+            self.next_seq += 1
+
+    def update_from(self, is_written: Callable[[int], bool]):
+        '''从磁盘读取此前已写入的数据块 (断点续传) 计算 MD5'''
+        self.advance(is_written)
+
+    def read(self, offset: int, length: int) -> bytes:
+        chunk = os.pread(self.fd, length, offset)
+        self.n_reread += len(chunk)
+        return chunk
+
+    def digest(self) -> bytes:
+        '''所有数据块写完后获取 MD5, 必要时从磁盘补读'''
+        offset = self.next_seq * self.chunk_size
+        while True:
+            chunk = self.read(offset, HASH_BUF_SIZE)
+            if chunk:
+                self.hasher.update(chunk)
+                offset += len(chunk)
+            else:
+                break
+        return self.hasher.digest()
 
 
 class DirInfo:
@@ -89,6 +250,9 @@ class FileInfo:
     __slots__ = ('id', 'perm', 'size', 'mtime', 'chksum', 'relpath', 'abspath',
                  '_values')
 
+    hash_cache: Optional[HashCache] = None  # 由 fcp / fcpd 启动时设置
+    mmap_io = False  # 由 fcp --mmap 开启, fcpd 始终通过 os.pread / os.pwritev 读写
+
     def __init__(self, id: int, perm: int, size: int,
                  mtime: float, chksum: bytes, relpath: bytes):
         self.id = id
@@ -117,19 +281,20 @@ class FileInfo:
     def name(self) -> str:
         return self.abspath.name
 
-    @property
-    def n_chunks(self):
-        return ceil(self.size / CHUNK_SIZE)
+    def n_chunks(self, chunk_size: int = CHUNK_SIZE) -> int:
+        return ceil(self.size / chunk_size)
 
     @classmethod
-    def load(cls, file_id: int, fullpath: Path, relpath: Path):
+    def load(cls, file_id: int, fullpath: Path, relpath: Path,
+             with_hash: bool = True):
         # 读取文件状态信息
         stat = fullpath.stat()
+        chksum = cls.hash(fullpath, stat) if with_hash else UNKNOWN_HASH
         f_info = cls(file_id,
                      stat.st_mode,   # 权限, 2 Bytes
                      stat.st_size,   # 大小, 8 Bytes
                      stat.st_mtime,  # 修改时间, 8 Bytes
-                     cls.hash(fullpath),  # 文件 MD5 校验码
+                     chksum,         # 文件 MD5 校验码
                      bytes(relpath))
         f_info.abspath = fullpath
         return f_info
@@ -143,13 +308,26 @@ class FileInfo:
         self.abspath = parent.joinpath(self.s_relpath)
         return self.abspath
 
-    def set_stat(self):
-        '''设置文件属性'''
+    def set_stat(self, verified: bool = True):
+        '''设置文件属性, verified 为 False 表示内容未经核对 (快速比对), 不记入缓存'''
         # 设置权限
         self.abspath.chmod(self.perm)
         # 设置时间
         os.utime(self.abspath, (self.mtime, self.mtime))
 
+        # 此时文件内容与 chksum 一致，记入缓存
+        if (verified and self.hash_cache is not None
+                and self.chksum != UNKNOWN_HASH):
+            self.hash_cache.put(self.abspath.stat(), self.chksum)
+
+    def write(self, data: bytes):
+        '''一次性写入小文件的全部内容'''
+        # 确保文件的上级目录存在
+        self.abspath.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+
+        with open(self.abspath, 'wb') as fp:
+            fp.write(data)
+
     def touch(self):
         '''创建空文件'''
         # 确保文件的上级目录存在
@@ -159,67 +337,851 @@ class FileInfo:
             open(self.abspath, 'w').close()
             self.set_stat()
 
-    def iread(self) -> Generator[Packet, None, None]:
-        '''封装文件数据块报文'''
+    @staticmethod
+    def same_block(block: bytes, sig: BlockSig) -> bool:
+        '''先比较开销较小的弱校验, 一致时再比较强校验'''
+        weak, strong = sig[:2]
+        return crc32(block) == weak and md5(block).digest() == strong
+
+    def block_sigs(self, chunk_size: int, basis_size: int) -> List[BlockSig]:
+        '''计算本地已有文件中各数据块的签名'''
+        n_blocks = ceil(min(basis_size, self.size) / chunk_size)
+        sigs = []
         with open(self.abspath, 'rb') as fp:
-            seq = 0
-            # 读取单位长度的数据，如果为空则跳出循环
-            while True:
-                chunk = fp.read(CHUNK_SIZE)
-                if chunk:
-                    yield Packet.load(Flag.FILE_CHUNK, self.id, seq, chunk)
-                    seq += 1
-                else:
-                    break
-
-    def iwrite(self) -> Generator[None, Tuple[int, bytes], None]:
-        '''按数据块迭代写入'''
-        # 确保文件的上级目录存在
-        self.abspath.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+            for _ in range(n_blocks):
+                block = fp.read(chunk_size)
+                sigs.append((crc32(block), md5(block).digest(),
+                             block[:SIG_ANCHOR_SIZE]))
+        return sigs
 
-        # 定义文件所有数据块编号集
-        seqs = {i for i in range(self.n_chunks)}
-
-        # 开始迭代写入
-        mode = 'rb+' if self.abspath.is_file() else 'wb'
-        with open(self.abspath, mode) as fp:
-            while seqs:
-                seq, chunk = yield
-                if seq in seqs:
-                    fp.seek(seq * CHUNK_SIZE)
-                    fp.write(chunk)
-                    seqs.remove(seq)
+    @classmethod
+    def hash(cls, filepath: Path, stat: Optional[os.stat_result] = None
+             ) -> bytes:
+        '''计算文件的 MD5, 内容未变化的文件直接从缓存中读取'''
+        if cls.hash_cache is not None:
+            stat = stat or filepath.stat()
+            chksum = cls.hash_cache.get(stat)
+            if chksum is not None:
+                return chksum
 
-    @staticmethod
-    def hash(filepath: Path) -> bytes:
         hasher = md5()
         with open(filepath, 'rb') as fp:
             while True:
-                chunk = fp.read(CHUNK_SIZE)
+                chunk = fp.read(HASH_BUF_SIZE)
                 if chunk:
                     hasher.update(chunk)
                 else:
                     break
-        return hasher.digest()
+        chksum = hasher.digest()
+
+        # 读取期间文件被修改过则不做缓存
+        if cls.hash_cache is not None:
+            new_stat = filepath.stat()
+            if (new_stat.st_mtime_ns == stat.st_mtime_ns
+                    and new_stat.st_size == stat.st_size):
+                cls.hash_cache.put(stat, chksum)
+        return chksum
 
     def is_vaild(self):
         '''检查文件校验和'''
         return (self.abspath.is_file()
                 and self.hash(self.abspath) == self.chksum)
 
+    def is_unchanged(self):
+        '''快速比对: 大小与修改时间 (精确到秒) 相同则认为文件未变化'''
+        try:
+            stat = self.abspath.stat()
+        except FileNotFoundError:
+            return False
+        return (stat.st_size == self.size
+                and int(stat.st_mtime) == int(self.mtime))
+
+
+class OrderedHasher:
+    '''多个线程并行读取同一文件时, 按数据块顺序计算 MD5
+
+    超前 next_seq 过多的线程会等待, 以限制暂存的数据量。
+    持有 next_seq 数据块的线程永远不会等待, 因此只要各组数据块按顺序调度就不会死锁。
+    '''
+
+    def __init__(self, chunk_size: int, max_ahead: int = HASH_PENDING_SIZE):
+        self.hasher = md5()
+        self.chunk_size = chunk_size
+        self.max_ahead = max_ahead
+        self.next_seq = 0
+        self.pending: Dict[int, bytes] = {}
+        self.aborted = False
+        self.cond = Condition()
+
+    def update(self, seq: int, chunk: bytes):
+        with self.cond:
+            if self.aborted:
+                return
+            while (seq - self.next_seq) * self.chunk_size > self.max_ahead:
+                if self.aborted:
+                    return
+                self.cond.wait()
+            if seq != self.next_seq:
+                self.pending[seq] = chunk
+                return
+
+        # 只有持有 next_seq 数据块的线程会执行到这里, 计算时不必持有锁
+        while chunk is not None:
+            self.hasher.update(chunk)
+            with self.cond:
+                self.next_seq += 1
+                chunk = self.pending.pop(self.next_seq, None)
+                self.cond.notify_all()
+
+    def abort(self):
+        '''放弃计算, 唤醒所有等待中的线程'''
+        with self.cond:
+            self.aborted = True
+            self.pending.clear()
+            self.cond.notify_all()
+
+    def digest(self) -> bytes:
+        return self.hasher.digest()
+
+
+class ReadAhead:
+    '''限制并行读取同一文件时各组领先的距离
+
+    读取数据块前, 须等到它与最早未发出的数据块相距不超过 max_ahead,
+    接收端因此只需暂存少量乱序到达的数据块。
+    持有最早未发出数据块的线程永远不会等待, 因此只要各组数据块按顺序调度就不会死锁。
+    '''
+
+    def __init__(self, seqs: List[int], chunk_size: int,
+                 max_ahead: int = READ_AHEAD_SIZE):
+        self.seqs = seqs  # 按顺序需要读取的数据块
+        self.chunk_size = chunk_size
+        self.max_ahead = max_ahead
+        self.index = 0  # seqs[index] 为最早未发出的数据块
+        self.finished: Set[int] = set()  # 已发出但排在其后的数据块
+        self.aborted = False
+        self.cond = Condition()
+
+    def enter(self, seq: int):
+        '''等待可以读取 seq 数据块'''
+        with self.cond:
+            while not self.aborted and self.index < len(self.seqs):
+                if ((seq - self.seqs[self.index]) * self.chunk_size
+                        <= self.max_ahead):
+                    return
+                self.cond.wait()
+
+    def leave(self, seq: int):
+        '''seq 数据块已发出 (或无需发送)'''
+        with self.cond:
+            self.finished.add(seq)
+            index = self.index
+            while (self.index < len(self.seqs)
+                   and self.seqs[self.index] in self.finished):
+                self.finished.remove(self.seqs[self.index])
+                self.index += 1
+            if self.index != index:
+                self.cond.notify_all()
+
+    def abort(self):
+        '''放弃读取, 唤醒所有等待中的线程'''
+        with self.cond:
+            self.aborted = True
+            self.cond.notify_all()
+
+
+class StripedReader:
+    '''文件的并行读取任务
+
+    文件按 STRIPE_CHUNKS 个数据块分为一组, 各组由读取线程池中的线程通过 os.pread 读取,
+    各组领先最早未发出的数据块不超过 READ_AHEAD_SIZE。
+    若尚未计算校验和，则在读取过程中顺带计算。
+    若提供了接收端已有数据块的签名，则只发送内容不同的数据块，
+    内容相同的数据块最后汇总为一个 FILE_KEEP 报文。
+    与对齐位置的旧数据块不同时, 再查找其是否由旧文件中的数据前后移动而来 (如插入或删除了若干行),
+    找到的数据块最后汇总为一个 FILE_COPY 报文, 由接收端从旧数据中复制。
+    断点续传时 missing 为接收端缺失的数据块区间, 只发送这部分数据块。
+    开启 mmap 时改为从 mmap 中切片, 数据块直接引用页缓存，直到发送时才被拷贝。
+    zero_copy 时若无需读取数据 (校验和已知、不做增量比对且不压缩)，数据块由 sendfile 直接发送。
+    sparse 时通过 SEEK_HOLE / SEEK_DATA 找出完全位于空洞中的数据块,
+    不读取也不发送，最后汇总为一个 FILE_HOLES 报文。
+    提供 compressor 时数据块压缩后以 FILE_ZCHUNK 报文发送
+    '''
+
+    def __init__(self, f_info: FileInfo, chunk_size: int,
+                 sigs: Optional[List[BlockSig]] = None,
+                 missing: Optional[List[Tuple[int, int]]] = None,
+                 zero_copy: bool = False, sparse: bool = False,
+                 compressor: Optional[ChunkCompressor] = None):
+        self.f_info = f_info
+        self.compressor = compressor
+        self.chunk_size = chunk_size
+        self.sigs = sigs or []
+        self.fd = os.open(f_info.abspath, os.O_RDONLY)
+        self.kept: List[int] = []  # 内容相同、无需发送的数据块
+        self.copies: List[Tuple[int, int]] = []  # 移动过的数据块: (seq, 旧偏移)
+        self.shift: Optional[int] = None  # 最近一次找到的移动距离 (新偏移 - 旧偏移)
+        self.verified: Set[Tuple[int, int]] = set()  # 已确认的 (旧数据块, 移动距离)
+        self.n_misses = 0  # 连续查找失败的次数
+        self.failed = False  # 某组数据块读取或发送失败, 其余各组随之停止
+        self.ended = False  # 各组均已结束
+        self.n_sent = 0  # 已发出的该文件的报文数
+        self.mutex = Lock()
+
+        self.hash_unknown = f_info.chksum == UNKNOWN_HASH
+        if self.hash_unknown and f_info.hash_cache is not None:
+            chksum = f_info.hash_cache.get(os.fstat(self.fd))
+            if chksum is not None:
+                f_info.chksum = chksum
+        self.hasher = None
+        if f_info.chksum == UNKNOWN_HASH:
+            self.hasher = OrderedHasher(chunk_size)
+
+        self.fp = None
+        self.view: Optional[memoryview] = None
+        if (zero_copy and self.hasher is None and not self.sigs
+                and compressor is None):
+            self.fp = open(self.fd, 'rb', buffering=0)
+        else:
+            size = os.fstat(self.fd).st_size
+            if use_mmap(size):
+                # 读取期间文件被截短时访问映射区会触发 SIGBUS, 因此须由用户显式开启
+                mm = map_file(self.fd, size, mmap.ACCESS_READ)
+                self.view = memoryview(mm)
+
+        # 需要发送的数据块, 为 None 表示全部发送
+        self.wanted = None
+        if missing is not None:
+            self.wanted = {seq for start, count in missing
+                           for seq in range(start, start + count)}
+
+        self.holes = self.find_holes() if sparse else set()
+        self.zeros = memoryview(bytes(chunk_size if self.holes else 0))
+
+        # 需要读取的数据块: 计算校验和时须读取整个文件
+        if self.wanted is None or self.hasher is not None:
+            seqs = list(range(f_info.n_chunks(chunk_size)))
+        else:
+            seqs = sorted(self.wanted)
+        self.stripes = [seqs[i:i + STRIPE_CHUNKS]
+                        for i in range(0, len(seqs), STRIPE_CHUNKS)]
+        self.ahead = ReadAhead(seqs, chunk_size)
+        self.n_pending = len(self.stripes)
+
+    def find_holes(self) -> Set[int]:
+        '''找出完全位于空洞中的数据块'''
+        holes: Set[int] = set()
+        if not hasattr(os, 'SEEK_HOLE'):
+            return holes
+
+        size = self.f_info.size
+        n_chunks = self.f_info.n_chunks(self.chunk_size)
+        offset = 0
+        try:
+            while offset < size:
+                hole = os.lseek(self.fd, offset, os.SEEK_HOLE)
+                if hole >= size:
+                    break
+                try:
+                    offset = os.lseek(self.fd, hole, os.SEEK_DATA)
+                except OSError:
+                    offset = size  # ENXIO: 空洞一直延续到文件末尾
+                end = n_chunks if offset >= size else offset // self.chunk_size
+                holes.update(range(ceil(hole / self.chunk_size), end))
+        except OSError:
+            return set()  # 文件系统不支持
+        return holes
+
+    def read(self,
+             seqs: List[int]) -> Generator[Tuple[Packet, int], None, None]:
+        '''读取一组数据块, 封装需要发送的数据块, 并给出其原始大小'''
+        for seq in seqs:
+            if self.failed:
+                return
+            self.ahead.enter(seq)
+            try:
+                yield from self.read_chunk(seq)
+            finally:
+                self.ahead.leave(seq)
+
+    def read_chunk(self,
+                   seq: int) -> Generator[Tuple[Packet, int], None, None]:
+        '''读取一个数据块, 需要发送时给出其报文及原始大小'''
+        offset = seq * self.chunk_size
+        if seq in self.holes:
+            # 空洞中的数据全为 0, 无需读取
+            if self.hasher is not None:
+                length = min(self.chunk_size, self.f_info.size - offset)
+                self.hasher.update(seq, self.zeros[:length])
+            return
+        elif self.fp is not None:
+            length = min(self.chunk_size, self.f_info.size - offset)
+            if length > 0:
+                region = FileRegion(self.fp, offset, length)
+                yield Packet.load(Flag.FILE_CHUNK, self.f_info.id, seq,
+                                  region), length
+            return
+
+        # 读取过程中文件变短时得到空数据, 仍需交给 hasher 以免其他线程一直等待
+        try:
+            if self.view is not None:
+                chunk = self.view[offset:offset + self.chunk_size]
+            else:
+                chunk = os.pread(self.fd, self.chunk_size, offset)
+        except OSError as e:
+            logging.error(f'[Sender] Failed to read '
+                          f'{self.f_info.s_relpath}: {e}')
+            chunk = b''
+
+        if self.hasher is not None:
+            self.hasher.update(seq, chunk)
+        if not chunk or (self.wanted is not None
+                         and seq not in self.wanted):
+            return  # 接收端已有该数据块, 只需参与计算校验和
+        elif (seq < len(self.sigs)
+              and FileInfo.same_block(chunk, self.sigs[seq])):
+            with self.mutex:
+                self.kept.append(seq)
+        else:
+            old_offset = None
+            if self.sigs:
+                old_offset = self.locate(seq, len(chunk))
+            if old_offset is not None:
+                with self.mutex:
+                    self.copies.append((seq, old_offset))
+            else:
+                yield self.pack_chunk(seq, chunk), len(chunk)
+
+    def pread(self, offset: int, length: int) -> bytes:
+        if self.view is not None:
+            return bytes(self.view[offset:offset + length])
+        return os.pread(self.fd, length, offset)
+
+    def locate(self, seq: int, length: int) -> Optional[int]:
+        '''查找数据块是否由旧文件中的数据前后移动而来, 返回其在旧文件中的偏移
+
+        移动距离通常在一段数据内保持不变, 先按最近一次找到的距离确认;
+        否则在本数据块附近查找邻近旧数据块的块首锚点, 再以弱、强校验确认候选位置
+        '''
+        start = seq * self.chunk_size
+        shift = self.shift
+        if shift is not None and self.covered(start, length, shift):
+            return start - shift
+        if self.n_misses >= SHIFT_MAX_MISSES:
+            return None  # 新旧文件差异过大, 不再查找
+
+        # 覆盖本数据块起点的旧数据块, 其起点位于 (start - chunk_size, start]
+        lo = max(start - self.chunk_size + 1, 0)
+        window = self.pread(lo, start - lo + SIG_ANCHOR_SIZE)
+        tried = {0, shift}  # 0 即对齐位置, 已比对过
+        first = max(seq - SHIFT_SEARCH_BLOCKS, 0)
+        last = min(seq + SHIFT_SEARCH_BLOCKS + 1, len(self.sigs))
+        for j in range(first, last):
+            anchor = self.sigs[j][2]
+            pos = window.find(anchor)
+            # 内容单调的数据 (如全 0) 中锚点处处可见, 限制候选位置的数量
+            while pos >= 0 and len(tried) < SHIFT_SEARCH_BLOCKS + 2:
+                shift = lo + pos - j * self.chunk_size
+                if shift not in tried:
+                    tried.add(shift)
+                    if self.covered(start, length, shift):
+                        self.shift = shift
+                        self.n_misses = 0
+                        return start - shift
+                pos = window.find(anchor, pos + 1)
+        self.n_misses += 1
+        return None
+
+    def covered(self, start: int, length: int, shift: int) -> bool:
+        '''新文件中 [start, start + length) 是否与旧文件中前移 shift 字节处的数据相同'''
+        old_start = start - shift
+        if old_start < 0:
+            return False
+        first = old_start // self.chunk_size
+        last = (old_start + length - 1) // self.chunk_size
+        if last >= len(self.sigs):
+            return False
+        for j in range(first, last + 1):
+            if (j, shift) in self.verified:
+                continue
+            offset = j * self.chunk_size + shift
+            if offset < 0 or not FileInfo.same_block(
+                    self.pread(offset, self.chunk_size), self.sigs[j]):
+                return False
+            self.verified.add((j, shift))
+        return True
+
+    def pack_chunk(self, seq: int, chunk: Buffer) -> Packet:
+        '''封装数据块, 值得压缩时封装为 FILE_ZCHUNK'''
+        if self.compressor is not None:
+            data = self.compressor.compress(chunk)
+            if data is not None:
+                return Packet.load(Flag.FILE_ZCHUNK, self.f_info.id, seq, data)
+        return Packet.load(Flag.FILE_CHUNK, self.f_info.id, seq, chunk)
+
+    def fail(self) -> bool:
+        '''放弃发送该文件, 返回 end() 是否会报告放弃 (已结束时返回 False)'''
+        with self.mutex:
+            if self.ended:
+                return False
+            is_first, self.failed = not self.failed, True
+        if is_first:
+            self.ahead.abort()  # 唤醒等待中的其他组
+            if self.hasher is not None:
+                self.hasher.abort()
+        return True
+
+    def end(self) -> bool:
+        '''各组均已结束且收尾报文已发出, 返回是否已放弃发送'''
+        with self.mutex:
+            self.ended = True
+            return self.failed
+
+    def close(self):
+        '''关闭文件, 可重复调用 (已关闭的描述符编号可能已被其他文件复用)'''
+        if self.fd < 0:
+            return
+        if self.fp is None:
+            os.close(self.fd)
+        self.fd = -1
+        self.fp = None
+        self.view = None
+
+    def finish_stripe(self) -> bool:
+        '''一组数据块读取完毕, 返回是否是最后一组'''
+        with self.mutex:
+            self.n_pending -= 1
+            return self.n_pending <= 0
+
+    def finish(self) -> Generator[Packet, None, None]:
+        '''全部数据块读取完毕, 封装 FILE_HOLES、FILE_KEEP、FILE_COPY 与 FILE_HASH 报文'''
+        f_info = self.f_info
+        if self.hasher is not None:
+            f_info.chksum = self.hasher.digest()
+            if f_info.hash_cache is not None:
+                f_info.hash_cache.put(os.fstat(self.fd), f_info.chksum)
+        # 数据块可能仍在发送队列中, 不能关闭 mmap 或 sendfile 所用的文件,
+        # 待其全部发出后自动释放
+        self.close()
+
+        holes = self.holes
+        if self.wanted is not None:
+            holes = holes & self.wanted
+        if holes:
+            yield Packet.load(Flag.FILE_HOLES, f_info.id, seq_ranges(holes))
+
+        if self.kept:
+            yield Packet.load(Flag.FILE_KEEP, f_info.id, seq_ranges(self.kept))
+
+        if self.copies:
+            yield Packet.load(Flag.FILE_COPY, f_info.id, sorted(self.copies))
+
+        # 发送读取过程中计算出的校验和
+        if self.hash_unknown:
+            yield Packet.load(Flag.FILE_HASH, f_info.id, f_info.chksum)
+
+
+class FileWriter:
+    '''文件的写入任务
+
+    写入期间文件描述符保持打开, 连续的数据块由写入线程池中的线程通过 os.pwritev 写入。
+    写入前为各区段预先分配磁盘空间, 源文件的空洞处不分配, 文件保持稀疏。
+    开启 mmap 时先为整个文件分配磁盘空间, 成功后数据块直接拷贝进 mmap,
+    避免磁盘已满时写入映射区触发 SIGBUS。
+    提供 journal 时记录已写入的数据块, 并跳过上次中断前已写入的数据块。
+    增量传输 (basis_size 为本地旧文件的大小) 时, 旧数据块被覆盖前另存一份 (.文件名.fcpb),
+    FILE_COPY 引用的旧数据无论是否已被覆盖都能读到, 数据块的写入顺序因此不受限制
+    '''
+
+    def __init__(self, f_info: FileInfo, chunk_size: int,
+                 journal: Optional[ChunkJournal] = None, basis_size: int = 0):
+        # 确保文件的上级目录存在
+        f_info.abspath.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+
+        self.f_info = f_info
+        self.chunk_size = chunk_size
+        self.journal = journal
+        self.fd = os.open(f_info.abspath, os.O_RDWR | os.O_CREAT, 0o644)
+        os.ftruncate(self.fd, f_info.size)
+        self.blksize = os.fstat(self.fd).st_blksize or 4096
+        self.mm: Optional[mmap.mmap] = None
+        if use_mmap(f_info.size) and self.allocate():
+            self.mm = map_file(self.fd, f_info.size, mmap.ACCESS_WRITE)
+
+        # 尚未写入的数据块编号集
+        self.seqs = set(range(f_info.n_chunks(chunk_size)))
+        if journal is not None:
+            self.seqs = {seq for seq in self.seqs if not journal.has(seq)}
+        self.claimed: Set[int] = set()  # 正由写入线程在锁外写入的数据块
+        self.hasher = StreamHasher(chunk_size, self.fd)
+        self.mutex = Lock()
+        self.n_writing = 0  # 正在锁外写入的线程数
+        self.failed = False  # 已放弃写入, 由最后一个写入线程关闭文件
+
+        # 以下两项仅由接收主线程访问, 用于判断数据块是否已全部到达
+        self.n_expected = len(self.seqs)
+        self.n_arrived = 0
+
+        # 可能被 FILE_COPY 引用的旧数据块数, 及其中已另存的数据块
+        self.n_basis = ceil(min(basis_size, f_info.size) / chunk_size)
+        name = f_info.abspath.name
+        self.backup_path = f_info.abspath.with_name(f'.{name}.fcpb')
+        self.backup_fd = -1
+        self.saved: Set[int] = set()
+        if self.n_basis:
+            try:
+                self.backup_path.unlink()  # 上次中断时留下的副本已无用
+            except FileNotFoundError:
+                pass
+
+    def write(self, start: int, chunks: List[Buffer]) -> bool:
+        '''以 os.pwritev 写入从 start 开始的连续数据块, 返回文件是否已全部写完
+
+        已写入或正由其他线程写入的数据块 (重发的重复报文) 直接丢弃
+        '''
+        with self.mutex:
+            seqs = self.claim(range(start, start + len(chunks)))
+            if not seqs:
+                return False
+            if self.n_basis:
+                for run_start, count in seq_ranges(seqs):
+                    self.preserve(run_start, count)
+            self.n_writing += 1
+
+        written: Dict[int, Buffer] = {}
+        try:
+            for run_start, count in seq_ranges(seqs):
+                run = [chunks[seq - start] for seq in range(run_start,
+                                                            run_start + count)]
+                run = [chunk.decompress() if isinstance(chunk, Compressed)
+                       else chunk for chunk in run]
+                self.write_run(run_start * self.chunk_size, run)
+                written.update(zip(range(run_start, run_start + count), run))
+        finally:
+            # 写入出错时也记录已写完的数据块, 随后由调用方放弃文件
+            with self.mutex:
+                self.claimed.difference_update(seqs)
+                self.leave()
+                is_done = False
+                if not self.failed:
+                    for seq, chunk in written.items():
+                        self.done(seq, chunk)
+                    is_done = self.settle()
+        self.sync_journal()
+        return is_done
+
+    def write_run(self, offset: int, chunks: List[Buffer]):
+        views = [memoryview(chunk) for chunk in chunks]
+        if self.mm is None:
+            self.preallocate(offset, sum(len(view) for view in views))
+        else:
+            # 超出映射区的部分 (发送端文件在传输中变大) 仍通过 pwritev 写入
+            while views and offset + len(views[0]) <= len(self.mm):
+                chunk = views.pop(0)
+                self.mm[offset:offset + len(chunk)] = chunk
+                offset += len(chunk)
+        self.pwritev(views, offset)
+
+    def claim(self, seqs: Iterable[int]) -> List[int]:
+        '''认领尚未写入且无其他线程正在写入的数据块 (调用时须持有 self.mutex)
+
+        文件已放弃或已关闭时返回空列表
+        '''
+        if self.failed or self.fd < 0:
+            return []
+        claimed = [seq for seq in seqs
+                   if seq in self.seqs and seq not in self.claimed]
+        self.claimed.update(claimed)
+        return claimed
+
+    def done(self, seq: int, chunk: Optional[Buffer] = None):
+        '''数据块已写入, chunk 为 None 时从磁盘读取 (调用时须持有 self.mutex)'''
+        self.seqs.discard(seq)
+        if chunk is None:
+            self.hasher.written(seq)
+        else:
+            self.hasher.update(seq, chunk)
+        if self.journal is not None:
+            self.journal.mark(seq)
+
+    def settle(self) -> bool:
+        '''跟进日志中的数据块的 MD5, 返回文件是否已全部写完 (调用时须持有 self.mutex)'''
+        if self.journal is not None:
+            self.hasher.update_from(self.journal.has)
+        return not self.seqs
+
+    def pwritev(self, views: List[memoryview], offset: int):
+        while views:
+            n_written = os.pwritev(self.fd, views, offset)
+            offset += n_written
+            # 丢弃已写完的缓冲区, 截掉部分写入的缓冲区
+            while views and n_written >= len(views[0]):
+                n_written -= len(views.pop(0))
+            if views:
+                views[0] = views[0][n_written:]
+
+    def allocate(self) -> bool:
+        '''为整个文件分配磁盘空间, 返回是否成功'''
+        if not hasattr(os, 'posix_fallocate'):
+            return False
+        try:
+            os.posix_fallocate(self.fd, 0, self.f_info.size)
+            return True
+        except OSError:
+            return False
+
+    def preallocate(self, offset: int, length: int):
+        '''为即将写入的区段分配连续的磁盘空间, 减少乱序写入造成的碎片'''
+        if not hasattr(os, 'posix_fallocate'):
+            return
+
+        # 只分配区段独占的磁盘块: 文件系统不支持时 glibc 会逐块写入 0 来模拟，
+        # 不能碰到其他线程正在写入的相邻区段
+        end = offset + length
+        offset = -(-offset // self.blksize) * self.blksize
+        if end < self.f_info.size:
+            end = end // self.blksize * self.blksize
+        if end > offset:
+            try:
+                os.posix_fallocate(self.fd, offset, end - offset)
+            except OSError:
+                pass  # 文件系统不支持时直接写入
+
+    def fill_holes(self, start: int, count: int) -> bool:
+        '''数据块位于源文件的空洞中, 返回文件是否已全部写完
+
+        目标位置已是空洞时无需写入, 否则 (如增量传输的旧文件) 用 0 覆盖
+        '''
+        zeros = memoryview(bytes(self.chunk_size))
+        with self.mutex:
+            seqs = self.claim(range(start, start + count))
+            if not seqs:
+                return False
+            self.n_writing += 1
+
+        written: List[int] = []
+        try:
+            for run_start, run_count in seq_ranges(seqs):
+                offset = run_start * self.chunk_size
+                end = min((run_start + run_count) * self.chunk_size,
+                          self.f_info.size)
+                if offset < end and has_data(self.fd, offset, end):
+                    if self.n_basis:
+                        with self.mutex:
+                            self.preserve(run_start, run_count)
+                    for pos in range(offset, end, self.chunk_size):
+                        self.pwritev([zeros[:end - pos]], pos)
+                written.extend(range(run_start, run_start + run_count))
+        finally:
+            with self.mutex:
+                self.claimed.difference_update(seqs)
+                self.leave()
+                is_done = False
+                if not self.failed:
+                    for seq in written:
+                        length = min(self.chunk_size,
+                                     self.f_info.size - seq * self.chunk_size)
+                        self.done(seq, zeros[:length])
+                    is_done = self.settle()
+        self.sync_journal()
+        return is_done
+
+    def keep(self, seq: int) -> bool:
+        '''保留与本地已有数据相同的数据块, 返回文件是否已全部写完'''
+        with self.mutex:
+            if not self.claim([seq]):
+                return False
+            self.claimed.discard(seq)
+            self.done(seq)  # 本地数据轮到时由 hasher 从磁盘读出, 计算文件的 MD5
+            is_done = self.settle()
+        self.sync_journal()
+        return is_done
+
+    def sync_journal(self):
+        '''每隔一段时间将日志写入磁盘, 期间不阻塞其他写入线程'''
+        if self.journal is not None and self.journal.is_due():
+            self.journal.flush(self.fd, wait=False)
+
+    def copy(self, seq: int, offset: int) -> bool:
+        '''数据块与旧文件中 offset 处的数据相同, 从旧数据复制, 返回文件是否已全部写完'''
+        length = min(self.chunk_size, self.f_info.size - seq * self.chunk_size)
+        with self.mutex:
+            if not self.claim([seq]):
+                return False
+            self.claimed.discard(seq)
+            data = self.read_basis(offset, length)
+        return self.write(seq, [data])
+
+    def preserve(self, start: int, count: int):
+        '''旧数据块被覆盖前另存到副本的相同位置 (调用时须持有 self.mutex)'''
+        for seq in range(start, min(start + count, self.n_basis)):
+            if seq in self.saved:
+                continue
+            if self.backup_fd < 0:
+                self.backup_fd = os.open(self.backup_path,
+                                         os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+                                         0o600)
+            offset = seq * self.chunk_size
+            block = memoryview(os.pread(self.fd, self.chunk_size, offset))
+            while block:
+                n_written = os.pwrite(self.backup_fd, block, offset)
+                block = block[n_written:]
+                offset += n_written
+            self.saved.add(seq)
+
+    def read_basis(self, offset: int, length: int) -> bytes:
+        '''读取旧文件中的数据, 已被覆盖的部分从副本中读取 (调用时须持有 self.mutex)'''
+        parts = []
+        end = offset + length
+        while offset < end:
+            seq = offset // self.chunk_size
+            n_bytes = min(end, (seq + 1) * self.chunk_size) - offset
+            fd = self.backup_fd if seq in self.saved else self.fd
+            parts.append(os.pread(fd, n_bytes, offset))
+            offset += n_bytes
+        return b''.join(parts)
+
+    def finish(self) -> bytes:
+        '''全部写完后关闭文件, 返回文件的 MD5'''
+        digest = self.hasher.digest()
+        # 先删除日志, 其他线程随后不会再对 self.fd 落盘或重建日志
+        if self.journal is not None:
+            self.journal.remove()
+        self.close()
+        return digest
+
+    def fail(self) -> bool:
+        '''放弃写入, 返回是否成功放弃 (文件已全部写完时返回 False)
+
+        其他线程仍在写入时, 由其中最后一个线程关闭文件
+        '''
+        with self.mutex:
+            if self.failed or not self.seqs:
+                return False
+            self.failed = True
+            if self.n_writing == 0:
+                self.abort()
+            return True
+
+    def leave(self):
+        '''锁外写入结束 (调用时须持有 self.mutex)'''
+        self.n_writing -= 1
+        if self.failed and self.n_writing == 0:
+            self.abort()
+
+    def abort(self):
+        '''传输中断, 关闭文件并保留日志以便续传'''
+        if self.fd >= 0:
+            if self.journal is not None:
+                self.journal.close(self.fd)
+            self.close()
+
+    def close(self):
+        '''关闭文件, 出错时也先标记为已关闭, 以免重复关闭'''
+        fd, self.fd = self.fd, -1
+        try:
+            if self.mm is not None:
+                mm, self.mm = self.mm, None
+                mm.close()
+        finally:
+            try:
+                os.close(fd)
+            finally:
+                if self.backup_fd >= 0:
+                    backup_fd, self.backup_fd = self.backup_fd, -1
+                    os.close(backup_fd)
+                    self.backup_path.unlink()
+
+
+class WriteRun:
+    '''同一文件中相邻数据块组成的连续区段'''
+    __slots__ = ('writer', 'start', 'chunks', 'packets', 'n_bytes')
+
+    def __init__(self, writer: FileWriter, start: int):
+        self.writer = writer
+        self.start = start
+        self.chunks: List[Buffer] = []
+        self.packets: List[Packet] = []  # 数据块所在的报文, 写完后归还其缓冲区
+        self.n_bytes = 0
+
+    @property
+    def end(self) -> int:
+        return self.start + len(self.chunks)
+
+    def add(self, chunk: Buffer, packet: Packet):
+        self.chunks.append(chunk)
+        self.packets.append(packet)
+        self.n_bytes += len(chunk)
+
+
+class Coalescer:
+    '''合并同一文件中相邻的数据块, 凑成连续区段后一次写入
+
+    区段达到 RUN_MAX_BYTES 或 IOV_MAX 个数据块时写出，
+    暂存总量超过 COALESCE_MAX_BYTES 时全部写出
+    '''
+
+    def __init__(self, flush: Callable[[WriteRun], None],
+                 max_run: int = RUN_MAX_BYTES,
+                 max_bytes: int = COALESCE_MAX_BYTES):
+        self.flush = flush
+        self.max_run = max_run
+        self.max_bytes = max_bytes
+        self.runs: Dict[Tuple[int, int], WriteRun] = {}  # (f_id, end) -> run
+        self.n_bytes = 0
+
+    def add(self, writer: FileWriter, seq: int, chunk: Buffer, packet: Packet):
+        f_id = writer.f_info.id
+        run = self.runs.pop((f_id, seq), None)  # 能接在某个区段之后
+        if run is None:
+            run = WriteRun(writer, seq)
+        run.add(chunk, packet)
+        self.n_bytes += len(chunk)
+
+        if run.n_bytes >= self.max_run or len(run.chunks) >= IOV_MAX:
+            self.flush_run(run)
+        else:
+            self.runs[(f_id, run.end)] = run
+            if self.n_bytes > self.max_bytes:
+                self.flush_all()
+
+    def flush_run(self, run: WriteRun):
+        self.n_bytes -= run.n_bytes
+        self.flush(run)
+
+    def flush_file(self, f_id: int):
+        '''写出一个文件的全部区段'''
+        for key in [key for key in self.runs if key[0] == f_id]:
+            self.flush_run(self.runs.pop(key))
+
+    def flush_all(self):
+        runs, self.runs = self.runs, {}
+        for run in runs.values():
+            self.flush_run(run)
+
 
 class Sender(Thread):
     def __init__(self, sid: bytes, username: str, src_paths: List[str],
-                 pool_size: int, include=None, exclude=None):
+                 pool_size: int, include=None, exclude=None,
+                 params: SessionParams = LEGACY,
+                 n_hashers: int = HASH_WORKERS):
         super().__init__(daemon=True)
 
         self.sid = sid
         self.username = username
         self.srcs = src_paths
-        self.conn_pool = ConnectionPool(pool_size)
+        self.params = params
+        self.conn_pool = ConnectionPool(pool_size, params)
         self.include = include or '*'
         self.exclude = exclude or []
         self.tree: Dict[int, Union[DirInfo, FileInfo]] = {}
+        self.n_hashers = max(n_hashers, 1)  # 计算文件校验和的线程数
+        self.n_failed = 0  # 无法读取的文件数
+        self.mutex = Lock()
+        self.readers = ThreadPoolExecutor(READ_WORKERS)  # 并行读取文件
+        self.progress_tasks: Dict[int, TaskID] = {}
+        self.sending: Dict[int, StripedReader] = {}  # 正在发送的文件
+        self.n_sent: Dict[int, int] = {}  # 已发送完毕的文件本轮发出的报文数
 
     @staticmethod
     def abspath(username: str, path: str):
@@ -294,10 +1256,63 @@ class Sender(Thread):
             for paths in cls.checkout_paths(_path, include, exclude):
                 yield paths
 
+    def send_file_info(self, future: Future, slots: Semaphore):
+        '''文件校验和计算完成后，将文件信息发送给接收端'''
+        slots.release()
+        try:
+            f_info = future.result()
+        except OSError as e:
+            logging.warning(f'[Sender] Skip unreadable file: {e}')
+            with self.mutex:
+                self.n_failed += 1
+        else:
+            self.tree[f_info.id] = f_info
+            info_pkt = Packet.load(Flag.FILE_INFO, *f_info)
+            self.conn_pool.send(info_pkt)
+
+    def send_bundle(self, f_ids: List[int]):
+        '''读出接收端索取的小文件, 连同内容打包发送 (在读取线程池中执行)'''
+        bundle_size = self.params.bundle_size
+        bundle = []
+        for f_id in f_ids:
+            f_info = self.tree[f_id]
+            try:
+                # 多读一个字节, 以发现文件已变大
+                with f_info.abspath.open('rb') as fp:
+                    data = fp.read(bundle_size + 1)
+                if len(data) > bundle_size:
+                    # 已放不进包里, 重新发送文件信息, 改为逐块发送
+                    f_info = FileInfo.load(f_id, f_info.abspath,
+                                           Path(f_info.s_relpath),
+                                           not self.params.quick_check)
+                    self.tree[f_id] = f_info
+                    info_pkt = Packet.load(Flag.FILE_INFO, *f_info)
+                    self.conn_pool.send(info_pkt)
+                    continue
+            except OSError as e:
+                logging.error(f'[Sender] Failed to read '
+                              f'{f_info.s_relpath}: {e}')
+                self.conn_pool.send(Packet.load(Flag.FILE_FAILED, f_id, 0))
+                continue
+            # 以实际读到的内容为准
+            bundle.append((f_id, f_info.perm, len(data), f_info.mtime,
+                           md5(data).digest(), f_info.relpath, data))
+        if bundle:
+            logging.debug(f'[Sender] Send bundle of {len(bundle)} files')
+            self.conn_pool.send(Packet.load(Flag.BUNDLE, bundle))
+
     def prepare_all_files(self):
         '''整理要传输的文件列表'''
         _id = 0
         relpaths = set()
+
+        # 文件校验和在线程池中并行计算 (hashlib 计算时会释放 GIL)
+        # 待计算的文件数有上限，避免遍历过快时积压过多任务
+        # 快速比对模式下不预先计算校验和，改为在发送文件时计算
+        hash_pool = ThreadPoolExecutor(self.n_hashers)
+        slots = Semaphore(self.n_hashers * 4)
+        with_hash = not self.params.quick_check
+
         for src_path in self.srcs:
             items = self.search_files_and_dirs(self.username, src_path,
                                                self.include, self.exclude)
@@ -306,28 +1321,130 @@ class Sender(Thread):
                     # 整理目录树
                     relpaths.add(relpath)
                     if fullpath.is_file():
-                        inf_cls, flag = FileInfo, Flag.FILE_INFO
+                        slots.acquire()
+                        future = hash_pool.submit(FileInfo.load, _id,
+                                                  fullpath, relpath, with_hash)
+                        future.add_done_callback(
+                            lambda fut: self.send_file_info(fut, slots))
+                        logging.debug(f'[Sender] Found FileInfo: '
+                                      f'id={_id} path={relpath.as_posix()}')
                     else:
-                        inf_cls, flag = DirInfo, Flag.DIR_INFO
-                    self.tree[_id] = inf_cls.load(_id, fullpath, relpath)
-
-                    # 将 文件/目录 信息发送给接收端
-                    info_pkt = Packet.load(flag, *self.tree[_id])
-                    self.conn_pool.send(info_pkt)
-                    logging.debug(f'[Sender] Found {inf_cls.__name__}: '
-                                  f'id={_id} path={relpath.as_posix()}')
+                        # 将目录信息直接发送给接收端
+                        self.tree[_id] = DirInfo.load(_id, fullpath, relpath)
+                        info_pkt = Packet.load(Flag.DIR_INFO, *self.tree[_id])
+                        self.conn_pool.send(info_pkt)
+                        logging.debug(f'[Sender] Found DirInfo: '
+                                      f'id={_id} path={relpath.as_posix()}')
 
                     _id += 1
                 else:
                     logging.debug(f'[Sender] Name conflict: '
                                   f'{relpath.as_posix()}, ignore.')
 
-        if _id == 0:
+        # 等待所有文件信息发出
+        hash_pool.shutdown(wait=True)
+        n_items = _id - self.n_failed
+
+        if n_items == 0:
             packet = Packet.load(Flag.EXCEPTION, 'No such file or directory')
         else:
-            packet = Packet.load(Flag.FILE_COUNT, _id)
+            packet = Packet.load(Flag.FILE_COUNT, n_items)
         self.conn_pool.send(packet)
-        logging.info(f'[Sender] Num of files and dirs: {_id}')
+        logging.info(f'[Sender] Num of files and dirs: {n_items}')
+
+    def send_file(self, f_id: int, sigs: Optional[List[BlockSig]] = None,
+                  missing: Optional[List[Tuple[int, int]]] = None):
+        '''将文件的各组数据块交给读取线程池'''
+        f_info = self.tree[f_id]
+        self.n_sent[f_id] = 0
+        try:
+            compressor = ChunkCompressor.for_file(self.params.codec,
+                                                  self.params.level,
+                                                  f_info.abspath)
+            reader = StripedReader(f_info, self.params.chunk_size, sigs,
+                                   missing, self.conn_pool.can_sendfile,
+                                   self.params.protocol >= 2, compressor)
+        except OSError as e:
+            logging.error(f'[Sender] Failed to open {f_info.s_relpath}: {e}')
+            self.fail_file(f_id)
+            return
+
+        # 添加进度条任务
+        with progress_lock:
+            self.progress_tasks[f_id] = trans_progress.add_task(
+                f'upload-{f_info.name}',
+                filename=f_info.name,
+                total=f_info.size,
+                start=True
+            )
+
+        # 各组按顺序提交, 线程池先进先出, 保证 OrderedHasher 不会死锁
+        self.sending[f_id] = reader
+        for seqs in reader.stripes:
+            self.readers.submit(self.send_stripe, reader, seqs)
+        if not reader.stripes:
+            self.end_file(reader)
+
+    def send_stripe(self, reader: StripedReader, seqs: List[int]):
+        '''读取并发送一组数据块 (在读取线程池中执行)'''
+        f_info = reader.f_info
+        task_id = self.progress_tasks[f_info.id]
+        try:
+            for chunk_packet, n_bytes in reader.read(seqs):
+                self.send_file_packet(reader, chunk_packet)
+                update_task(task_id, advance=n_bytes)
+        except Exception as e:
+            logging.error(f'[Sender] Failed to send {f_info.s_relpath}: {e}')
+            reader.fail()
+
+        if reader.finish_stripe():
+            self.end_file(reader)
+
+    def send_file_packet(self, reader: StripedReader, packet: Packet):
+        '''发送文件的报文并计数'''
+        self.conn_pool.send(packet)
+        with reader.mutex:
+            reader.n_sent += 1
+
+    def end_file(self, reader: StripedReader):
+        '''各组均已结束: 发出收尾报文, 已放弃时通知接收端'''
+        f_info = reader.f_info
+        if not reader.failed:
+            try:
+                self.finish_file(reader)
+            except Exception as e:
+                logging.error(f'[Sender] Failed to send {f_info.s_relpath}: '
+                              f'{e}')
+                reader.fail()
+        task_id = self.progress_tasks.pop(f_info.id, None)
+        if reader.failed:
+            reader.close()
+            if task_id is not None:
+                remove_task(task_id)
+        elif task_id is not None:
+            # 数据已全部发出, 进度条出错也不影响文件本身
+            update_task(task_id, completed=f_info.size)
+            handle_finished_task(trans_progress)
+
+        # 先记下报文数再标记结束, 此后收到的 FILE_FAILED 由接收线程直接回复
+        self.n_sent[f_info.id] = reader.n_sent
+        del self.sending[f_info.id]
+        if reader.end():
+            self.fail_file(f_info.id)
+
+    def fail_file(self, f_id: int):
+        '''通知接收端该文件发送失败, 或确认已停止发送接收端放弃的文件
+
+        附带本轮为该文件发出的报文数, 接收端收齐后再计为失败, 以免会话结束时仍有报文在途
+        '''
+        if self.params.protocol >= 2:
+            fail_pkt = Packet.load(Flag.FILE_FAILED, f_id, self.n_sent[f_id])
+            self.conn_pool.send(fail_pkt)
+
+    def finish_file(self, reader: StripedReader):
+        '''文件的全部数据块发出后, 发送 FILE_HOLES、FILE_KEEP 与 FILE_HASH'''
+        for packet in reader.finish():
+            self.send_file_packet(reader, packet)
 
     def run(self):
         logging.debug(f'[Sender] Sender-{self.sid.hex()[:8]} is running')
@@ -354,22 +1471,25 @@ class Sender(Thread):
                 break
 
             if packet.flag == Flag.FILE_READY:
-                f_id, = packet.unpack_body()
-                f_info = self.tree[f_id]
-
-                # 添加进度条任务
-                task_id = trans_progress.add_task(
-                    f'upload-{f_info.name}',
-                    filename=f_info.name,
-                    total=f_info.size,
-                    start=True
-                )
-
-                # 发送文件数据块
-                for chunk_packet in f_info.iread():
-                    self.conn_pool.send(chunk_packet)
-                    trans_progress.update(task_id, advance=chunk_packet.length)
-                handle_finished_task(trans_progress)
+                f_id, missing = packet.unpack_body()
+                self.send_file(f_id, missing=missing)
+
+            elif packet.flag == Flag.FILE_SIGS:
+                # 接收端已有该文件的旧版本, 只发送有变化的数据块
+                f_id, sigs = packet.unpack_body()
+                self.send_file(f_id, sigs)
+
+            elif packet.flag == Flag.FILE_WANT:
+                # 接收端索取内容有变化的小文件
+                f_ids, = packet.unpack_body()
+                self.readers.submit(self.send_bundle, f_ids)
+
+            elif packet.flag == Flag.FILE_FAILED:
+                # 接收端无法写入该文件: 停止读取, 已读出的数据块发出后回复
+                f_id, _ = packet.unpack_body()
+                reader = self.sending.get(f_id)
+                if reader is None or not reader.fail():
+                    self.fail_file(f_id)
 
             elif packet.flag == Flag.DONE:
                 logging.info('[Sender] All files are processed, exit.')
@@ -378,18 +1498,20 @@ class Sender(Thread):
             else:
                 logging.error(f'[Sender] Unknow packet: {packet}')
 
+        self.readers.shutdown(wait=False)
         self.conn_pool.stop()
         logging.debug(f'Sender-{self.sid.hex()[:8]} exit')
 
 
 class Receiver(Thread):
     def __init__(self, sid: bytes, username: str, dst_path: str,
-                 pool_size: int):
+                 pool_size: int, params: SessionParams = LEGACY):
         super().__init__(daemon=True)
 
         self.sid = sid
         self.dst_path = Sender.abspath(username, dst_path)
-        self.conn_pool = ConnectionPool(pool_size)
+        self.params = params
+        self.conn_pool = ConnectionPool(pool_size, params)
 
         self.base_dir = Path.home()
         self.size = 0
@@ -397,11 +1519,29 @@ class Receiver(Thread):
         self.n_recv = 0
         self.total = 0xffffffff
         self.use_custom_name = False
-        self.concurrency = Semaphore(8)  # 允许同时写入的文件数
+        self.window = Window()  # 控制同时接收的文件数与数据量
         self.files: Dict[int, FileInfo] = {}
-        self.iwriters: Dict[int, Generator] = {}
+        self.writers: Dict[int, FileWriter] = {}
+        self.write_q: Queue = Queue(WRITE_QUEUE_SIZE)  # 交给写入线程的区段
+        self.coalescer = Coalescer(self.write_q.put)  # 合并相邻的数据块
+        self.done_q: Queue = Queue()  # 写入线程已写完的文件: (f_id, digest)
+        self.write_threads: List[Thread] = []
         self.ready_files: Deque[int] = deque()
+        # 已写完的文件的实际校验和, None 表示写入失败
+        self.digests: Dict[int, Optional[bytes]] = {}
+        # 放弃的文件须收齐发送端本轮发出的报文再计为失败, 以免会话结束时仍有报文在途
+        self.file_packets: Dict[int, int] = {}  # 本轮收到的各文件的报文数
+        self.failing: Dict[int, Optional[int]] = {}  # 放弃的文件: 发送端发出的报文数
+        self.failed_files: Dict[int, int] = {}  # 写完后才收到 FILE_FAILED 的文件
+        self.basis_sizes: Dict[int, int] = {}  # 可增量传输的文件的原有大小
+        self.journals: Dict[int, ChunkJournal] = {}  # 可断点续传的文件的日志
+        self.n_repairs: Dict[int, int] = {}  # 校验失败的文件已请求重传的次数
+        self.sig_pool = ThreadPoolExecutor(HASH_WORKERS)  # 计算数据块签名
         self.trans_progress_tasks: Dict[int, TaskID] = {}
+        # 内容有变化的小文件攒够一个数据块大小后一起向发送端索取, 由其打包发送
+        self.wanted: List[int] = []  # 尚未索取的小文件
+        self.wanted_bytes = 0
+        self.bundling: Set[int] = set()  # 已索取、尚未收到内容的小文件
 
     def check_dst_path(self):
         '''检查目标路径'''
@@ -433,46 +1573,155 @@ class Receiver(Thread):
     def ready_notice(self):
         '''通知对端文件准备就绪'''
         while self.ready_files:
-            if self.concurrency.acquire(False):
+            if self.window.is_open():
                 f_id = self.ready_files[0]
                 f_info = self.files[f_id]
-                # 创建写入迭代器
-                self.iwriters[f_id] = f_info.iwrite()
-                self.iwriters[f_id].send(None)
+                chunk_size = self.params.chunk_size
+
+                # 续传上次中断的文件, 或为大文件新建断点续传日志
+                missing = None
+                journal = self.journals.pop(f_id, None)
+                if journal is not None:
+                    missing = journal.missing()
+                    if not missing:
+                        # 中断前已全部写入, 重传最后一块以完成校验流程
+                        journal.unmark(journal.n_chunks - 1)
+                        missing = journal.missing()
+                    logging.info(f'[Receiver] Resume {f_info.s_relpath}, '
+                                 f'{len(missing)} ranges missing')
+                elif (self.params.protocol >= 2
+                      and f_info.size >= RESUME_MIN_SIZE):
+                    journal = ChunkJournal.create(f_info.abspath, chunk_size,
+                                                  f_info.size, f_info.mtime,
+                                                  f_info.chksum)
+
+                # 按尚需接收的数据量占用窗口
+                n_bytes = f_info.size
+                if missing is not None:
+                    n_missing = sum(count for _, count in missing)
+                    n_bytes = min(n_missing * chunk_size, f_info.size)
+                self.window.admit(f_id, n_bytes)
+
+                # 创建写入任务
+                basis_size = self.basis_sizes.pop(f_id, 0)
+                self.writers[f_id] = FileWriter(f_info, chunk_size, journal,
+                                                basis_size)
+                self.file_packets[f_id] = 0
 
                 # 通知对端: 文件准备就绪
-                logging.debug(f'[Receiver] File({f_id}) ready')
-                ready_pkt = Packet.load(Flag.FILE_READY, f_id)
-                self.conn_pool.send(ready_pkt)
+                # 本地已有旧版本时，改为在数据块签名计算完成后发出 FILE_SIGS
+                if basis_size:
+                    self.sig_pool.submit(self.send_block_sigs, f_info,
+                                         basis_size)
+                elif missing is not None:
+                    logging.debug(f'[Receiver] File({f_id}) ready to resume')
+                    ready_pkt = Packet.load(Flag.FILE_READY, f_id, missing)
+                    self.conn_pool.send(ready_pkt)
+                else:
+                    logging.debug(f'[Receiver] File({f_id}) ready')
+                    ready_pkt = Packet.load(Flag.FILE_READY, f_id)
+                    self.conn_pool.send(ready_pkt)
                 self.ready_files.popleft()
 
                 # 添加进度条任务
-                task_id = trans_progress.add_task(
-                    f'download-{f_info.name}',
-                    filename=f_info.name,
-                    total=f_info.size,
-                    start=True
-                )
+                with progress_lock:
+                    task_id = trans_progress.add_task(
+                        f'download-{f_info.name}',
+                        filename=f_info.name,
+                        total=f_info.size,
+                        completed=f_info.size - n_bytes,
+                        start=True
+                    )
                 self.trans_progress_tasks[f_id] = task_id
             else:
                 break
 
+    def want(self, f_info: FileInfo):
+        '''内容有变化的小文件: 攒够一个数据块大小后一起索取'''
+        self.files[f_info.id] = f_info
+        self.bundling.add(f_info.id)
+        self.wanted.append(f_info.id)
+        # 按打包后的大小估算, 包含每个文件的信息与路径
+        self.wanted_bytes += f_info.size + 40 + len(f_info.relpath)
+        if self.wanted_bytes >= self.params.chunk_size:
+            self.flush_wanted()
+
+    def flush_wanted(self):
+        '''向发送端索取已攒下的小文件'''
+        if self.wanted:
+            logging.debug(f'[Receiver] Want {len(self.wanted)} small files')
+            self.conn_pool.send(Packet.load(Flag.FILE_WANT, self.wanted))
+            self.wanted = []
+            self.wanted_bytes = 0
+
+    def process_bundle(self, packet: Packet):
+        '''处理发送端打包发来的小文件, 均为本端索取的内容有变化的文件'''
+        entries, = packet.unpack_body()
+        for *info, data in entries:
+            f_info = FileInfo(*info)
+            self.locate(f_info)
+            self.bundling.discard(f_info.id)
+            try:
+                if md5(data).digest() == f_info.chksum:
+                    f_info.write(data)
+                    f_info.set_stat()
+                    logging.info(f'[Receiver] File finished: '
+                                 f'{f_info.s_relpath}')
+                else:
+                    # 内容损坏, 改为像普通文件一样请求发送端逐块发送
+                    logging.warning(f'[Receiver] Bad file hash: '
+                                    f'{f_info.s_relpath}, request it again')
+                    self.files[f_info.id] = f_info
+                    self.size += f_info.size
+                    self.ready_files.append(f_info.id)
+                    self.ready_notice()
+                    continue
+            except OSError as e:
+                # 计为失败, 不影响同一报文中的其他文件
+                logging.error(f'[Receiver] Failed to write '
+                              f'{f_info.s_relpath}: {e}')
+            self.n_recv += 1
+
+    def locate(self, f_info: FileInfo):
+        '''确定文件的保存路径'''
+        if self.use_custom_name:
+            f_info.abspath = self.dst_path
+        else:
+            f_info.set_parent(self.base_dir)
+
     def process_file_info(self, packet: Packet):
         '''处理文件信息报文'''
         # 解包，并创建 FileInfo 对象
         f_info = FileInfo(*packet.unpack_body())
-        if self.use_custom_name:
-            f_info.abspath = self.dst_path
+        self.locate(f_info)
+        # 索取的小文件已变大时, 发送端重新发来文件信息, 改为逐块发送
+        self.bundling.discard(f_info.id)
+
+        # 检查文件是否需要传输, 上次中断的文件直接续传
+        journal = None
+        if self.params.protocol >= 2 and f_info.size >= RESUME_MIN_SIZE:
+            journal = ChunkJournal.load(f_info.abspath,
+                                        self.params.chunk_size, f_info.size,
+                                        f_info.mtime, f_info.chksum)
+
+        if journal is not None:
+            self.journals[f_info.id] = journal
+            unchanged = False
+        elif self.params.quick_check:
+            unchanged = f_info.is_unchanged()
         else:
-            f_info.set_parent(self.base_dir)
+            unchanged = f_info.is_vaild()
 
-        # 检查文件是否需要传输
-        if f_info.is_vaild():
-            f_info.set_stat()
+        if unchanged:
+            f_info.set_stat(verified=not self.params.quick_check)
             self.n_recv += 1
             logging.info(f'[Receiver] File finished: {f_info.s_relpath}.')
         else:
-            if f_info.size > 0:
+            if 0 < f_info.size <= self.params.bundle_size:
+                self.want(f_info)
+            elif f_info.size > 0:
+                if self.params.delta and journal is None:
+                    self.check_basis(f_info)
                 self.files[f_info.id] = f_info
                 self.size += f_info.size
                 self.ready_files.append(f_info.id)  # 将 f_id 加入待通知队列
@@ -483,50 +1732,283 @@ class Receiver(Thread):
                 self.n_recv += 1
                 logging.info(f'[Receiver] File finished: {f_info.s_relpath}')
 
-    def get_iwriter(self, f_id):
-        '''获取写入迭代器'''
-        if f_id not in self.iwriters:
-            f_info = self.files[f_id]
-            # 创建并启动写入迭代器
-            self.iwriters[f_id] = f_info.iwrite()
-            self.iwriters[f_id].send(None)
-        return self.iwriters[f_id]
+    def check_basis(self, f_info: FileInfo):
+        '''本地已有较大的旧版本文件时，只接收有变化的数据块'''
+        try:
+            stat = f_info.abspath.stat()
+        except OSError:
+            return
+        if S_ISREG(stat.st_mode) and min(stat.st_size,
+                                         f_info.size) >= DELTA_MIN_SIZE:
+            self.basis_sizes[f_info.id] = stat.st_size
+
+    def send_block_sigs(self, f_info: FileInfo, basis_size: int):
+        '''计算本地文件的数据块签名并发给对端 (在线程池中执行)'''
+        try:
+            sigs = f_info.block_sigs(self.params.chunk_size, basis_size)
+        except OSError as e:
+            logging.warning('[Receiver] Failed to read '
+                            f'{f_info.s_relpath}: {e}')
+            sigs = []
+        logging.debug(f'[Receiver] File({f_info.id}) ready with '
+                      f'{len(sigs)} block sigs')
+        sigs_pkt = Packet.load(Flag.FILE_SIGS, f_info.id, sigs)
+        self.conn_pool.send(sigs_pkt)
 
     def process_file_chunk(self, packet: Packet):
-        '''处理文件数据块'''
+        '''处理文件数据块, 交给写入线程写入'''
         f_id, seq, chunk = packet.unpack_body()
-        try:
-            logging.debug(f'[Receiver] Write chunk({seq}) '
-                          f'into {self.files[f_id].s_relpath}')
-            iwriter = self.get_iwriter(f_id)
-            trans_progress.update(self.trans_progress_tasks[f_id],
-                                  advance=len(chunk))
-            handle_finished_task(trans_progress)
-            iwriter.send((seq, chunk))
-        except StopIteration:
-            # 释放并发计数器
-            self.concurrency.release()
-            # 检查文件 Hash
-            if self.files[f_id].is_vaild():
-                self.files[f_id].set_stat()  # 修改文件状态
-                self.n_recv += 1
-                self.iwriters.pop(f_id)
-                self.ready_notice()
-                logging.info(f'[Receiver] File finished: '
-                             f'{self.files[f_id].s_relpath}')
+        self.count_file_packet(f_id)
+        writer = self.writers.get(f_id)
+        if writer is None:
+            # 文件已写完, 丢弃重复的数据块
+            self.conn_pool.release(packet)
+            return 0
+        if packet.flag == Flag.FILE_ZCHUNK:
+            # 解压交给写入线程, 此处按解压后的大小计算进度与窗口
+            offset = seq * self.params.chunk_size
+            length = min(self.params.chunk_size, writer.f_info.size - offset)
+            chunk = Compressed(chunk, length, self.params.codec)
+
+        logging.debug(f'[Receiver] Write chunk({seq}) '
+                      f'into {writer.f_info.s_relpath}')
+        update_task(self.trans_progress_tasks[f_id],
+                    advance=len(chunk))
+        handle_finished_task(trans_progress)
+        self.window.consume(f_id, len(chunk))
+
+        # 相邻数据块合并后交给写入线程
+        # 写入线程跟不上时在此阻塞, 接收队列随之写满, 最终由 TCP 反压发送端
+        self.coalescer.add(writer, seq, chunk, packet)
+        writer.n_arrived += 1
+        if writer.n_arrived >= writer.n_expected:
+            self.coalescer.flush_file(f_id)
+
+        self.ready_notice()  # 窗口有空余时通知下一个文件就绪
+        return len(chunk)
+
+    def process_file_keep(self, packet: Packet):
+        '''处理与本地数据相同、无需传输的数据块'''
+        f_id, ranges = packet.unpack_body()
+        self.count_file_packet(f_id)
+        writer = self.writers.get(f_id)
+        if writer is None:
+            return  # 文件已写入失败, 不再处理
+        n_kept = sum(count for _, count in ranges)
+        logging.debug(f'[Receiver] Keep {n_kept} chunks '
+                      f'of {self.files[f_id].s_relpath}')
+        update_task(self.trans_progress_tasks[f_id],
+                    advance=n_kept * self.params.chunk_size)
+        for start, count in ranges:
+            for seq in range(start, start + count):
+                self.write_q.put((writer, writer.keep, seq))
+        writer.n_arrived += n_kept
+        if writer.n_arrived >= writer.n_expected:
+            self.coalescer.flush_file(f_id)
+
+    def process_file_copy(self, packet: Packet):
+        '''处理由旧文件中的数据前后移动而来、无需传输的数据块'''
+        f_id, copies = packet.unpack_body()
+        self.count_file_packet(f_id)
+        writer = self.writers.get(f_id)
+        if writer is None:
+            return  # 文件已写入失败, 不再处理
+        logging.debug(f'[Receiver] Copy {len(copies)} moved chunks '
+                      f'of {self.files[f_id].s_relpath}')
+        update_task(self.trans_progress_tasks[f_id],
+                    advance=len(copies) * self.params.chunk_size)
+        for seq, offset in copies:
+            self.write_q.put((writer, writer.copy, seq, offset))
+        writer.n_arrived += len(copies)
+        if writer.n_arrived >= writer.n_expected:
+            self.coalescer.flush_file(f_id)
+
+    def process_file_holes(self, packet: Packet):
+        '''处理位于源文件空洞中、无需传输的数据块'''
+        f_id, ranges = packet.unpack_body()
+        self.count_file_packet(f_id)
+        writer = self.writers.get(f_id)
+        if writer is None:
+            return  # 文件已写入失败, 不再处理
+        f_info = self.files[f_id]
+        n_holes = sum(count for _, count in ranges)
+        logging.debug(f'[Receiver] Skip {n_holes} hole chunks '
+                      f'of {f_info.s_relpath}')
+        update_task(self.trans_progress_tasks[f_id],
+                    advance=n_holes * self.params.chunk_size)
+        for start, count in ranges:
+            self.write_q.put((writer, writer.fill_holes, start, count))
+        writer.n_arrived += n_holes
+        if writer.n_arrived >= writer.n_expected:
+            self.coalescer.flush_file(f_id)
+
+    def write_chunks(self):
+        '''写入线程: 从队列中取出数据块写入文件'''
+        while True:
+            item = self.write_q.get()
+            if item is None:
+                break
+
+            # 队列中为待写入的区段, 或 (writer, 方法, 参数...) 表示保留的数据块及空洞
+            if isinstance(item, WriteRun):
+                writer, packets = item.writer, item.packets
             else:
-                logging.error(f'[Receiver] Bad file hash: '
-                              f'{self.files[f_id].s_relpath}')
+                writer, packets = item[0], []
 
-        return len(chunk)
+            is_done = False
+            try:
+                if isinstance(item, WriteRun):
+                    is_done = writer.write(item.start, item.chunks)
+                else:
+                    is_done = item[1](*item[2:])
+                if is_done:
+                    self.done_q.put((writer.f_info.id, writer.finish()))
+            except (OSError, ValueError) as e:
+                # 放弃该文件, 由接收主线程释放窗口并计为失败
+                logging.error(f'[Receiver] Failed to write '
+                              f'{writer.f_info.s_relpath}: {e}')
+                # 关闭文件时可能再次出错, 不能因此退出写入线程
+                report = is_done
+                try:
+                    if is_done:
+                        writer.abort()  # 已全部写入, 计算校验和时出错
+                    else:
+                        report = writer.fail()
+                except Exception as err:
+                    logging.error(f'[Receiver] Failed to close '
+                                  f'{writer.f_info.s_relpath}: {err}')
+                    report = True  # 出错时已由本线程放弃该文件
+                if report:
+                    self.done_q.put((writer.f_info.id, None))
+            finally:
+                # 数据已写入文件，归还接收缓冲区
+                for packet in packets:
+                    self.conn_pool.release(packet)
+
+    def process_finished_files(self):
+        '''处理写入线程已写完的文件'''
+        while True:
+            try:
+                f_id, digest = self.done_q.get_nowait()
+            except Empty:
+                break
+
+            # 释放文件占用的窗口
+            self.window.finish(f_id)
+            self.writers.pop(f_id)
+            self.ready_notice()
+
+            # 检查文件 Hash, 快速比对模式下需等待发送端发来校验和
+            if f_id in self.failed_files:
+                # 写完时发送端已放弃该文件
+                self.failing[f_id] = self.failed_files.pop(f_id)
+                self.check_failing(f_id)
+                continue
+            elif digest is None and self.params.protocol >= 2:
+                # 本端放弃写入, 待发送端停止发送该文件并告知报文数
+                self.failing[f_id] = None
+                self.conn_pool.send(Packet.load(Flag.FILE_FAILED, f_id, 0))
+                continue
+            self.digests[f_id] = digest
+            if digest is None or self.files[f_id].chksum != UNKNOWN_HASH:
+                self.verify_file(f_id)
+
+    def process_file_failed(self, packet: Packet):
+        '''处理发送端无法读取或发送的文件: 放弃写入并计为失败'''
+        f_id, n_packets = packet.unpack_body()
+        if f_id in self.bundling:
+            # 发送端无法读取索取的小文件
+            self.bundling.discard(f_id)
+            logging.error(f'[Receiver] Failed to receive '
+                          f'{self.files[f_id].s_relpath}')
+            self.n_recv += 1
+            return
+        if f_id in self.failing and self.failing[f_id] is None:
+            # 发送端已停止发送本端放弃的文件
+            self.failing[f_id] = n_packets
+            self.check_failing(f_id)
+            return
+
+        writer = self.writers.get(f_id)
+        if writer is not None and writer.fail():
+            # 由 process_finished_files 释放窗口后向发送端确认
+            self.done_q.put((f_id, None))
+        elif f_id in self.digests:
+            # 已写完, 不再等待发送端的校验和
+            del self.digests[f_id]
+            self.failing[f_id] = n_packets
+            self.check_failing(f_id)
+        elif writer is not None:
+            # 写入线程刚好写完, 结果尚在 done_q 中
+            self.failed_files[f_id] = n_packets
+
+    def count_file_packet(self, f_id: int):
+        '''统计本轮收到的该文件的报文'''
+        self.file_packets[f_id] = self.file_packets.get(f_id, 0) + 1
+        if f_id in self.failing:
+            self.check_failing(f_id)
+
+    def check_failing(self, f_id: int):
+        '''放弃的文件在发送端发出的报文全部到达后计为失败'''
+        n_packets = self.failing[f_id]
+        if n_packets is not None and self.file_packets[f_id] >= n_packets:
+            del self.failing[f_id]
+            self.digests[f_id] = None
+            self.verify_file(f_id)
+
+    def process_file_hash(self, packet: Packet):
+        '''处理发送端在读取文件时计算出的校验和'''
+        f_id, chksum = packet.unpack_body()
+        self.count_file_packet(f_id)
+        self.files[f_id].chksum = chksum
+        if f_id in self.digests:
+            self.verify_file(f_id)
+
+    def verify_file(self, f_id: int):
+        '''检查已写完的文件的 Hash, 不一致时请求对端重发有差异的数据块'''
+        f_info = self.files[f_id]
+        n_repairs = self.n_repairs.get(f_id, 0)
+        digest = self.digests.pop(f_id)
+        if digest is None:
+            logging.error(f'[Receiver] Failed to receive {f_info.s_relpath}')
+            self.n_recv += 1
+        elif digest == f_info.chksum:
+            f_info.set_stat()  # 修改文件状态
+            self.n_recv += 1
+            logging.info(f'[Receiver] File finished: {f_info.s_relpath}')
+        elif self.params.protocol >= 2 and n_repairs < REPAIR_RETRIES:
+            # 以写坏的文件为旧版本重新就绪, 对端比对数据块签名后只重发内容不同的数据块
+            self.n_repairs[f_id] = n_repairs + 1
+            logging.warning(f'[Receiver] Bad file hash: {f_info.s_relpath}, '
+                            f'resend the mismatched chunks')
+            self.basis_sizes[f_id] = f_info.size
+            self.ready_files.append(f_id)
+            self.ready_notice()
+        else:
+            # 放弃该文件, 以免会话一直等待
+            logging.error(f'[Receiver] Bad file hash: {f_info.s_relpath}')
+            self.n_recv += 1
 
     def run(self):
         logging.debug(f'Receiver-{self.sid.hex()[:8]} is running')
         self.conn_pool.start()  # 启动连接池
 
+        # 启动写入线程
+        for _ in range(WRITE_WORKERS):
+            t_write = Thread(target=self.write_chunks, daemon=True)
+            t_write.start()
+            self.write_threads.append(t_write)
+
         # 等待接收文件总数数据包
+        # 多个连接之间的报文没有先后顺序，先到达的信息报文需暂存
         logging.debug('[Receiver] Waitting for translation mode')
+        early_packets: Deque[Packet] = deque()
         packet = self.conn_pool.recv()
+        while packet.flag in (Flag.DIR_INFO, Flag.FILE_INFO, Flag.BUNDLE,
+                              Flag.FILE_COUNT):
+            early_packets.append(packet)
+            packet = self.conn_pool.recv()
+
         if packet.flag == Flag.MONOFILE:
             # 取出文件总数，并确认目标路径
             self.is_monofile, = packet.unpack_body()
@@ -540,17 +2022,56 @@ class Receiver(Thread):
             return
 
         # 等待接收文件信息和数据
+        # 对端消失 (连接全部断开且未重新 ATTACH, 或长时间没有报文) 时超时退出
+        last_recv = monotonic()  # 最近一次收到报文的时间
+        is_timeout = False
         while self.n_recv < self.total:
-            packet = self.conn_pool.recv()
+            self.process_finished_files()
+            if early_packets:
+                packet = early_packets.popleft()
+            else:
+                # 定时醒来检查写入线程已写完的文件
+                packet = self.conn_pool.poll(POLL_INTERVAL)
+                if packet is None:
+                    # 暂时没有新数据, 不再等待合并与攒够小文件
+                    self.coalescer.flush_all()
+                    self.flush_wanted()
+                    if monotonic() - last_recv > TIMEOUT:
+                        logging.error('[Receiver] get input queue timeout, '
+                                      'exit.')
+                        is_timeout = True
+                        break
+                    continue
+                last_recv = monotonic()
+
             if packet.flag == Flag.DIR_INFO:
                 self.process_dir_info(packet)
 
             elif packet.flag == Flag.FILE_INFO:
                 self.process_file_info(packet)
 
-            elif packet.flag == Flag.FILE_CHUNK:
+            elif (packet.flag == Flag.FILE_CHUNK
+                  or packet.flag == Flag.FILE_ZCHUNK):
                 self.process_file_chunk(packet)
 
+            elif packet.flag == Flag.BUNDLE:
+                self.process_bundle(packet)
+
+            elif packet.flag == Flag.FILE_KEEP:
+                self.process_file_keep(packet)
+
+            elif packet.flag == Flag.FILE_COPY:
+                self.process_file_copy(packet)
+
+            elif packet.flag == Flag.FILE_HOLES:
+                self.process_file_holes(packet)
+
+            elif packet.flag == Flag.FILE_HASH:
+                self.process_file_hash(packet)
+
+            elif packet.flag == Flag.FILE_FAILED:
+                self.process_file_failed(packet)
+
             elif packet.flag == Flag.FILE_COUNT:
                 self.total, = packet.unpack_body()
 
@@ -562,10 +2083,25 @@ class Receiver(Thread):
             else:
                 logging.error(f'[Receiver] Unknow packet flag: {packet.flag}')
 
-        self.conn_pool.send(Packet.load(Flag.DONE))
-        logging.info('[Receiver] All files finished.')
+        # 停止写入线程, 关闭未写完的文件并保存其断点续传日志
+        self.coalescer.flush_all()
+        for _ in self.write_threads:
+            self.write_q.put(None)
+        for t_write in self.write_threads:
+            t_write.join()
+        for writer in self.writers.values():
+            writer.abort()
+
+        if is_timeout:
+            # 对端可能已不在, 尽力通知后不再等待报文发完
+            exit_pkt = Packet.load(Flag.EXCEPTION, 'waitting timeout.')
+            self.conn_pool.send(exit_pkt, timeout=CLOSE_TIMEOUT)
+        else:
+            self.conn_pool.send(Packet.load(Flag.DONE))
+            logging.info('[Receiver] All files finished.')
+        self.sig_pool.shutdown(wait=False)
 
-        self.conn_pool.stop()
+        self.conn_pool.stop(timeout=CLOSE_TIMEOUT if is_timeout else None)
         logging.info(f'Receiver-{self.sid.hex()[:8]} exit')
 
 
@@ -0,0 +1,96 @@
+from time import monotonic
+from typing import Dict
+
+from .config import (WINDOW_MIN_BYTES, WINDOW_MAX_BYTES, WINDOW_MIN_FILES,
+                     WINDOW_MAX_FILES)
+
+ALPHA = 0.125  # 平滑系数, 与 TCP 估算 RTT 的方式相同
+SAMPLE_INTERVAL = 0.5  # 带宽采样间隔 (秒)
+
+
+class Window:
+    '''接收窗口
+
+    同时限制在途字节数 (已就绪文件中尚未收到的数据量) 与在途文件数，
+    两者的目标值均根据实测的 带宽 × RTT 动态调整。
+    按剩余字节数计算在途数据量，正在传输的文件快结束时即可通知下一个文件就绪，
+    使发送端始终有数据可发。
+    '''
+
+    def __init__(self):
+        self.max_bytes = WINDOW_MIN_BYTES
+        self.max_files = WINDOW_MIN_FILES
+        self.n_bytes = 0  # 在途字节数
+        self.remaining: Dict[int, int] = {}  # 各在途文件尚未收到的字节数
+        self.admitted_at: Dict[int, float] = {}  # 尚未收到数据的文件的就绪时间
+
+        self.rtt = 0.0  # 从通知就绪到收到第一个数据块的平均耗时
+        self.bandwidth = 0.0  # 平均接收速率 (Bytes/s)
+        self.file_rate = 0.0  # 平均每秒完成的文件数
+        self.sampled_at = monotonic()
+        self.sampled_bytes = 0
+        self.sampled_files = 0
+
+    def __str__(self) -> str:
+        return (f'Window(bytes={self.n_bytes}/{self.max_bytes}, '
+                f'files={len(self.remaining)}/{self.max_files}, '
+                f'rtt={self.rtt * 1000:.1f}ms, '
+                f'bw={self.bandwidth / 1024 / 1024:.1f}MB/s)')
+
+    def is_open(self) -> bool:
+        '''是否可以再接收一个文件'''
+        return (not self.remaining
+                or (self.n_bytes < self.max_bytes
+                    and len(self.remaining) < self.max_files))
+
+    def admit(self, f_id: int, n_bytes: int):
+        '''通知对端文件就绪前登记该文件'''
+        self.remaining[f_id] = n_bytes
+        self.n_bytes += n_bytes
+        self.admitted_at[f_id] = monotonic()
+
+    def consume(self, f_id: int, n_bytes: int):
+        '''收到文件数据'''
+        now = monotonic()
+        admitted_at = self.admitted_at.pop(f_id, None)
+        if admitted_at is not None:
+            self.rtt = self.smooth(self.rtt, now - admitted_at)
+
+        remaining = self.remaining.get(f_id, 0)
+        n_bytes = min(n_bytes, remaining)
+        self.remaining[f_id] = remaining - n_bytes
+        self.n_bytes -= n_bytes
+        self.sampled_bytes += n_bytes
+        self.sample(now)
+
+    def finish(self, f_id: int):
+        '''文件接收完毕, 释放其剩余的窗口 (如增量传输时未发送的数据块)'''
+        self.n_bytes -= self.remaining.pop(f_id, 0)
+        self.admitted_at.pop(f_id, None)
+        self.sampled_files += 1
+
+    @staticmethod
+    def smooth(average: float, sample: float) -> float:
+        return sample if average == 0 else average + ALPHA * (sample - average)
+
+    def sample(self, now: float):
+        '''定期采样带宽, 并据此调整窗口大小'''
+        elapsed = now - self.sampled_at
+        if elapsed < SAMPLE_INTERVAL:
+            return
+
+        self.bandwidth = self.smooth(self.bandwidth,
+                                     self.sampled_bytes / elapsed)
+        self.file_rate = self.smooth(self.file_rate,
+                                     self.sampled_files / elapsed)
+        self.sampled_at = now
+        self.sampled_bytes = 0
+        self.sampled_files = 0
+
+        # 在途数据量保持为两倍的带宽时延积, 以容忍带宽与时延的波动
+        max_bytes = int(self.bandwidth * self.rtt * 2)
+        self.max_bytes = max(WINDOW_MIN_BYTES,
+                             min(max_bytes, WINDOW_MAX_BYTES))
+        max_files = int(self.file_rate * self.rtt * 2)
+        self.max_files = max(WINDOW_MIN_FILES,
+                             min(max_files, WINDOW_MAX_FILES))
@@ -6,7 +6,7 @@ with open("README.md", "r") as f_readme:
 setuptools.setup(
     name="fastcopy",
     version="0.1.8",
-    python_requires=">=3.6",
+    python_requires=">=3.7",
     author="Seamile",
     author_email="lanhuermao@gmail.com",
     description="A multi-threaded file transfer tool over SSH. The goal is to replace SCP.",
@@ -19,6 +19,11 @@ setuptools.setup(
         "python-daemon>=2.3.0",
         "rich>=10.6.0"
     ],
+    extras_require={
+        "crc32c": ["crc32c>=2.2"],
+        "zstd": ["zstandard>=0.15"],
+        "lz4": ["lz4>=3.1"]
+    },
     entry_points={
         'console_scripts': [
             'fcp=fastcopy.client:main',
@@ -0,0 +1,51 @@
+import os
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from fastcopy.journal import ChunkJournal
+
+CHUNK_SIZE = 4096
+N_CHUNKS = 16
+
+
+class ChunkJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.filepath = Path(self.tmp.name, 'data')
+        self.fd = os.open(self.filepath, os.O_RDWR | os.O_CREAT)
+        os.ftruncate(self.fd, CHUNK_SIZE * N_CHUNKS)
+        self.journal = ChunkJournal.create(self.filepath, CHUNK_SIZE,
+                                           CHUNK_SIZE * N_CHUNKS, 0.0,
+                                           bytes(16))
+
+    def tearDown(self):
+        os.close(self.fd)
+        self.tmp.cleanup()
+
+    def test_resume_from_flushed_marks(self):
+        '''落盘后的标记在下次传输时读回'''
+        self.journal.mark(3)
+        self.journal.close(self.fd)
+        journal = ChunkJournal.load(self.filepath, CHUNK_SIZE,
+                                    CHUNK_SIZE * N_CHUNKS, 0.0, bytes(16))
+        self.assertIsNotNone(journal)
+        self.assertTrue(journal.has(3))
+        self.assertFalse(journal.has(4))
+
+    def test_no_flush_after_remove(self):
+        '''日志删除后, 迟到的 flush 不会重建日志'''
+        self.journal.mark(0)
+        self.journal.flush(self.fd)
+        path = ChunkJournal.path_of(self.filepath)
+        self.assertTrue(path.is_file())
+
+        self.journal.remove()
+        self.journal.mark(1)
+        self.journal.flush(self.fd, wait=False)
+        self.journal.close(self.fd)
+        self.assertFalse(path.exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import socket
+import unittest
+from collections import Counter
+from struct import pack
+from threading import Thread
+from time import monotonic, sleep
+
+from fastcopy.network import ConnectionPool, Flag, Packet, SessionParams
+
+
+def make_params() -> SessionParams:
+    '''协商重发, 不做流量控制'''
+    requested = SessionParams.request(chunk_size=64 * 1024, credit=0)
+    return SessionParams.negotiate(requested)
+
+
+def make_chunk(seq: int, size: int) -> bytes:
+    '''内容由 seq 决定的数据块, 便于接收端核对'''
+    return pack('>I', seq) * (size // 4)
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    N_PACKETS = 600
+    CHUNK_SIZE = 16 * 1024
+
+    def setUp(self):
+        params = make_params()
+        self.sender = ConnectionPool(params=params)
+        self.receiver = ConnectionPool(params=params)
+
+        # 两条本地 socket 连接, 两端的连接编号一一对应
+        self.pairs = [socket.socketpair() for _ in range(2)]
+        for conn_id, (a, b) in enumerate(self.pairs):
+            self.sender.add(a, conn_id)
+            self.receiver.add(b, conn_id)
+        self.sender.start()
+        self.receiver.start()
+        self.stopped = False
+
+    def tearDown(self):
+        if self.stopped:
+            return
+        # 双方同时结束, 各自等待对端关闭连接
+        stopper = Thread(target=self.sender.stop, daemon=True)
+        stopper.start()
+        self.receiver.stop()
+        stopper.join()
+
+    def send_all(self):
+        for seq in range(self.N_PACKETS):
+            chunk = make_chunk(seq, self.CHUNK_SIZE)
+            self.sender.send(Packet.load(Flag.FILE_CHUNK, 1, seq, chunk))
+
+    def test_resend_after_drop(self):
+        '''传输中途一条连接断开, 接收端仍恰好收到每个报文一次'''
+        feeder = Thread(target=self.send_all, daemon=True)
+        feeder.start()
+
+        received: Counter = Counter()
+        while sum(received.values()) < self.N_PACKETS:
+            packet = self.receiver.poll(timeout=30)
+            self.assertIsNotNone(packet, 'transfer stalled')
+            self.assertEqual(packet.flag, Flag.FILE_CHUNK)
+            f_id, seq, chunk = packet.unpack_body()
+            self.assertEqual(f_id, 1)
+            self.assertEqual(bytes(chunk), make_chunk(seq, self.CHUNK_SIZE))
+            received[seq] += 1
+            self.receiver.release(packet)
+
+            if sum(received.values()) == self.N_PACKETS // 4:
+                # 模拟网络故障: 发送端一侧的 socket 两个方向同时中断
+                self.pairs[0][0].shutdown(socket.SHUT_RDWR)
+
+        feeder.join(timeout=30)
+        self.assertFalse(feeder.is_alive())
+        self.assertEqual(set(received), set(range(self.N_PACKETS)))
+        self.assertEqual(set(received.values()), {1})
+
+    def test_ack_tail(self):
+        '''不足一次确认的少量报文也会在空闲后确认, 发送端不再为重发保留它们'''
+        for seq in range(3):
+            chunk = make_chunk(seq, self.CHUNK_SIZE)
+            self.sender.send(Packet.load(Flag.FILE_CHUNK, 1, seq, chunk))
+        for _ in range(3):
+            packet = self.receiver.poll(timeout=30)
+            self.assertIsNotNone(packet, 'transfer stalled')
+            self.receiver.release(packet)
+
+        deadline = monotonic() + 5
+        while monotonic() < deadline:
+            with self.sender.cond:
+                n_unacked = sum(len(outbox.unacked)
+                                for outbox in self.sender.outboxes.values())
+            if n_unacked == 0:
+                break
+            sleep(0.05)
+        self.assertEqual(n_unacked, 0)
+
+    def test_done_is_not_a_drop(self):
+        '''发出 DONE 的一端随后收到对端关闭连接, 不算意外断开'''
+        drops = []
+        self.sender.on_drop = drops.append
+        self.receiver.on_drop = drops.append
+
+        # 同接收端结束会话: 发出 DONE 后还要做些收尾工作才停止连接池
+        self.receiver.send(Packet.load(Flag.DONE))
+        packet = self.sender.poll(timeout=30)
+        self.assertIsNotNone(packet)
+        self.assertEqual(packet.flag, Flag.DONE)
+        stopper = Thread(target=self.sender.stop, daemon=True)
+        stopper.start()
+        sleep(0.5)  # 发送端已关闭写方向, 接收端读到连接结束
+        self.receiver.stop()
+        stopper.join()
+        self.stopped = True
+
+        self.assertEqual(drops, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
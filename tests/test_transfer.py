@@ -0,0 +1,163 @@
+import getpass
+import socket
+import unittest
+from pathlib import Path
+from random import Random
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import monotonic, sleep
+from unittest import mock
+
+from fastcopy.journal import ChunkJournal
+from fastcopy.network import ConnectionPool, Flag, Packet, SessionParams
+from fastcopy.transfer import UNKNOWN_HASH, Receiver, Sender
+
+
+def make_params() -> SessionParams:
+    '''协商重发与流量控制, 数据块较小以便每个文件分为多组并行读取'''
+    requested = SessionParams.request(chunk_size=64 * 1024)
+    return SessionParams.negotiate(requested)
+
+
+class SessionTest(unittest.TestCase):
+    N_FILES = 60
+    N_CONNS = 3
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.src = Path(self.tmp.name, 'src')
+        self.dst = Path(self.tmp.name, 'dst')
+        self.src.mkdir()
+        self.dst.mkdir()
+
+        # 大小不一的文件: 小文件打包发送, 大文件分为多组由多个读取线程并行读取
+        rand = Random(0)
+        for i in range(self.N_FILES):
+            size = rand.choice([1024, 32 * 1024, 300 * 1024, 1200 * 1024])
+            self.src.joinpath(f'f{i:02d}').write_bytes(rand.randbytes(size))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def start_session(self):
+        '''通过本地 socket 连接启动一次传输, 两端的连接编号一一对应'''
+        params = make_params()
+        user = getpass.getuser()
+        self.sender = Sender(b'\0' * 16, user, [str(self.src)],
+                             self.N_CONNS, params=params)
+        self.receiver = Receiver(b'\0' * 16, user, str(self.dst),
+                                 self.N_CONNS, params=params)
+        self.pairs = [socket.socketpair() for _ in range(self.N_CONNS)]
+        for conn_id, (a, b) in enumerate(self.pairs):
+            self.sender.conn_pool.add(a, conn_id)
+            self.receiver.conn_pool.add(b, conn_id)
+
+        # 记下发送端发出的报文类型
+        self.sent_flags = []
+        send = self.sender.conn_pool.send
+
+        def record(packet, *args, **kwargs):
+            self.sent_flags.append(packet.flag)
+            return send(packet, *args, **kwargs)
+        self.sender.conn_pool.send = record
+
+        self.receiver.start()
+        self.sender.start()
+
+    def finish_session(self):
+        '''等待传输结束, 检查所有文件均已完整送达'''
+        self.receiver.join(timeout=60)
+        self.sender.join(timeout=60)
+        self.assertFalse(self.receiver.is_alive(), 'receiver stalled')
+        self.assertFalse(self.sender.is_alive(), 'sender stalled')
+
+        for src_file in self.src.iterdir():
+            dst_file = self.dst.joinpath(src_file.name)
+            self.assertTrue(dst_file.is_file(), src_file.name)
+            self.assertEqual(dst_file.read_bytes(), src_file.read_bytes(),
+                             src_file.name)
+
+    def drop_when(self, n_recv: int):
+        '''接收端收完 n_recv 个文件后, 模拟一条连接的网络故障'''
+        deadline = monotonic() + 30
+        while self.receiver.n_recv < n_recv and monotonic() < deadline:
+            sleep(0.001)
+        self.pairs[0][0].shutdown(socket.SHUT_RDWR)
+
+    def test_resend_after_drop(self):
+        '''多个文件并行传输时一条连接断开, 所有文件仍完整送达'''
+        self.start_session()
+        dropper = Thread(target=self.drop_when, args=(self.N_FILES // 4,),
+                         daemon=True)
+        dropper.start()
+        self.finish_session()
+        dropper.join(timeout=30)
+        self.assertIn(Flag.BUNDLE, self.sent_flags)
+
+    def test_skip_unchanged_small_files(self):
+        '''再次同步未变化的文件时, 小文件与大文件的内容都不再发送'''
+        self.start_session()
+        self.finish_session()
+
+        self.start_session()
+        self.finish_session()
+        for flag in (Flag.BUNDLE, Flag.FILE_CHUNK, Flag.FILE_ZCHUNK):
+            self.assertNotIn(flag, self.sent_flags)
+
+
+class PeerVanishTest(unittest.TestCase):
+    N_CHUNKS = 8
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.dst = Path(self.tmp.name)
+        params = make_params()
+        self.chunk_size = params.chunk_size
+        self.receiver = Receiver(b'\0' * 16, getpass.getuser(),
+                                 str(self.dst), 2, params=params)
+
+        # 由另一个连接池扮演发送端, 手工发出报文
+        self.peer = ConnectionPool(params=params)
+        self.pairs = [socket.socketpair() for _ in range(2)]
+        for conn_id, (a, b) in enumerate(self.pairs):
+            self.peer.add(a, conn_id)
+            self.receiver.conn_pool.add(b, conn_id)
+        self.peer.start()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @mock.patch('fastcopy.transfer.RESUME_MIN_SIZE', 0)
+    @mock.patch('fastcopy.transfer.TIMEOUT', 1)
+    @mock.patch('fastcopy.transfer.CLOSE_TIMEOUT', 0.5)
+    def test_exit_when_peer_vanishes(self):
+        '''发送端中途消失, 接收端超时退出并保留断点续传日志'''
+        self.receiver.start()
+        size = self.N_CHUNKS * self.chunk_size
+        self.peer.send(Packet.load(Flag.MONOFILE, True))
+        self.peer.send(Packet.load(Flag.FILE_COUNT, 1))
+        self.peer.send(Packet.load(Flag.FILE_INFO, 1, 0o100644, size,
+                                   monotonic(), UNKNOWN_HASH, b'big'))
+        packet = self.peer.poll(timeout=30)
+        while packet is not None and packet.flag != Flag.FILE_READY:
+            packet = self.peer.poll(timeout=30)
+        self.assertIsNotNone(packet, 'file is not ready')
+        for seq in range(2):
+            chunk = bytes([seq]) * self.chunk_size
+            self.peer.send(Packet.load(Flag.FILE_CHUNK, 1, seq, chunk))
+        sleep(0.5)
+
+        # 模拟发送端消失: 所有连接同时中断, 且不会重新 ATTACH
+        for a, _ in self.pairs:
+            a.shutdown(socket.SHUT_RDWR)
+
+        self.receiver.join(timeout=30)
+        self.assertFalse(self.receiver.is_alive(), 'receiver never exits')
+        for t_write in self.receiver.write_threads:
+            self.assertFalse(t_write.is_alive())
+        journal = ChunkJournal.path_of(self.dst.joinpath('big'))
+        self.assertTrue(journal.is_file(), 'journal is removed')
+
+
+if __name__ == '__main__':
+    unittest.main()